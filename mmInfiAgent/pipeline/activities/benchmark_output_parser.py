@@ -0,0 +1,149 @@
+"""
+Micro-benchmark of the ReAct output parser of AsyncReactAgent against the former regex parser.
+
+Both parsers run over recorded LLM outputs, the completions stored by eval.py --llm_cache record and the turns of
+mock LLM server trajectories, plus sample outputs and malformed ones of growing size. The script checks that both
+parsers give the same step or the same error for every output, and exits with 1 otherwise.
+
+    python activities/benchmark_output_parser.py --llm_cache_path tmp/llm_response_cache.sqlite
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from typing import Callable, List, Tuple
+
+from infiagent.utils import get_logger
+from infiagent.llm.response_cache import RESPONSE_CACHE_PATH
+from infiagent.agent.react.output_parser import parse_react_output, parse_react_output_regex
+from infiagent.exceptions.exceptions import LLMException
+
+logger = get_logger()
+
+SAMPLE_OUTPUTS = [
+    "Let me look at the attached files first.\n"
+    "Action: python_code_sandbox\n"
+    "Action Input: ```python\n"
+    "import pandas as pd\n"
+    "df = pd.read_csv('upload_files/data.csv')\n"
+    "print(df.describe())\n"
+    "```\n",
+    "Thought: I now know the final answer.\n"
+    "Final Answer: ```json[\"42\"]```",
+    "I will plot the distribution.\n"
+    "```python\n"
+    "df['price'].hist()\n"
+    "```",
+    "Thought: the column names are unclear, I should print them.\n"
+    "Action: python_code_sandbox\n",
+]
+
+# Malformed outputs the former regexes backtrack on, by the size they are repeated to
+MALFORMED_OUTPUTS: List[Tuple[str, Callable[[int], str]]] = [
+    ("unclosed code block",
+     lambda size: "Action: python_code_sandbox\nAction Input: ```python\n" + "df.head()\n" * size),
+    ("repeated actions", lambda size: "Action: python_code_sandbox\n" * size),
+    ("unclosed code blocks", lambda size: "```python\nprint(1)\n" * size),
+]
+
+
+def _get_script_params():
+    parser = argparse.ArgumentParser(description="Benchmark the ReAct output parser against the former regexes")
+    parser.add_argument('--llm_cache_path',
+                        help='Response cache of recorded LLM outputs, skipped when it does not exist',
+                        default=RESPONSE_CACHE_PATH,
+                        required=False, type=str)
+    parser.add_argument('--trajectories',
+                        help='JSONL file of mock LLM server trajectories, one {"question": ..., "turns": [...]} '
+                             'per line',
+                        default=None,
+                        required=False, type=str)
+    parser.add_argument('--malformed_sizes',
+                        help='Comma separated repetitions of the malformed outputs, the former parser takes '
+                             'seconds from about 50 on',
+                        default="10,20,40",
+                        required=False, type=str)
+    parser.add_argument('--repeat',
+                        help='Runs per output, the fastest one is reported',
+                        default=5,
+                        required=False, type=int)
+    return parser.parse_args()
+
+
+def load_recorded_outputs(llm_cache_path: str, trajectories_path: str = None) -> List[str]:
+    """
+    Load the LLM outputs stored in a response cache and in a trajectories file.
+    """
+    outputs = []
+    if llm_cache_path and os.path.isfile(llm_cache_path):
+        connection = sqlite3.connect(f"file:{llm_cache_path}?mode=ro", uri=True)
+        try:
+            for value, in connection.execute("SELECT value FROM responses"):
+                content = json.loads(zlib.decompress(value)).get("content")
+                if isinstance(content, str):
+                    outputs.append(content)
+        finally:
+            connection.close()
+    if trajectories_path:
+        with open(trajectories_path, "r", encoding="utf-8") as fr:
+            for line in fr:
+                if line.strip():
+                    outputs.extend(json.loads(line)["turns"])
+    return outputs
+
+
+def _outcome(parse: Callable, llm_output: str):
+    try:
+        return parse(llm_output)
+    except LLMException as e:
+        return str(e)
+
+
+def _time(parse: Callable, llm_output: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        _outcome(parse, llm_output)
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def main():
+    args = _get_script_params()
+    recorded_outputs = load_recorded_outputs(args.llm_cache_path, args.trajectories)
+    cases = [("recorded", output) for output in recorded_outputs] + \
+            [("sample", output) for output in SAMPLE_OUTPUTS]
+    for size in [int(size) for size in args.malformed_sizes.split(",") if size.strip()]:
+        cases.extend((f"{name} x{size}", build(size)) for name, build in MALFORMED_OUTPUTS)
+    logger.info(f"Parsing {len(recorded_outputs)} recorded and {len(cases) - len(recorded_outputs)} other outputs")
+
+    mismatches = 0
+    totals = {}
+    for name, llm_output in cases:
+        if _outcome(parse_react_output, llm_output) != _outcome(parse_react_output_regex, llm_output):
+            mismatches += 1
+            logger.error(f"Parsers disagree on the {name} output: {llm_output!r}")
+        regex_time = _time(parse_react_output_regex, llm_output, args.repeat)
+        scan_time = _time(parse_react_output, llm_output, args.repeat)
+        group = "recorded" if name == "recorded" else name
+        total = totals.setdefault(group, [0, 0.0, 0.0, 0])
+        total[0] += 1
+        total[1] += regex_time
+        total[2] += scan_time
+        total[3] = max(total[3], len(llm_output))
+
+    print(f"{'outputs':<28}{'count':>7}{'max chars':>11}{'regex ms':>12}{'scan ms':>10}{'speedup':>9}")
+    for group, (count, regex_time, scan_time, max_length) in totals.items():
+        print(f"{group:<28}{count:>7}{max_length:>11}{regex_time * 1000:>12.3f}{scan_time * 1000:>10.3f}"
+              f"{regex_time / max(scan_time, 1e-9):>8.1f}x")
+    if mismatches:
+        logger.error(f"{mismatches} of {len(cases)} outputs are parsed differently")
+        sys.exit(1)
+    logger.info(f"All {len(cases)} outputs are parsed the same by both parsers")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,42 +6,30 @@ import asyncio
 import logging
 import sys
 import json
-import io
 import pandas as pd
 import openai
 import time
+from functools import partial
 
 
 import infiagent
-from infiagent.utils import get_logger, upload_files, get_file_name_and_path
+from infiagent.utils import get_logger, STAGE_MODES, STAGE_MODE_AUTO, get_file_name_and_path, parse_shard, select_shard, \
+    get_shard_output_path, find_shard_output_paths, merge_shard_outputs, get_question_id, ResultWriter
 from infiagent.services.chat_complete_service import predict
+from infiagent.schemas import QuestionBudget
+from infiagent.tools import AsyncPythonSandBoxTool, configure_execution_cache
+from infiagent.tools.code_sandbox.execution_cache import EXECUTION_CACHE_PATH, EXECUTION_CACHE_MAX_SIZE
+from infiagent.llm.transport import configure_transport, close_transport, shutdown_sdk_executor
+from infiagent.llm.rate_limiter import configure_rate_limits
+from infiagent.llm.response_cache import CACHE_MODE_OFF, CACHE_MODES, RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_PATH, \
+    configure_response_cache
+from infiagent.llm.image_cache import IMAGE_CACHE_MAX_SIZE, configure_image_cache
 
 
 logger = get_logger()
 
 
 
-class UploadedFile(io.BytesIO):
-    def __init__(self, path):
-        with open(path, 'rb') as file:
-            data = file.read()
-
-        super().__init__(data)
-
-        self.name = path.split("/")[-1]  # 获取文件名
-        if self.name.endswith('.png'):
-            self.type = 'image/png'
-        else:
-            self.type = 'application/octet-stream'  # 或者其他适当的 MIME 类型
-        self.size = len(data)
-
-    def __repr__(self):
-        return f"MyUploadedFile(name={self.name}, size={self.size}, type={self.type})"
-
-    def __len__(self):
-        return self.size
-
-
 def _get_script_params():
     try:
         parser = argparse.ArgumentParser()
@@ -63,6 +51,132 @@ def _get_script_params():
                             # "../output/results_qwenvl_max.jsonl"
                             # "../output/results_geminiProVision.jsonl"
                             required=False, type=str)
+        parser.add_argument('--concurrency',
+                            help='Number of questions kept in flight at once, each with its own session and sandbox',
+                            default=1,
+                            required=False, type=int)
+        parser.add_argument('--stage_mode',
+                            help='How benchmark files are staged into the sandbox, auto clones them copy-on-write '
+                                 'or links a read-only copy shared by the sandboxes, hardlink and symlink share the '
+                                 'writable benchmark files themselves with the sandbox code',
+                            default=STAGE_MODE_AUTO, choices=STAGE_MODES,
+                            required=False, type=str)
+        parser.add_argument('--kernel_pool_size',
+                            help='Number of sandbox kernels started ahead of time with the data science stack imported',
+                            default=0,
+                            required=False, type=int)
+        parser.add_argument('--kernel_max_uses',
+                            help='Number of questions a pooled kernel answers before it is replaced by a fresh one',
+                            default=20,
+                            required=False, type=int)
+        parser.add_argument('--step_timeout',
+                            help='Seconds a code run may take before the sandbox kernel is interrupted, the kernel '
+                                 'keeps its variables and the agent gets a timeout observation',
+                            default=AsyncPythonSandBoxTool.STEP_TIMEOUT,
+                            required=False, type=float)
+        parser.add_argument('--question_max_seconds', '--question_timeout',
+                            help='Seconds a question may take in all, its LLM calls and code runs are cut to the time '
+                                 'left and the agent then answers that it ran out of time. With a question_timeout in '
+                                 'the sandbox tool config the earlier deadline wins',
+                            default=None,
+                            required=False, type=float)
+        parser.add_argument('--question_max_tokens',
+                            help='Prompt and completion tokens of all the LLM calls of a question',
+                            default=None,
+                            required=False, type=int)
+        parser.add_argument('--question_max_sandbox_seconds',
+                            help='Seconds of all the code runs of a question, cut at their step timeouts',
+                            default=None,
+                            required=False, type=float)
+        parser.add_argument('--run_timeout',
+                            help='Seconds the whole run may take, running questions are finished and the questions '
+                                 'not started yet are left for a resumed run',
+                            default=None,
+                            required=False, type=float)
+        parser.add_argument('--run_deadline',
+                            help='Unix time at which the run ends, set by the parent process for its shard workers '
+                                 'instead of --run_timeout',
+                            default=None,
+                            required=False, type=float)
+        parser.add_argument('--sandbox_cache',
+                            help='Serve the first cell of a session from a cache of sandbox outputs, keyed by the '
+                                 'code and the input files, when the cell is side-effect free',
+                            action='store_true')
+        parser.add_argument('--sandbox_cache_path',
+                            help='Path of the sqlite file of the sandbox output cache',
+                            default=EXECUTION_CACHE_PATH,
+                            required=False, type=str)
+        parser.add_argument('--sandbox_cache_max_mb',
+                            help='Size of the sandbox output cache above which the least recently used outputs '
+                                 'are evicted',
+                            default=EXECUTION_CACHE_MAX_SIZE // (1024 * 1024),
+                            required=False, type=int)
+        parser.add_argument('--llm_max_connections',
+                            help='Size of the keep-alive connection pool shared by the LLM clients',
+                            default=100,
+                            required=False, type=int)
+        parser.add_argument('--llm_sdk_workers',
+                            help='Threads running the calls of the LLM SDKs without an async API, e.g. dashscope '
+                                 'and google-generativeai',
+                            default=32,
+                            required=False, type=int)
+        parser.add_argument('--llm_rpm',
+                            help='Requests per minute allowed to each LLM provider and model, unlimited by default',
+                            default=None,
+                            required=False, type=float)
+        parser.add_argument('--llm_tpm',
+                            help='Tokens per minute allowed to each LLM provider and model, unlimited by default',
+                            default=None,
+                            required=False, type=float)
+        parser.add_argument('--llm_max_concurrency',
+                            help='Upper bound of the concurrent calls to each LLM provider and model, the limit is '
+                                 'lowered while the provider throttles',
+                            default=64,
+                            required=False, type=int)
+        parser.add_argument('--llm_cache',
+                            help='LLM response cache mode: record stores every response, replay serves stored '
+                                 'responses and calls the LLM on a miss, replay_or_fail fails a question on a miss',
+                            default=CACHE_MODE_OFF, choices=CACHE_MODES,
+                            required=False, type=str)
+        parser.add_argument('--llm_cache_path',
+                            help='Path of the sqlite file of the LLM response cache',
+                            default=RESPONSE_CACHE_PATH,
+                            required=False, type=str)
+        parser.add_argument('--llm_cache_max_mb',
+                            help='Size of the LLM response cache above which the least recently used responses '
+                                 'are evicted',
+                            default=RESPONSE_CACHE_MAX_SIZE // (1024 * 1024),
+                            required=False, type=int)
+        parser.add_argument('--image_cache_mb',
+                            help='Size of the encoded input images kept in memory for all rounds and sessions',
+                            default=IMAGE_CACHE_MAX_SIZE // (1024 * 1024),
+                            required=False, type=int)
+        parser.add_argument('--image_cache_dir',
+                            help='Directory the encoded input images are persisted in, for other workers and '
+                                 'later runs, not persisted by default',
+                            default=None,
+                            required=False, type=str)
+        parser.add_argument('--write_batch_size',
+                            help='Number of answered questions written and fsync\'d to the output at once',
+                            default=16,
+                            required=False, type=int)
+        parser.add_argument('--flush_interval',
+                            help='Seconds after which a partial batch of answered questions is written anyway',
+                            default=5.0,
+                            required=False, type=float)
+        parser.add_argument('--shard',
+                            help='Only answer shard i of n of the benchmark rows, e.g. 0/4, and write to a part file '
+                                 'next to the output',
+                            default=None,
+                            required=False, type=str)
+        parser.add_argument('--workers',
+                            help='Spawn this many worker processes, one per shard, and merge their part files into '
+                                 'the output when they finish',
+                            default=1,
+                            required=False, type=int)
+        parser.add_argument('--merge',
+                            help='Only merge the existing shard part files into the output, then exit',
+                            action='store_true')
         args = parser.parse_args()
         return args
 
@@ -131,9 +245,136 @@ def extract_data_from_folder(folder_path):
     return extracted_data
 
 
+async def _answer_question(q, table_dir, img_dir, args):
+    input_text, file_names, img_names = (q['prompt'], q['attachments'], q['imgs'])
+    if isinstance(file_names, str):
+        file_names = eval(file_names)
+    if isinstance(img_names, str):
+        img_names = eval(img_names)
+
+    uploaded_files = [os.path.join(table_dir, file_name) for file_name in file_names]
+    uploaded_imgs = [os.path.join(img_dir, img_name) for img_name in img_names]
+
+    prompt = f"Question: {input_text}\n"
+
+    response = await predict(
+        prompt=prompt,
+        uploaded_files=uploaded_files,
+        uploaded_imgs=uploaded_imgs,
+        config_path=args.config_path,
+        open_path_img=args.open_path_img,
+        stage_mode=args.stage_mode,
+        budget=QuestionBudget(max_seconds=args.question_max_seconds, max_tokens=args.question_max_tokens,
+                              max_sandbox_seconds=args.question_max_sandbox_seconds,
+                              run_deadline=args.run_deadline),
+    )
+
+    q['response'] = response
+    print(f"response: {response}")
+    return q
+
+
+async def _question_worker(worker_id, question_queue, result_queue, table_dir, img_dir, args):
+    """
+    Pull benchmark rows from the question queue until it is drained, and hand every answered row to the writer.
+    A failed question is logged and left out of the output, so that a resumed run picks it up again, as are the
+    questions not started by the run deadline.
+    """
+    while True:
+        if args.run_deadline is not None and time.time() >= args.run_deadline:
+            if not question_queue.empty():
+                logger.warning(f"Worker {worker_id} reached the run deadline, {question_queue.qsize()} questions are "
+                               f"left for a resumed run")
+            return
+        try:
+            q = question_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+
+        try:
+            await result_queue.put(await _answer_question(q, table_dir, img_dir, args))
+        except Exception as e:
+            logger.error("Worker {} failed to answer question: {}. Error: {}".format(worker_id, q['prompt'], str(e)),
+                         exc_info=True)
+
+
+async def _result_writer(result_queue, result_writer, flush_interval):
+    """
+    Single consumer of answered rows, so that concurrent questions never interleave lines in the output file.
+    Rows are written in batches, and a partial batch is flushed once no row arrived for flush_interval seconds.
+    """
+    # The get is not cancelled on a flush timeout, as wait_for would, so a row it already took is never dropped
+    get_task = None
+    try:
+        while True:
+            if get_task is None:
+                get_task = asyncio.ensure_future(result_queue.get())
+            done, _ = await asyncio.wait({get_task}, timeout=flush_interval)
+            if not done:
+                result_writer.flush()
+                continue
+            q, get_task = get_task.result(), None
+            if q is None:
+                break
+            result_writer.write(q)
+    finally:
+        if get_task is not None:
+            get_task.cancel()
+        result_writer.flush()
+
+
+def _strip_script_arg(argv, name):
+    stripped = []
+    skip_next = False
+    for arg in argv:
+        if skip_next:
+            skip_next = False
+        elif arg == name:
+            skip_next = True
+        elif not arg.startswith(f"{name}="):
+            stripped.append(arg)
+    return stripped
+
+
+async def _launch_shard_workers(args):
+    """
+    Run every shard in its own process so that parsing, logging and kernel message handling are not bound to one
+    core, then merge the part files into the output.
+    """
+    argv = _strip_script_arg(sys.argv[1:], '--workers')
+    if args.run_deadline is not None:
+        # The shards share the deadline of the run, whenever they start
+        argv = _strip_script_arg(_strip_script_arg(argv, '--run_timeout'), '--run_deadline')
+        argv += ['--run_deadline', repr(args.run_deadline)]
+    processes = []
+    for shard_index in range(args.workers):
+        shard = f"{shard_index}/{args.workers}"
+        logger.info(f"Launch worker for shard {shard}")
+        processes.append(await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__),
+                                                              *argv, '--shard', shard))
+
+    return_codes = await asyncio.gather(*[process.wait() for process in processes])
+    for shard_index, return_code in enumerate(return_codes):
+        if return_code != 0:
+            logger.error(f"Worker for shard {shard_index}/{args.workers} exited with code {return_code}, "
+                         f"merge its partial results only")
+
+    merge_shard_outputs(args.output, [get_shard_output_path(args.output, shard_index, args.workers)
+                                      for shard_index in range(args.workers)])
+
+
 async def main():
 
     args = _get_script_params()
+    if args.run_deadline is None and args.run_timeout is not None:
+        args.run_deadline = time.time() + args.run_timeout
+
+    if args.merge:
+        merge_shard_outputs(args.output, find_shard_output_paths(args.output))
+        return
+    if args.workers > 1 and args.shard is None:
+        await _launch_shard_workers(args)
+        return
 
     root_directory = os.path.abspath(__file__)
     while 'infiagent' not in os.path.basename(root_directory).lower():
@@ -146,18 +387,22 @@ async def main():
     extracted_data = extracted_data.to_dict(orient="records")
     # random.shuffle(extracted_data)
 
-    prompt2ans = {}
-    if os.path.exists(args.output):
-        with open(args.output, "r") as fr:
-            for line in fr:
-                try:
-                    line = json.loads(line.strip())
-                    prompt2ans[line['prompt']] = line
-                except:
-                    continue
+    output_path = args.output
+    if args.shard is not None:
+        shard_index, shard_count = parse_shard(args.shard)
+        extracted_data = select_shard(extracted_data, shard_index, shard_count)
+        output_path = get_shard_output_path(args.output, shard_index, shard_count)
+
+    question_id_fn = partial(get_question_id, config_path=args.config_path)
+    result_writer = ResultWriter(output_path, question_id_fn=question_id_fn, batch_size=args.write_batch_size).open()
+    answered = result_writer.question_ids
+    if output_path != args.output:
+        # A shard also skips the questions already merged into the output by earlier runs
+        answered = answered | ResultWriter.load_question_ids(args.output, question_id_fn=question_id_fn)
 
     start_time = time.time()
 
+    question_queue = asyncio.Queue()
     for index, q in enumerate(extracted_data):
 
         # if "First, as shown in the picture, there is a number on each balloon." not in q['prompt'] and "What is the color of the geometric object which is shiny? Please generate" not in q['prompt'] and "How many people in the table were born in the same year" not in q['prompt'] and "Based on the pricing information provided in the CSV file" not in q['prompt']:
@@ -165,42 +410,54 @@ async def main():
         # if index == 6:
         #     break
 
-        input_text, file_names, img_names = (q['prompt'], q['attachments'], q['imgs'])
-        if isinstance(file_names, str):
-            file_names = eval(file_names)
-        if isinstance(img_names, str):
-            img_names = eval(img_names)
-        if input_text is None:
+        if q['prompt'] is None:
             continue
-        if input_text in prompt2ans:
+        q['qid'] = question_id_fn(q)
+        if q['qid'] in answered:
             continue
-
-        uploaded_files = []
-        for file_name in file_names:
-            uploaded_file = UploadedFile(os.path.join(table_dir, file_name))
-            uploaded_files.append(uploaded_file)
-
-        uploaded_imgs = []
-        for img_name in img_names:
-            uploaded_img = UploadedFile(os.path.join(img_dir, img_name))
-            uploaded_imgs.append(uploaded_img)
-
-        prompt = f"Question: {input_text}\n"
-
-        response = await predict(
-            prompt=prompt,
-            uploaded_files=uploaded_files,
-            uploaded_imgs=uploaded_imgs,
-            config_path=args.config_path,
-            open_path_img=args.open_path_img,
-        )
-
-        q['response'] = response
-        # results.append(q)
-        print(f"response: {response}")
-
-        with open(f"{args.output}", 'a') as outfile:
-            outfile.write(json.dumps(q)+'\n')
+        question_queue.put_nowait(q)
+
+    concurrency = max(1, min(args.concurrency, question_queue.qsize()))
+    logger.info(f"Answering {question_queue.qsize()} questions with concurrency {concurrency}")
+
+    configure_transport(max_connections=args.llm_max_connections, sdk_max_workers=args.llm_sdk_workers)
+    configure_rate_limits(requests_per_minute=args.llm_rpm, tokens_per_minute=args.llm_tpm,
+                          max_concurrency=args.llm_max_concurrency)
+    response_cache = configure_response_cache(mode=args.llm_cache, path=args.llm_cache_path,
+                                              max_size=args.llm_cache_max_mb * 1024 * 1024)
+    image_cache = configure_image_cache(max_size=args.image_cache_mb * 1024 * 1024, directory=args.image_cache_dir)
+    execution_cache = configure_execution_cache(enabled=args.sandbox_cache, path=args.sandbox_cache_path,
+                                                max_size=args.sandbox_cache_max_mb * 1024 * 1024)
+    # The question deadline of the sandboxes is the one of the question budget, see _answer_question
+    AsyncPythonSandBoxTool.configure_deadlines(step_timeout=args.step_timeout)
+    if args.kernel_pool_size > 0:
+        kernel_pool = AsyncPythonSandBoxTool.configure_kernel_pool(min_size=args.kernel_pool_size,
+                                                                   max_uses=args.kernel_max_uses)
+        await kernel_pool.warm_up()
+    else:
+        kernel_pool = AsyncPythonSandBoxTool.get_kernel_pool()
+
+    result_queue = asyncio.Queue()
+    writer = asyncio.create_task(_result_writer(result_queue, result_writer, args.flush_interval))
+    try:
+        await asyncio.gather(*[_question_worker(worker_id, question_queue, result_queue, table_dir, img_dir, args)
+                               for worker_id in range(concurrency)])
+    finally:
+        await result_queue.put(None)
+        await writer
+        result_writer.close()
+        await kernel_pool.close()
+        await close_transport()
+        shutdown_sdk_executor()
+        if response_cache is not None:
+            logger.info(f"LLM response cache {response_cache.mode}: {response_cache.hits} hits, "
+                        f"{response_cache.misses} misses")
+            configure_response_cache(mode=CACHE_MODE_OFF)
+        logger.info(f"Image payload cache: {image_cache.hits} hits, {image_cache.misses} misses")
+        if execution_cache is not None:
+            logger.info(f"Sandbox output cache: {execution_cache.hits} hits, {execution_cache.misses} misses, "
+                        f"{execution_cache.bypassed} first cells with side effects")
+            configure_execution_cache(enabled=False)
 
     # 在这里写下你需要进行计时的代码
 
@@ -210,5 +467,3 @@ async def main():
 
 if __name__ == '__main__':
     asyncio.run(main())
-
-
@@ -0,0 +1,280 @@
+"""
+Local OpenAI-compatible chat completions server, a stand-in for the LLM in offline load tests.
+
+The server answers every question with a ReAct trajectory: the recorded turns of the question when a trajectories
+file is given, otherwise the scripted turns. The turn to answer is the first one not yet in the prompt, so a
+conversation advances like with a real model and a run is reproducible. Latency, generation speed and injected
+errors are drawn from a random generator seeded per request, independently of the arrival order.
+
+Start it with e.g.
+    python activities/mock_llm_server.py --port 8000 --latency lognormal:0.5,0.3 --tokens_per_second 50 \
+        --throttle_rate 0.05
+and point the api_base of a VLlmOpenAIClient config at http://localhost:8000/v1. GET /stats reports the request
+counts and the peak concurrency seen by the server.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Rough characters per token of the usage counts
+CHARS_PER_TOKEN = 4
+# Tokens sent per chunk of a streamed completion
+STREAM_CHUNK_TOKENS = 4
+# Characters of a turn looked up in the prompt to find out whether the turn was already answered
+TURN_MATCH_LENGTH = 80
+
+DEFAULT_SCRIPT = [
+    "Let me look at the attached files first.\n"
+    "Action: python_code_sandbox\n"
+    "Action Input: ```python\n"
+    "import os\n"
+    "print(sorted(os.listdir('.'))[:10])\n"
+    "```\n",
+    " I now know the answer.\n"
+    "Final Answer: ```json[\"mock answer\"]```",
+]
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    Parse a latency distribution, in seconds, of the form fixed:s, uniform:low,high, normal:mean,std or
+    lognormal:median,sigma.
+    """
+    name, _, args = spec.partition(":")
+    values = [float(value) for value in args.split(",") if value]
+    if name == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if name == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if name == "normal" and len(values) == 2:
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if name == "lognormal" and len(values) == 2:
+        # Parameterised by the median, whose log is mu
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1]) if values[0] > 0 else 0.0
+    raise ValueError(f"Invalid latency distribution {spec}")
+
+
+class Trajectories:
+    """
+    The ReAct turns answered per question. Recorded trajectories are read from a JSONL file with one
+    {"question": ..., "turns": [...]} object per line, a question matches a prompt containing it.
+    """
+
+    def __init__(self, script: List[str], recorded: Optional[List[dict]] = None):
+        self.script = script
+        self.recorded = recorded or []
+
+    @classmethod
+    def load(cls, script_path: Optional[str] = None, trajectories_path: Optional[str] = None) -> "Trajectories":
+        script = DEFAULT_SCRIPT
+        if script_path:
+            with open(script_path, "r", encoding="utf-8") as fr:
+                script = json.load(fr)
+        recorded = []
+        if trajectories_path:
+            with open(trajectories_path, "r", encoding="utf-8") as fr:
+                recorded = [json.loads(line) for line in fr if line.strip()]
+        return cls(script=script, recorded=recorded)
+
+    def next_turn(self, prompt: str) -> str:
+        turns = self.script
+        for trajectory in self.recorded:
+            if trajectory["question"] in prompt:
+                turns = trajectory["turns"]
+                break
+        for turn in turns[:-1]:
+            if turn[:TURN_MATCH_LENGTH].strip() not in prompt:
+                return turn
+        return turns[-1]
+
+
+class MockServerStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.completed = 0
+        self.errors = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.started_at = time.time()
+
+    def to_dict(self) -> dict:
+        stats = dict(self.__dict__)
+        stats["uptime"] = time.time() - self.started_at
+        return stats
+
+
+def _prompt_text(messages: List[dict]) -> str:
+    texts = []
+    for message in messages:
+        content = message.get("content") or ""
+        if isinstance(content, list):
+            texts.extend(part.get("text", "") for part in content if isinstance(part, dict))
+        else:
+            texts.append(str(content))
+    return "\n".join(texts)
+
+
+def _apply_stop(content: str, stop) -> str:
+    for stop_sequence in [stop] if isinstance(stop, str) else stop or []:
+        index = content.find(stop_sequence)
+        if index >= 0:
+            content = content[:index]
+    return content
+
+
+def _count_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def create_app(trajectories: Trajectories, latency: Callable[[random.Random], float],
+               tokens_per_second: float = 0.0, error_rate: float = 0.0, throttle_rate: float = 0.0,
+               seed: int = 0) -> FastAPI:
+    """
+    Create the mock server app.
+
+    :param trajectories: The ReAct turns answered per question.
+    :param latency: Distribution of the delay before the first token, see parse_latency.
+    :param tokens_per_second: Generation speed after the first token, 0 sends the completion at once.
+    :param error_rate: Fraction of requests failed with a 500.
+    :param throttle_rate: Fraction of requests throttled with a 429.
+    :param seed: Seed of the per request random generators.
+    """
+    app = FastAPI()
+    stats = MockServerStats()
+    attempts: Dict[str, int] = {}
+    app.state.stats = stats
+
+    def _request_rng(prompt: str) -> random.Random:
+        # Seeded by the prompt and the attempt, so a retry of a failed request draws again
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        attempt = attempts.get(prompt_hash, 0)
+        attempts[prompt_hash] = attempt + 1
+        return random.Random(f"{seed}:{prompt_hash}:{attempt}")
+
+    async def _chat_completions(request: Request):
+        body = await request.json()
+        stats.requests += 1
+        stats.in_flight += 1
+        stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+        streaming = False
+        try:
+            prompt = _prompt_text(body.get("messages", []))
+            rng = _request_rng(prompt)
+            draw = rng.random()
+            if draw < throttle_rate:
+                stats.throttled += 1
+                return JSONResponse({"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                                    status_code=429, headers={"Retry-After": "1"})
+            if draw < throttle_rate + error_rate:
+                stats.errors += 1
+                return JSONResponse({"error": {"message": "Injected server error", "type": "server_error"}},
+                                    status_code=500)
+
+            content = _apply_stop(trajectories.next_turn(prompt), body.get("stop"))
+            prompt_tokens, completion_tokens = _count_tokens(prompt), _count_tokens(content)
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            first_token_delay = latency(rng)
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            model = body.get("model") or request.path_params.get("engine", "mock")
+
+            if body.get("stream"):
+                streaming = True
+                return StreamingResponse(_stream(completion_id, model, content, first_token_delay),
+                                         media_type="text/event-stream")
+
+            generation_time = completion_tokens / tokens_per_second if tokens_per_second > 0 else 0.0
+            await asyncio.sleep(first_token_delay + generation_time)
+            stats.completed += 1
+            return JSONResponse({
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+        finally:
+            if not streaming:
+                stats.in_flight -= 1
+
+    async def _stream(completion_id: str, model: str, content: str, first_token_delay: float):
+        try:
+            await asyncio.sleep(first_token_delay)
+            chunk_size = STREAM_CHUNK_TOKENS * CHARS_PER_TOKEN
+            deltas = [{"role": "assistant", "content": ""}] + \
+                     [{"content": content[i:i + chunk_size]} for i in range(0, len(content), chunk_size)]
+            for index, delta in enumerate(deltas):
+                if index > 1 and tokens_per_second > 0:
+                    await asyncio.sleep(STREAM_CHUNK_TOKENS / tokens_per_second)
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+            stats.completed += 1
+        finally:
+            stats.in_flight -= 1
+
+    # OpenAI style and Azure style paths, the Azure client puts the model into the path as the deployment
+    app.add_api_route("/v1/chat/completions", _chat_completions, methods=["POST"])
+    app.add_api_route("/openai/deployments/{engine}/chat/completions", _chat_completions, methods=["POST"])
+
+    @app.get("/v1/models")
+    async def _models():
+        return {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]}
+
+    @app.get("/stats")
+    async def _stats():
+        return stats.to_dict()
+
+    return app
+
+
+def _get_script_params():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock LLM server for offline load tests")
+    parser.add_argument('--host', help='Host to listen on', default='127.0.0.1', type=str)
+    parser.add_argument('--port', help='Port to listen on', default=8000, type=int)
+    parser.add_argument('--script',
+                        help='JSON list of the ReAct turns answered to every question without a recorded trajectory',
+                        default=None, type=str)
+    parser.add_argument('--trajectories',
+                        help='JSONL file of recorded trajectories, one {"question": ..., "turns": [...]} per line',
+                        default=None, type=str)
+    parser.add_argument('--latency',
+                        help='Delay before the first token: fixed:s, uniform:low,high, normal:mean,std or '
+                             'lognormal:median,sigma',
+                        default='fixed:0', type=str)
+    parser.add_argument('--tokens_per_second', help='Generation speed after the first token, 0 for no delay',
+                        default=0.0, type=float)
+    parser.add_argument('--error_rate', help='Fraction of requests failed with a 500', default=0.0, type=float)
+    parser.add_argument('--throttle_rate', help='Fraction of requests throttled with a 429', default=0.0,
+                        type=float)
+    parser.add_argument('--seed', help='Seed of the latency and error draws', default=0, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _get_script_params()
+    app = create_app(trajectories=Trajectories.load(args.script, args.trajectories),
+                     latency=parse_latency(args.latency),
+                     tokens_per_second=args.tokens_per_second,
+                     error_rate=args.error_rate,
+                     throttle_rate=args.throttle_rate,
+                     seed=args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
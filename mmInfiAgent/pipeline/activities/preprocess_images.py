@@ -0,0 +1,127 @@
+"""
+Precompute the provider payloads of the benchmark images.
+
+The images of the imgs column of the benchmark are resized, converted and encoded for each provider in a process
+pool, and written to the content-addressed store of the LLM image cache, together with their dimensions and
+estimated token costs. Runs of eval.py with --image_cache_dir pointing at the store then skip the encoding.
+
+    python activities/preprocess_images.py --providers claude,gemini --workers 8
+"""
+import argparse
+import ast
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List
+
+import pandas as pd
+
+from infiagent.utils import get_logger
+from infiagent.llm.image_cache import IMAGE_CACHE_DIR, IMAGE_INFO_KIND, ImagePayloadCache, read_image_info
+from infiagent.llm.client.claude_openai import encode_image as encode_claude_image
+from infiagent.llm.client.gemini_genai import encode_image as encode_gemini_image
+from infiagent.llm.client.openai_compatible import MAX_IMAGE_EDGE, encode_image_url
+
+logger = get_logger()
+
+# Payload kind and builder of each provider, the kinds the clients look up
+PROVIDER_PAYLOADS: Dict[str, tuple] = {
+    "claude": ("claude", encode_claude_image),
+    "gemini": ("gemini", encode_gemini_image),
+    # OpenAI-compatible clients with image_transport base64 and the default image_max_edge
+    "openai": (f"data_url_{MAX_IMAGE_EDGE}", encode_image_url),
+}
+
+
+def _get_script_params():
+    root_directory = os.path.abspath(__file__)
+    while 'infiagent' not in os.path.basename(root_directory).lower():
+        root_directory = os.path.dirname(root_directory)
+
+    parser = argparse.ArgumentParser(description="Precompute the provider payloads of the benchmark images")
+    parser.add_argument('--data_path',
+                        help='Benchmark csv, its imgs column lists the images of each question',
+                        default=os.path.join(os.path.dirname(root_directory), "data/benchmark.csv"),
+                        required=False, type=str)
+    parser.add_argument('--img_dir',
+                        help='Directory of the benchmark images',
+                        default=os.path.join(os.path.dirname(root_directory), "data/000-imgs"),
+                        required=False, type=str)
+    parser.add_argument('--store_dir',
+                        help='Directory of the image cache the payloads are written to',
+                        default=IMAGE_CACHE_DIR,
+                        required=False, type=str)
+    parser.add_argument('--providers',
+                        help=f'Comma separated providers to precompute, of {", ".join(PROVIDER_PAYLOADS)}',
+                        default=",".join(PROVIDER_PAYLOADS),
+                        required=False, type=str)
+    parser.add_argument('--workers',
+                        help='Processes encoding images',
+                        default=os.cpu_count() or 1,
+                        required=False, type=int)
+    return parser.parse_args()
+
+
+def list_benchmark_images(data_path: str) -> List[str]:
+    """
+    List the image names of the imgs column of the benchmark, each once.
+    """
+    image_names = {}
+    for img_names in pd.read_csv(data_path)["imgs"].dropna():
+        if isinstance(img_names, str):
+            img_names = ast.literal_eval(img_names)
+        for img_name in img_names:
+            image_names[img_name] = None
+    return list(image_names)
+
+
+def preprocess_image(image_path: str, store_dir: str, providers: List[str]) -> dict:
+    """
+    Write the payloads and the info of an image to the store, run in the worker processes.
+    """
+    # Payloads only go to disk, the worker keeps none in memory
+    cache = ImagePayloadCache(max_size=0, directory=store_dir)
+    builders: List[tuple] = [(IMAGE_INFO_KIND, read_image_info)] + [PROVIDER_PAYLOADS[p] for p in providers]
+    info = None
+    for kind, build in builders:
+        payload = cache.get_or_build(image_path, kind, build)
+        if kind == IMAGE_INFO_KIND:
+            info = payload
+    return {"built": cache.misses, **info}
+
+
+def main():
+    args = _get_script_params()
+    providers = [provider.strip() for provider in args.providers.split(",") if provider.strip()]
+    unknown = [provider for provider in providers if provider not in PROVIDER_PAYLOADS]
+    if unknown:
+        raise ValueError(f"Unknown providers {unknown}, expect some of {list(PROVIDER_PAYLOADS)}")
+
+    image_names = list_benchmark_images(args.data_path)
+    logger.info(f"Preprocessing {len(image_names)} images for {providers} with {args.workers} workers")
+    start_time = time.time()
+    built, failed, total_tokens = 0, [], {}
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {executor.submit(preprocess_image, os.path.join(args.img_dir, image_name), args.store_dir,
+                                   providers): image_name
+                   for image_name in image_names}
+        for future in as_completed(futures):
+            try:
+                info = future.result()
+            except Exception as e:
+                logger.error(f"Failed to preprocess image {futures[future]}: {e}")
+                failed.append(futures[future])
+                continue
+            built += info["built"]
+            for provider, tokens in info["tokens"].items():
+                total_tokens[provider] = total_tokens.get(provider, 0) + tokens
+
+    logger.info(f"Preprocessed {len(image_names) - len(failed)} images into {args.store_dir} in "
+                f"{time.time() - start_time:.1f}s, {built} payloads built, the others were already stored. "
+                f"Estimated image tokens per provider: {total_tokens}")
+    if failed:
+        logger.warning(f"{len(failed)} images failed: {failed}")
+
+
+if __name__ == '__main__':
+    main()
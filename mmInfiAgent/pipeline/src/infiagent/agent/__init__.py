@@ -1,2 +1,3 @@
 from .base_agent import BaseAgent
+from .agent_factory import AgentFactory, AgentPrototype
 from .react import AsyncReactAgent
@@ -0,0 +1,144 @@
+import asyncio
+import os
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Tuple
+
+from .base_agent import BaseAgent, LLM_CONF_OVERRIDE_KEY
+from ..llm.base_llm import BaseLLM
+from ..tools import BaseTool
+from ..utils import Config, get_logger
+
+logger = get_logger()
+
+DEFAULT_MAX_POOL_SIZE = 64
+
+
+@dataclass
+class AgentPrototype:
+    """
+    Everything needed to build an agent that does not change between sessions: the loaded config, the LLM client
+    shared by all agents of the config, and one prototype per plugin.
+    """
+    config_data: Dict[str, Any]
+    llm: BaseLLM
+    tools: List[Tuple[str, BaseTool]] = field(default_factory=list)
+    agent_plugins: List[Tuple[str, str]] = field(default_factory=list)
+
+
+class AgentFactory:
+    """
+    Process-level factory of agents.
+
+    The config of an agent is loaded and its LLM client and tools are created once per config path and LLM
+    overrides. An agent then only gets its own copy of the tools, and agents released after a session are cleared
+    and handed out again, so that creating a session does not re-parse the config or re-create the LLM client.
+    """
+    _instance = None
+
+    def __init__(self, max_pool_size: int = DEFAULT_MAX_POOL_SIZE):
+        self._max_pool_size = max_pool_size
+        self._prototypes: Dict[Tuple, AgentPrototype] = {}
+        self._building: Dict[Tuple, asyncio.Task] = {}
+        self._pool: Dict[Tuple, Deque[BaseAgent]] = defaultdict(deque)
+
+    @classmethod
+    def get_instance(cls) -> "AgentFactory":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def _get_key(config_path: str, **kwargs) -> Tuple:
+        overrides = tuple((param, repr(kwargs[param])) for param in LLM_CONF_OVERRIDE_KEY if kwargs.get(param))
+        return os.path.abspath(config_path), overrides
+
+    async def acquire(self, config_path: str, **kwargs) -> BaseAgent:
+        """
+        Get a cleared agent for the config, either from the pool or built from the config prototype.
+
+        :param config_path: The agent config path.
+        :type config_path: str
+        :param kwargs: LLM param overrides, see LLM_CONF_OVERRIDE_KEY.
+        :return: An agent ready for a new session.
+        :rtype: BaseAgent
+        """
+        key = self._get_key(config_path, **kwargs)
+        pool = self._pool.get(key)
+        if pool:
+            return pool.popleft()
+
+        prototype = await self._get_prototype(key, config_path, **kwargs)
+        agent = await self._build_agent(prototype)
+        agent._factory_key = key
+        return agent
+
+    def release(self, agent: BaseAgent):
+        """
+        Clear an agent after its session and keep it for the next session of the same config.
+        """
+        key = getattr(agent, '_factory_key', None)
+        if key is None:
+            return
+        agent.clear()
+        pool = self._pool[key]
+        if len(pool) < self._max_pool_size:
+            pool.append(agent)
+
+    def clear(self):
+        """
+        Drop all prototypes and pooled agents, e.g. after a config file changed.
+        """
+        self._prototypes.clear()
+        self._building.clear()
+        self._pool.clear()
+
+    async def _get_prototype(self, key: Tuple, config_path: str, **kwargs) -> AgentPrototype:
+        if key in self._prototypes:
+            return self._prototypes[key]
+
+        # Concurrent sessions of a new config wait for the same build instead of each loading the config
+        task = self._building.get(key)
+        if task is None:
+            task = asyncio.create_task(self._build_prototype(config_path, **kwargs))
+            self._building[key] = task
+        try:
+            prototype = await task
+        finally:
+            if self._building.get(key) is task and task.done():
+                del self._building[key]
+        self._prototypes[key] = prototype
+        return prototype
+
+    @staticmethod
+    async def _build_prototype(config_path: str, **kwargs) -> AgentPrototype:
+        config_data = Config.load(config_path)
+        logger.info(f"Build agent prototype from config path {config_path} : {config_data}")
+
+        if 'llm' in config_data and 'params' in config_data['llm']:
+            for param in LLM_CONF_OVERRIDE_KEY:
+                if param in kwargs and kwargs[param]:
+                    logger.info(f"Overwrite with new {param} {kwargs[param]}")
+                    config_data['llm']['params'][param] = kwargs[param]
+
+        tool_configs = []
+        agent_plugins = []
+        for plugin_config in config_data.get('plugins', []):
+            if plugin_config.get('type', "") == 'agent':
+                agent_plugins.append((plugin_config['name'], plugin_config['config']))
+            else:
+                tool_configs.append(plugin_config)
+
+        llm, *tools = await asyncio.gather(BaseAgent._async_init_llm(config_data.get("llm", {})),
+                                           *[BaseAgent._async_init_plugin(tool_config)
+                                             for tool_config in tool_configs])
+        return AgentPrototype(config_data=config_data, llm=llm, tools=list(tools), agent_plugins=agent_plugins)
+
+    async def _build_agent(self, prototype: AgentPrototype) -> BaseAgent:
+        agent = BaseAgent._get_basic_instance_from_config(prototype.config_data)
+        agent.llm = prototype.llm
+        for name, tool in prototype.tools:
+            agent.add_plugin(name, tool.clone())
+        for name, config_path in prototype.agent_plugins:
+            agent.add_plugin(name, await self.acquire(config_path))
+        return agent
@@ -332,6 +332,9 @@ class BaseAgent(ABC):
 
     def clear(self):
         """
-        Clear and reset the agent.
+        Clear and reset the agent, so that the same instance can be reused for a new session. The LLM client and the
+        plugins are kept, plugins are cleared as well.
         """
-        pass
+        for plugin in self.__plugins_map.values():
+            if isinstance(plugin, (BaseTool, BaseAgent)):
+                plugin.clear()
@@ -1,43 +1,102 @@
+import asyncio
 import re
-import time
 from typing import Union, List, Dict, Optional
-import asyncio
 from werkzeug.datastructures import FileStorage
 
 from .. import BaseAgent
-from ...exceptions.exceptions import InternalErrorException, LLMException, SandboxException
+from ...exceptions.exceptions import InternalErrorException, LLMException, SandboxException, \
+    BudgetExhaustedException
+from ...llm.transport import request_deadline
+from ...prompt import PromptBuilder
 from ...schemas import (
     AgentType, AgentRequest, AgentFinish, AgentAction, AgentResponse,
-    BaseAgentResponse, AgentObservation, RunCodeOutput, MediaFile
+    BaseAgentResponse, AgentObservation, RunCodeOutput, MediaFile, QuestionBudget
 )
 from ...tools import PythonSandBoxToolResponse, AsyncPythonSandBoxTool
+from .output_parser import FINAL_ANSWER_INDICATORS, parse_react_output
 from ...utils import get_logger, replace_latex_format, extract_and_replace_url, \
     OBSERVATION_PREFIX_CN, OBSERVATION_PREFIX_EN, AGENT_FAILED_CN, AGENT_FAILED_EN, \
-    TOOL_INPUT_PREFIX_CN, TOOL_INPUT_PREFIX_EN, AGENT_EXCEED_MAX_RETRY_CN, AGENT_EXCEED_MAX_RETRY_EN
+    TOOL_INPUT_PREFIX_CN, TOOL_INPUT_PREFIX_EN, AGENT_EXCEED_MAX_RETRY_CN, AGENT_EXCEED_MAX_RETRY_EN, \
+    AGENT_BUDGET_EXHAUSTED_CN, AGENT_BUDGET_EXHAUSTED_EN
 
 SAND_BOX_PLUGIN_NAME = 'python_code_sandbox'
-FINAL_ANSWER_INDICATORS = ["Final Answer:", "[END]", "The final Answer", "final answer"]
 CODE_BLOCK_START_TAG = '```python'
 CODE_BLOCK_TAG = '```'
 STOP_WORD = ['Observation:']
+# Fenced code blocks with their language, the first python block is the input of an action
+_CODE_BLOCK_REGEX = re.compile(r"```(\w*)\n?.*?```", re.DOTALL)
+_ACTION_BLOCK_LANGUAGES = ("python", "py")
 
 logger = get_logger()
 
 
+def find_step_end(llm_output: str) -> Optional[int]:
+    """
+    Find the end of the first complete step of a completion streamed so far, where the generation can be cancelled:
+    the first code block after a final answer indicator, e.g. 'Final Answer: ```json[...]```', or else the first
+    python code block of an action. A final answer written after an action, without its observation, is cut off, so
+    the action is run rather than answered from output the model made up. The end only depends on the text before
+    it, so cutting a whole completion gives the same step as cancelling its stream.
+
+    :param llm_output: The completion streamed so far.
+    :type llm_output: str
+    :return: The index after the step, None while the step is incomplete.
+    :rtype: Optional[int]
+    """
+    # Cheap check first, it runs on every delta of the stream
+    if llm_output.count(CODE_BLOCK_TAG) < 2:
+        return None
+    indicator_index = min((llm_output.find(indicator) for indicator in FINAL_ANSWER_INDICATORS
+                           if indicator in llm_output), default=len(llm_output))
+    for match in _CODE_BLOCK_REGEX.finditer(llm_output):
+        if indicator_index < match.start() or match.group(1) in _ACTION_BLOCK_LANGUAGES:
+            return match.end()
+    return None
+
+
 class AsyncReactAgent(BaseAgent):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._name = self._name or "AsyncReactAgent"
         self._type = AgentType.react
         self.__intermediate_steps: List[BaseAgentResponse] = []
+        self.__prompt_builder: Optional[PromptBuilder] = None
+        self.__budget: Optional[QuestionBudget] = None
 
     @property
     def intermediate_steps(self):
         return self.__intermediate_steps
 
+    @property
+    def prompt_prefix(self) -> Optional[str]:
+        """
+        The part of the current prompt that stays the same in every round, for LLM backends caching prefixes.
+        """
+        return self.__prompt_builder.prefix if self.__prompt_builder is not None else None
+
+    @property
+    def budget(self) -> Optional[QuestionBudget]:
+        """
+        The budget of the question being answered, None for no limit.
+        """
+        return self.__budget
+
+    @property
+    def prompt_token_count(self) -> Optional[int]:
+        """
+        The token count of the last prompt, counted with the tokenizer of the LLM.
+        """
+        return self.__prompt_builder.token_count if self.__prompt_builder is not None else None
+
     def run(self, *args, **kwargs):
         pass
 
+    def clear(self):
+        super().clear()
+        self.__intermediate_steps = []
+        self.__prompt_builder = None
+        self.__budget = None
+
     async def sync_to_sandbox(self, file: Union[str, Dict, FileStorage]):
         sandbox_plugin = self.plugins_map.get(SAND_BOX_PLUGIN_NAME)
         if not isinstance(sandbox_plugin, (AsyncPythonSandBoxTool, AsyncPythonSandBoxTool)):
@@ -45,6 +104,10 @@ class AsyncReactAgent(BaseAgent):
         return await sandbox_plugin.sync_to_sandbox(file)
 
     async def async_run(self, agent_req: AgentRequest):
+        self.__budget = agent_req.budget
+        sandbox_plugin = self.plugins_map.get(SAND_BOX_PLUGIN_NAME)
+        if isinstance(sandbox_plugin, AsyncPythonSandBoxTool):
+            sandbox_plugin.set_budget(agent_req.budget)
 
         file_names, file2info = [],{}
         question = ''
@@ -86,6 +149,13 @@ class AsyncReactAgent(BaseAgent):
         current_iteration = 0
 
         for _ in range(max_iterations):
+            exhausted = self.__budget.exhausted if self.__budget is not None else None
+            if exhausted is not None:
+                llm_response = self._budget_finish(exhausted, is_cn)
+                logger.info(f"Question budget exhausted: {exhausted}, stop iteration.")
+                yield self.create_agent_response(llm_response.formatted_output, [], llm_response.raw_output)
+                break
+
             current_iteration += 1
             llm_response = await self._single_round_thought(instruction, input_imgs, input_files,
                                                             max_llm_iteration=max_single_step_iterations,
@@ -115,29 +185,11 @@ class AsyncReactAgent(BaseAgent):
 
     # TODO update logic to not be sandbox specific, sandbox related logic should be handled in sandbox client
 
-    async def monitor_execution(self, timeout, response):
-
-        f = self.get_plugin_tool_async_function()[response.tool]
-        p = f(response.tool_input)
-        start_time = time.time()
-        try:
-            response = await asyncio.wait_for(p.wait(), timeout=timeout)
-            execution_time = time.time() - start_time
-            return response
-        except asyncio.TimeoutError:
-            raise RuntimeError(f"Execution Timeout of {execution_time}")
-
     async def _process_agent_action(self, response, current_iteration, max_iterations, is_cn: bool = False):
         try:
             response.tool = 'python_code_sandbox'
-            # old version start
+            # The sandbox interrupts code running past its step or question deadline, see AsyncPythonSandBoxTool
             action_response = await self.get_plugin_tool_async_function()[response.tool](response.tool_input)
-            # old version end
-
-            # # new version start
-            # timeout_duration = 5  # 单位：秒
-            # action_response = await self.monitor_execution(timeout_duration,response)
-            # # new version end
 
             logger.info(
                 f"Step {current_iteration} of {max_iterations}. Got agent observation raw output:\n"
@@ -167,19 +219,26 @@ class AsyncReactAgent(BaseAgent):
     def _compose_prompt(self, instruction) -> str:
         """
         Compose the prompt from template, worker description, examples and instruction.
+        The prompt is built incrementally, only the steps added since the last round are rendered.
         """
-        agent_scratchpad = self.prompt_template.construct_scratchpad(self.__intermediate_steps)
-        tool_description = self._get_plugin_description()
-        tool_names = ", ".join(list(self.plugins_map.keys()))
         if self.prompt_template is None:
             raise InternalErrorException("Agent prompt is none, please check init process")
 
-        return self.prompt_template.format(
-            instruction=instruction,
-            agent_scratchpad=agent_scratchpad,
-            tool_description=tool_description,
-            tool_names=tool_names
-        )
+        builder = self.__prompt_builder
+        if builder is None or builder.variables['instruction'] != instruction \
+                or builder.step_count > len(self.__intermediate_steps):
+            builder = PromptBuilder(
+                self.prompt_template,
+                instruction=instruction,
+                tool_description=self._get_plugin_description(),
+                tool_names=", ".join(list(self.plugins_map.keys()))
+            )
+            self.__prompt_builder = builder
+
+        for agent_response in self.__intermediate_steps[builder.step_count:]:
+            builder.append(agent_response)
+        # Prompts over the token budget of the LLM keep the template and the latest steps
+        return builder.build(getattr(self.llm, "token_budget", None))
 
     async def _single_round_thought(self, instruction: str, input_imgs: List, input_files: List, max_llm_iteration=3, is_cn: bool = False) -> \
             Union[AgentAction, AgentFinish]:
@@ -194,6 +253,9 @@ class AsyncReactAgent(BaseAgent):
                 action_response = self._parse_output(llm_response.content, input_files, is_cn)
 
                 return action_response
+            except BudgetExhaustedException as e:
+                logger.info(f"{e}, stop the LLM iterations")
+                return self._budget_finish(e.reason, is_cn)
             except Exception as e:
                 logger.error("LLM iteration {} out of {} failed. Error: {}".
                              format(llm_iteration_count, max_llm_iteration, str(e)), exc_info=True)
@@ -206,84 +268,61 @@ class AsyncReactAgent(BaseAgent):
 
     async def _get_llm_response(self, instruction: str, input_imgs: List):
         prompt = self._compose_prompt(instruction)
-        logger.info("Send prompt to LLM:\n{}\n[Prompt End]".format(prompt))
-        # await asyncio.sleep(60)
-        response = await self.llm.async_completion(prompt, input_imgs)
+        budget = self.__budget
+        if budget is not None:
+            if budget.exhausted is not None:
+                raise BudgetExhaustedException(budget.exhausted)
+            remaining_tokens = budget.remaining_tokens()
+            if remaining_tokens is not None and (self.prompt_token_count or 0) >= remaining_tokens:
+                raise BudgetExhaustedException("token")
+        logger.info("Send prompt of {} tokens to LLM:\n{}\n[Prompt End]".format(self.prompt_token_count, prompt))
+        # Generation stops once the first action or the final answer is complete, hallucinated observations and
+        # further steps after it are never generated. The request is cancelled when the question runs out of time,
+        # and the clients lower their request timeouts to the time left.
+        deadline = budget.deadline if budget is not None else None
+        with request_deadline(deadline):
+            try:
+                response = await asyncio.wait_for(
+                    self.llm.async_completion_until(prompt, input_imgs, until=find_step_end, stop=STOP_WORD),
+                    timeout=budget.remaining_seconds() if budget is not None else None)
+            except asyncio.TimeoutError:
+                # A timeout of the client itself is retried like any other LLM error
+                if budget is not None and budget.exhausted is not None:
+                    raise BudgetExhaustedException(budget.exhausted)
+                raise
+        if budget is not None:
+            budget.add_tokens((response.prompt_token or self.prompt_token_count or 0)
+                              + (response.completion_token or self.llm.token_budget.count(response.content or "")))
         if response.state == "error":
             raise LLMException("Failed to retrieve response from LLM, error: {}".format(str(response.content)))
 
         logger.info("Got response from llm, raw response content: \n{}\n[raw response end]".format(response.content))
         return response
 
-    def _parse_output(self, llm_output: str, input_files: List, is_cn: bool = False) -> Union[AgentAction, AgentFinish]:
-
-        raw_llm_output = llm_output
-
-        # for stop_word in STOP_WORD:
-        #     if stop_word in llm_output:
-        #         llm_output = llm_output.split(stop_word)[0].rstrip()
-        #         break
-
-        # Check for Final Answer, if it is final, then just return
-        for indicator in FINAL_ANSWER_INDICATORS:
-            if indicator in llm_output:
-                # got final answer and remove the indicator
-                parts = llm_output.split(indicator)
-                # formatted_output = ''.join(parts[:-1]).strip()
-                formatted_output = ''.join(parts).strip()
-                formatted_output = replace_latex_format(formatted_output)
-                return AgentFinish(raw_output=llm_output, formatted_output=formatted_output)
-
-        # Updated regex pattern for capturing the expected input format
-        ACTION_REGEX_1 = r"(.*?)\n?Action:\s*(.*?)\n?Action\s*Input:\s*```python\n(.*?)```(.*?)$|(.*?)\n?'''(\w+)\n?(.*?)\n?'''(.*?)$"
-        ACTION_REGEX_2 = r"(.*?)\n?Action:\s*(.*?)\n?Action\s*Input:\s*```py\n(.*?)```(.*?)$|(.*?)\n?'''(\w+)\n?(.*?)\n?'''(.*?)$"
-        ACTION_REGEX_3 = r"(.*?)\n?Action:\s*(.*?)\n?\s*```python\n(.*?)```(.*?)$|(.*?)\n?'''(\w+)\n?(.*?)\n?'''(.*?)$"
-        ACTION_REGEX_4 = r"(.*?)\n?```python\n(.*?)```(.*?)$|(.*?)\n?'''(\w+)\n?(.*?)\n?'''(.*?)$"
-
-        action_match = (re.search(ACTION_REGEX_1, llm_output, re.DOTALL) or re.search(ACTION_REGEX_2, llm_output, re.DOTALL)
-                        or re.search(ACTION_REGEX_3, llm_output, re.DOTALL))
-
-        action_match_others = re.search(ACTION_REGEX_4, llm_output, re.DOTALL)
-
-        # Find action, context, and action input, build action response
-        if action_match or action_match_others:
-            if action_match:
-                context = action_match.group(1).strip()
-                action_tool_description = action_match.group(2).strip()
-                action_input = action_match.group(3).strip()
-            else:
-                context = ""
-                action_tool_description = 'python_code_sandbox'
-                action_input = action_match_others.group(2).strip()
-            # Format code
-            # TODO: currently we only have one plugin which is sandbox, update to support multiple tools
-            format_code_block = self._format_code_block(action_input, input_files)
-
-            prefix = TOOL_INPUT_PREFIX_CN if is_cn else TOOL_INPUT_PREFIX_EN
-            formatted_output = "{}\n{}\n{}\n".format(context, prefix, format_code_block)
-            formatted_output = replace_latex_format(formatted_output)
+    @staticmethod
+    def _budget_finish(reason: str, is_cn: bool = False) -> AgentFinish:
+        message = AGENT_BUDGET_EXHAUSTED_CN if is_cn else AGENT_BUDGET_EXHAUSTED_EN
+        return AgentFinish(formatted_output=message.format(reason), raw_output="")
 
-            return AgentAction(tool=action_tool_description,
-                               tool_input=format_code_block,
-                               formatted_output=formatted_output,
-                               raw_output=llm_output)
-        else:
-            for indicator in FINAL_ANSWER_INDICATORS:
-                if indicator in raw_llm_output:
-                    # got final answer and remove the indicator
-                    parts = llm_output.split(indicator)
-                    # formatted_output = ''.join(parts[:-1]).strip()
-                    formatted_output = ''.join(parts).strip()
-                    formatted_output = replace_latex_format(formatted_output)
-                    return AgentFinish(raw_output=llm_output, formatted_output=formatted_output)
-
-            # Not final answer and not action, raise exception
-            if not re.search(r"Action\s*:", llm_output, re.DOTALL):
-                raise LLMException(f"Missing 'Action' in LLM output: `{llm_output}`")
-            elif not re.search(r"Action\s*Input\s*:", llm_output, re.DOTALL):
-                raise LLMException(f"Missing 'Action Input' in LLM output: `{llm_output}`")
-            else:
-                raise LLMException(f"Unrecognized LLM output format: `{llm_output}`")
+    def _parse_output(self, llm_output: str, input_files: List, is_cn: bool = False) -> Union[AgentAction, AgentFinish]:
+        # One linear scan over the output, see parse_react_output for the accepted formats
+        parsed_output = parse_react_output(llm_output)
+        if parsed_output.is_final:
+            formatted_output = replace_latex_format(parsed_output.final_answer)
+            return AgentFinish(raw_output=llm_output, formatted_output=formatted_output)
+
+        # Format code
+        # TODO: currently we only have one plugin which is sandbox, update to support multiple tools
+        format_code_block = self._format_code_block(parsed_output.tool_input, input_files)
+
+        prefix = TOOL_INPUT_PREFIX_CN if is_cn else TOOL_INPUT_PREFIX_EN
+        formatted_output = "{}\n{}\n{}\n".format(parsed_output.context, prefix, format_code_block)
+        formatted_output = replace_latex_format(formatted_output)
+
+        return AgentAction(tool=parsed_output.tool,
+                           tool_input=format_code_block,
+                           formatted_output=formatted_output,
+                           raw_output=llm_output)
 
     def _format_code_block(self, tool_input, input_files):
         stripped_tool_input = tool_input.strip()
@@ -0,0 +1,186 @@
+import bisect
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+from ...exceptions.exceptions import LLMException
+
+FINAL_ANSWER_INDICATORS = ["Final Answer:", "[END]", "The final Answer", "final answer"]
+
+# Every position a token of the ReAct format starts at, overlapping ones included, e.g. both fences of '````'
+_TOKEN_REGEX = re.compile(r"(?=(Action|```|'''))")
+_FINAL_ANSWER_REGEX = re.compile("|".join(re.escape(indicator) for indicator in FINAL_ANSWER_INDICATORS))
+_WHITESPACE_REGEX = re.compile(r"\s*")
+_WORD_REGEX = re.compile(r"\w")
+
+_ACTION = "Action:"
+_INPUT = "Input"
+_PYTHON_BLOCK = "```python\n"
+_PY_BLOCK = "```py\n"
+_FENCE = "```"
+_QUOTE = "'''"
+
+
+@dataclass(frozen=True)
+class ParsedOutput:
+    """
+    A ReAct step parsed from an LLM output, either a final answer or an action.
+
+    :param final_answer: The output without the final answer indicator, None for an action.
+    :param context: The thought before the action.
+    :param tool: The tool of the action.
+    :param tool_input: The code of the action, without its fences.
+    """
+    final_answer: Optional[str] = None
+    context: str = ""
+    tool: Optional[str] = None
+    tool_input: Optional[str] = None
+
+    @property
+    def is_final(self) -> bool:
+        return self.final_answer is not None
+
+
+def parse_react_output(llm_output: str) -> ParsedOutput:
+    """
+    Parse an LLM output of the ReAct format in linear time. The tokens of the format are found in one scan, and the
+    step is then put together from their positions, with the same result as parse_react_output_regex.
+
+    An output with a final answer indicator is a final answer. Otherwise the first of these is the action, the
+    first 'Action:' and the first 'Action Input: ```python' block after it, the same with a ```py block, the first
+    'Action:' and the first ```python block after it, and the first ```python block without a tool, which then is
+    python_code_sandbox.
+
+    :param llm_output: The LLM output.
+    :type llm_output: str
+    :return: The parsed step.
+    :rtype: ParsedOutput
+    :raises LLMException: The output is neither a final answer nor an action.
+    """
+    indicators = set(_FINAL_ANSWER_REGEX.findall(llm_output))
+    for indicator in FINAL_ANSWER_INDICATORS:
+        if indicator in indicators:
+            return ParsedOutput(final_answer=llm_output.replace(indicator, "").strip())
+
+    fences = []
+    first_python_block = None
+    first_word_quote = None
+    has_closing_quote = False
+    action = None
+    action_input = {_PYTHON_BLOCK: None, _PY_BLOCK: None}
+    action_python_block = None
+    has_action_colon = False
+    has_action_input_colon = False
+    for match in _TOKEN_REGEX.finditer(llm_output):
+        position = match.start()
+        token = match.group(1)
+        if token == _FENCE:
+            fences.append(position)
+            if llm_output.startswith(_PYTHON_BLOCK, position):
+                if first_python_block is None:
+                    first_python_block = position
+                if action is not None and action_python_block is None and position >= action + len(_ACTION):
+                    action_python_block = position
+        elif token == _QUOTE:
+            if first_word_quote is None:
+                if _WORD_REGEX.match(llm_output, position + len(_QUOTE)):
+                    first_word_quote = position
+            elif position >= first_word_quote + len(_QUOTE) + 1:
+                has_closing_quote = True
+        else:
+            keyword_end = position + len("Action")
+            after_action = _skip_whitespace(llm_output, keyword_end)
+            if llm_output.startswith(":", after_action):
+                has_action_colon = True
+                if action is None and after_action == keyword_end:
+                    action = position
+            elif llm_output.startswith(_INPUT, after_action):
+                input_end = after_action + len(_INPUT)
+                after_input = _skip_whitespace(llm_output, input_end)
+                if llm_output.startswith(":", after_input):
+                    has_action_input_colon = True
+                    # The input of an action follows an 'Action:', with the colon right after 'Input'
+                    if action is not None and after_input == input_end:
+                        block = _skip_whitespace(llm_output, after_input + 1)
+                        for block_tag in action_input:
+                            if action_input[block_tag] is None and llm_output.startswith(block_tag, block):
+                                action_input[block_tag] = (position, block + len(block_tag))
+
+    # The alternatives are tried in the order of the former regexes. Each of them also matched a pair of quote
+    # fences, e.g. '''python ... ''', but took no step from it.
+    has_quote_block = first_word_quote is not None and has_closing_quote
+    for block_tag in (_PYTHON_BLOCK, _PY_BLOCK):
+        if action_input[block_tag] is not None:
+            input_start, code_start = action_input[block_tag]
+            code = _code_block(llm_output, fences, code_start)
+            if code is not None:
+                return ParsedOutput(context=llm_output[:action].strip(),
+                                    tool=llm_output[action + len(_ACTION):input_start].strip(),
+                                    tool_input=code)
+        if has_quote_block:
+            raise LLMException(f"Unrecognized LLM output format: `{llm_output}`")
+    if action_python_block is not None:
+        code = _code_block(llm_output, fences, action_python_block + len(_PYTHON_BLOCK))
+        if code is not None:
+            return ParsedOutput(context=llm_output[:action].strip(),
+                                tool=llm_output[action + len(_ACTION):action_python_block].strip(),
+                                tool_input=code)
+    if first_python_block is not None:
+        code = _code_block(llm_output, fences, first_python_block + len(_PYTHON_BLOCK))
+        if code is not None:
+            return ParsedOutput(tool="python_code_sandbox", tool_input=code)
+
+    if not has_action_colon:
+        raise LLMException(f"Missing 'Action' in LLM output: `{llm_output}`")
+    elif not has_action_input_colon:
+        raise LLMException(f"Missing 'Action Input' in LLM output: `{llm_output}`")
+    else:
+        raise LLMException(f"Unrecognized LLM output format: `{llm_output}`")
+
+
+def _skip_whitespace(text: str, position: int) -> int:
+    return _WHITESPACE_REGEX.match(text, position).end()
+
+
+def _code_block(text: str, fences: list, code_start: int) -> Optional[str]:
+    # The code runs to the first fence after its start, fences holds the positions of all of them in order
+    index = bisect.bisect_left(fences, code_start)
+    if index == len(fences):
+        return None
+    return text[code_start:fences[index]].strip()
+
+
+def parse_react_output_regex(llm_output: str) -> ParsedOutput:
+    """
+    The former regex parser of AsyncReactAgent, kept as the reference of parse_react_output in the equivalence
+    tests and activities/benchmark_output_parser.py. Its backtracking is quadratic and worse on long outputs.
+    """
+    for indicator in FINAL_ANSWER_INDICATORS:
+        if indicator in llm_output:
+            return ParsedOutput(final_answer=''.join(llm_output.split(indicator)).strip())
+
+    action_regex_1 = r"(.*?)\n?Action:\s*(.*?)\n?Action\s*Input:\s*```python\n(.*?)```(.*?)$|(.*?)\n?'''(\w+)\n?(.*?)\n?'''(.*?)$"
+    action_regex_2 = r"(.*?)\n?Action:\s*(.*?)\n?Action\s*Input:\s*```py\n(.*?)```(.*?)$|(.*?)\n?'''(\w+)\n?(.*?)\n?'''(.*?)$"
+    action_regex_3 = r"(.*?)\n?Action:\s*(.*?)\n?\s*```python\n(.*?)```(.*?)$|(.*?)\n?'''(\w+)\n?(.*?)\n?'''(.*?)$"
+    action_regex_4 = r"(.*?)\n?```python\n(.*?)```(.*?)$|(.*?)\n?'''(\w+)\n?(.*?)\n?'''(.*?)$"
+
+    action_match = (re.search(action_regex_1, llm_output, re.DOTALL) or re.search(action_regex_2, llm_output, re.DOTALL)
+                    or re.search(action_regex_3, llm_output, re.DOTALL))
+    action_match_others = re.search(action_regex_4, llm_output, re.DOTALL)
+
+    if action_match or action_match_others:
+        if action_match:
+            if action_match.group(1) is None:
+                raise LLMException(f"Unrecognized LLM output format: `{llm_output}`")
+            return ParsedOutput(context=action_match.group(1).strip(), tool=action_match.group(2).strip(),
+                                tool_input=action_match.group(3).strip())
+        if action_match_others.group(2) is None:
+            raise LLMException(f"Unrecognized LLM output format: `{llm_output}`")
+        return ParsedOutput(tool="python_code_sandbox", tool_input=action_match_others.group(2).strip())
+
+    if not re.search(r"Action\s*:", llm_output, re.DOTALL):
+        raise LLMException(f"Missing 'Action' in LLM output: `{llm_output}`")
+    elif not re.search(r"Action\s*Input\s*:", llm_output, re.DOTALL):
+        raise LLMException(f"Missing 'Action Input' in LLM output: `{llm_output}`")
+    else:
+        raise LLMException(f"Unrecognized LLM output format: `{llm_output}`")
@@ -1,16 +1,16 @@
+import asyncio
 import logging
 import os
 import time
-from typing import Any, Dict, Union
-import pandas as pd
-from io import StringIO
+from typing import Any, Dict, List, Optional, Union
 
 from werkzeug.datastructures import FileStorage
 
-from ..agent import BaseAgent
+from ..agent import AgentFactory
 from ..agent.react import AsyncReactAgent
-from ..schemas import AgentRequest, MediaFile, Message, RoleType
-from ..utils import generate_random_string, get_logger, get_model_config_path
+from ..schemas import AgentRequest, MediaFile, Message, QuestionBudget, RoleType
+from ..utils import generate_random_string, get_logger, get_model_config_path, get_csv_basic_info, \
+    csv_needs_conversion, stage_files, STAGE_MODE_AUTO
 
 logger = get_logger()
 
@@ -42,15 +42,45 @@ class CodeInterpreterSession:
         logger.info(f"Use Config Path: {config_path}")
         sandbox_id = generate_random_string(8)
 
-        # setup agent
-        agent = await BaseAgent.async_from_config_path_and_kwargs(config_path, **kwargs)
-        await agent.plugins_map["python_code_sandbox"].set_sandbox_id(sandbox_id)
+        # setup agent, the config, llm client and tools are only built for the first session of a config
+        agent = await AgentFactory.get_instance().acquire(config_path, **kwargs)
+        sandbox_tool = agent.plugins_map["python_code_sandbox"]
+        await sandbox_tool.set_sandbox_id(sandbox_id)
+        # The kernel boots while the first LLM round runs, the first code run only waits for what is left of it
+        sandbox_tool.start_kernel()
 
         return cls(session_id=sandbox_id,
                    config_path=config_path,
                    agent=agent)
 
-    async def upload_to_sandbox(self, file: Union[str, FileStorage], open_path_file: str = None):
+    async def stage_to_sandbox(self, file_paths: List[str], open_path_file: str = None,
+                               stage_mode: str = STAGE_MODE_AUTO):
+        """
+        Stage local files into the sandbox in the background, see stage_files. The files are listed in the request
+        right away, the CSV summaries of the prompt and the images sent to the LLM are read from the source files, and
+        the first code run of the sandbox waits for the staging to finish.
+
+        :param file_paths: The local file paths.
+        :type file_paths: List[str]
+        :param open_path_file: The URL prefix of the images.
+        :type open_path_file: str
+        :param stage_mode: How to stage a file, one of STAGE_MODES.
+        :type stage_mode: str
+        """
+        if not file_paths:
+            return
+        staging = asyncio.ensure_future(asyncio.to_thread(stage_files, file_paths, self.session_id, stage_mode))
+        self.agent.plugins_map["python_code_sandbox"].add_setup_task(staging)
+        for index, file_path in enumerate(file_paths):
+            if file_path.endswith('.csv') and csv_needs_conversion(file_path):
+                # The sandbox reads the file converted to comma delimiters, the summary has to be of that one
+                staged_files = await staging
+                await self.upload_to_sandbox(staged_files[index], open_path_file)
+            else:
+                await self.upload_to_sandbox(file_path, open_path_file, source_path=file_path)
+
+    async def upload_to_sandbox(self, file: Union[str, FileStorage], open_path_file: str = None,
+                                source_path: str = None):
         dst_path = await self.agent.sync_to_sandbox(file)
         message = f'User uploaded the following files: {dst_path}\n'
         logging.info(f"The file path {file} has been synced to sandbox with file path {dst_path}")
@@ -68,13 +98,8 @@ class CodeInterpreterSession:
             file_basic_info = None
         elif file_type == 'csv':
             open_path = None
-            df = pd.read_csv(file)
-            output = StringIO()
-            df.info(buf=output)
-            info_str = output.getvalue()
-            info_lines = info_str.splitlines()
-            info_str_top20 = "\n".join(info_lines[2:20])
-            file_basic_info = info_str_top20
+            # A summary not cached yet hashes and scans the file, off the event loop
+            file_basic_info = await asyncio.to_thread(get_csv_basic_info, file)
         else:
             open_path = None
             file_basic_info = None
@@ -84,16 +109,18 @@ class CodeInterpreterSession:
                 file_type=file_type,
                 open_path=open_path,
                 file_basic_info=file_basic_info,
+                source_path=source_path,
         ))
 
-    async def chat(self, user_messages, input_files=None):
+    async def chat(self, user_messages, input_files=None, budget: Optional[QuestionBudget] = None):
         start_time = time.time()
 
         self.messages.extend(user_messages)
         agent_request = AgentRequest(
             messages=self.messages,
             input_files=self.input_files,
-            sandbox_id=self.session_id
+            sandbox_id=self.session_id,
+            budget=budget
         )
         logger.info(f"Agent request: {agent_request.__dict__}\n[Request End]")
 
@@ -107,6 +134,14 @@ class CodeInterpreterSession:
             f'Agent Execution Latency: {exec_time - start_time}'
         )
 
+    def close(self):
+        """
+        Hand the agent back to the factory once the session is over, the session can't chat afterwards.
+        """
+        if self.agent is not None:
+            AgentFactory.get_instance().release(self.agent)
+            self.agent = None
+
     def __enter__(self):
         pass
 
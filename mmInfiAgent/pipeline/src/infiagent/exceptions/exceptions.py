@@ -44,3 +44,14 @@ class PluginException(DependencyException):
     def __init__(self, message, *args: object):
         super().__init__(message, *args)
 
+
+
+class LLMCacheMissException(LLMException):
+    def __init__(self, message, *args: object):
+        super().__init__(message, *args)
+
+
+class BudgetExhaustedException(DependencyException):
+    def __init__(self, reason, *args: object):
+        super().__init__(f"Question budget exhausted: {reason}", *args)
+        self.reason = reason
@@ -1,6 +1,12 @@
+from .client.openai_compatible import *
 from .client.openai import *
 from .client.azure_openai import *
 from .base_llm import *
+from .transport import *
+from .rate_limiter import *
+from .response_cache import *
+from .token_budget import *
+from .image_cache import *
 from .client.vllm_openai import *
 from .client.qwenvl import *
 from .client.gemini import *
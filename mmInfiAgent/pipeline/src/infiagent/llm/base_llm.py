@@ -1,14 +1,41 @@
 from abc import ABC
+from typing import AsyncIterator, Callable, List, Optional
 
-from ..exceptions.exceptions import InputErrorException
+from ..exceptions.exceptions import InputErrorException, LLMException
 from ..schemas import BaseCompletion
+from ..utils import get_logger
+from .rate_limiter import RateLimiter, get_rate_limiter, rate_limited, rate_limited_stream
+from .response_cache import cached, get_response_cache
+from .token_budget import TokenBudget
+from .transport import LLMCredentials
+
+logger = get_logger()
+
+CODE_FENCE = "```"
 
 
 class BaseLLM(ABC):
+    # Tokens of the context window reserved for the completion
+    max_gen_length: int = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Every completion of a subclass is looked up in the response cache, when it is enabled, and otherwise
+        # goes through the rate limiter of its provider and model
+        if "async_completion" in cls.__dict__:
+            cls.async_completion = cached(rate_limited(cls.__dict__["async_completion"]))
+        if "async_stream_completion" in cls.__dict__:
+            cls.async_stream_completion = rate_limited_stream(cls.__dict__["async_stream_completion"])
 
     def __init__(self, model_name: str, params: dict, **kwargs):
         self.__model_name = model_name
         self.__params = params
+        self.__credentials = LLMCredentials(api_key=kwargs.get("api_key", None),
+                                            api_base=kwargs.get("api_base", None),
+                                            api_type=kwargs.get("api_type", None),
+                                            api_version=kwargs.get("api_version", None))
+        self.__rate_limit = kwargs.get("rate_limit", None) or {}
+        self.__token_budget = None
 
     @classmethod
     async def create(cls, config_data: dict):
@@ -28,9 +55,155 @@ class BaseLLM(ABC):
     def params(self) -> dict:
         return self.__params
 
+    @property
+    def credentials(self) -> LLMCredentials:
+        return self.__credentials
+
+    @credentials.setter
+    def credentials(self, credentials: LLMCredentials):
+        self.__credentials = credentials
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        return get_rate_limiter(self.credentials.api_base or type(self).__name__, self.model_name,
+                                **self.__rate_limit)
+
+    @property
+    def token_budget(self) -> TokenBudget:
+        """
+        The token budget of the prompts, the context window of the model minus max_gen_length.
+        """
+        if self.__token_budget is None:
+            self.__token_budget = TokenBudget.create(self.model_name, self.params, self.max_gen_length)
+        return self.__token_budget
+
+    def fit_prompt(self, prompt: str) -> str:
+        """
+        Fit a prompt in the token budget. Agents already fit their prompts by dropping old observations, this is the
+        last resort cutting the middle of a prompt that is still too long.
+        """
+        budget = self.token_budget
+        fitted_prompt, token_count = budget.truncate(prompt)
+        if fitted_prompt is not prompt:
+            logger.warning(f"Prompt of {budget.count(prompt)} tokens exceeds the budget of {budget.max_prompt_tokens} "
+                           f"tokens of {self.model_name}, truncated to {token_count} tokens")
+        return fitted_prompt
+
     def completion(self, prompt) -> BaseCompletion:
         pass
 
     async def async_completion(self, prompt) -> BaseCompletion:
         pass
 
+    @property
+    def supports_streaming(self) -> bool:
+        """
+        Whether the client streams completions from its API, i.e. it overrides async_stream_completion.
+        """
+        return type(self).async_stream_completion is not BaseLLM.async_stream_completion
+
+    async def async_stream_completion(self, prompt: str, input_imgs: Optional[List] = None,
+                                      stop: Optional[List[str]] = None, **kwargs) -> AsyncIterator[str]:
+        """
+        Stream the completion of a prompt as text deltas. Closing the stream before its end closes the response, so
+        the server stops generating. Clients without a streaming API yield the whole completion at once.
+
+        :param prompt: The prompt to use for completion.
+        :type prompt: str
+        :param input_imgs: The input images.
+        :type input_imgs: Optional[List]
+        :param stop: The stop sequences, passed to the server by the clients supporting them.
+        :type stop: Optional[List[str]]
+        :return: The text deltas of the completion.
+        :rtype: AsyncIterator[str]
+        """
+        completion = await self.async_completion(prompt, input_imgs, **kwargs)
+        if completion.state == "error":
+            raise LLMException("Failed to retrieve response from LLM, error: {}".format(str(completion.content)))
+        yield cut_completion(completion.content, stop=stop)
+
+    async def async_completion_until(self, prompt: str, input_imgs: Optional[List] = None,
+                                     until: Optional[Callable[[str], Optional[int]]] = None,
+                                     stop: Optional[List[str]] = None) -> BaseCompletion:
+        """
+        Get the completion of a prompt up to the point until returns, e.g. the end of the first action of an agent.
+        Streaming clients cancel the generation there, the others cut the whole completion. The stop sequences are
+        applied on the client in both cases, see cut_completion. Completions are not streamed while the response
+        cache is enabled, so recorded and replayed runs see the same completions.
+
+        :param prompt: The prompt to use for completion.
+        :type prompt: str
+        :param input_imgs: The input images.
+        :type input_imgs: Optional[List]
+        :param until: Gets the text generated so far, returns the index to cut it at once it is complete.
+        :type until: Optional[Callable[[str], Optional[int]]]
+        :param stop: The stop sequences.
+        :type stop: Optional[List[str]]
+        :return: BaseCompletion object.
+        :rtype: BaseCompletion
+        """
+        if not self.supports_streaming or get_response_cache() is not None:
+            completion = await self.async_completion(prompt, input_imgs)
+            if completion.state == "success" and isinstance(completion.content, str):
+                completion.content = cut_completion(completion.content, until, stop)
+            return completion
+
+        text = ""
+        # The stop sequences are not sent to the server, it would also stop at one inside a code block
+        stream = self.async_stream_completion(prompt, input_imgs)
+        try:
+            async for delta in stream:
+                text += delta
+                cut_text = cut_completion(text, stop=stop)
+                end = until(cut_text) if until is not None else None
+                if end is not None or len(cut_text) < len(text):
+                    text = cut_text[:end]
+                    logger.info(f"Completion of {self.model_name} is complete after {len(text)} characters, "
+                                f"generation cancelled")
+                    break
+        finally:
+            await stream.aclose()
+        # Streams report no usage, tokens are counted with the tokenizer of the model
+        return BaseCompletion(state="success",
+                              content=text,
+                              prompt_token=self.token_budget.count(prompt),
+                              completion_token=self.token_budget.count(text))
+
+
+def cut_completion(text: str, until: Optional[Callable[[str], Optional[int]]] = None,
+                   stop: Optional[List[str]] = None) -> str:
+    """
+    Cut a completion before its first stop sequence and at the index until returns, the client side counterpart of
+    the stop sequences and the early stop of the streaming clients. Stop sequences inside code blocks don't cut the
+    completion, e.g. an action printing "Observation:".
+    """
+    for stop_word in stop or []:
+        index = _find_outside_code(text, stop_word)
+        if index >= 0:
+            text = text[:index]
+    if until is not None:
+        end = until(text)
+        if end is not None:
+            text = text[:end]
+    return text
+
+
+def _find_outside_code(text: str, word: str) -> int:
+    """
+    Find the first occurrence of word that is not inside a ``` code block, -1 if there is none.
+    """
+    in_code = False
+    pos = 0
+    index = text.find(word)
+    while index >= 0:
+        fence = text.find(CODE_FENCE, pos)
+        if fence < 0 or index < fence:
+            if not in_code:
+                return index
+            if fence < 0:
+                return -1
+        in_code = not in_code
+        pos = fence + len(CODE_FENCE)
+        if index < pos:
+            index = text.find(word, pos)
+    return -1
@@ -5,9 +5,6 @@ import os
 from abc import ABC
 from typing import Callable, List
 from ...utils import get_logger
-import httpx
-
-import openai
 from tenacity import (  # for exponential backoff
     before_sleep_log,
     retry,
@@ -15,34 +12,35 @@ from tenacity import (  # for exponential backoff
     wait_random_exponential,
 )
 
-from PIL import Image
-from anthropic import AsyncAnthropic
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
 from ..base_llm import BaseLLM
+from ..image_cache import get_image_cache, prepare_image
+from ..rate_limiter import before_sleep_throttle
+from ..transport import get_httpx_client
 from ...schemas import *
 
 logger = get_logger()
 MAX_GEN_LENGTH = 1500
 
 
-def compress_image(image_path, output_path, max_size_mb=4.0):
-    max_size = max_size_mb * 1024 * 1024
-    with Image.open(image_path) as img:
-        img_size = os.path.getsize(image_path)
-        if img_size > max_size:
-            ratio = (max_size / img_size) ** 0.5
-            new_width = int(img.width * ratio)
-            new_height = int(img.height * ratio)
-            img = img.resize((new_width, new_height), Image.ANTIALIAS)
-            img.save(output_path, optimize=True, quality=95)
-            return True
-        else:
-            return False
+# Longer images are downscaled by the API anyway
+MAX_IMAGE_EDGE = 1568
+MAX_IMAGE_SIZE_MB = 4.0
+
+
+def encode_image(image_path: str, max_size_mb: float = MAX_IMAGE_SIZE_MB) -> dict:
+    """
+    Get the base64 image source of the messages API. Images larger than max_size_mb or MAX_IMAGE_EDGE pixels are
+    resized in memory.
+    """
+    image_data, media_type = prepare_image(image_path, max_edge=MAX_IMAGE_EDGE,
+                                           max_bytes=int(max_size_mb * 1024 * 1024))
+    return {"type": "base64", "media_type": media_type, "data": base64.b64encode(image_data).decode("utf-8")}
 
 
 @retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(5), reraise=True,
-       before_sleep=before_sleep_log(logger, logging.WARNING))
-async def async_chat_completion_with_backoff(**kwargs):
-    client = AsyncAnthropic(api_key=kwargs.get('api_key', None))
+       before_sleep=before_sleep_throttle(before_sleep_log(logger, logging.WARNING)))
+async def async_chat_completion_with_backoff(client: AsyncAnthropic, **kwargs):
     async def _internal_coroutine():
         return await client.messages.create(**kwargs)
 
@@ -54,10 +52,24 @@ class ClaudeClient(BaseLLM, ABC):
     Wrapper class
     """
 
+    max_gen_length = MAX_GEN_LENGTH
+
     def __init__(self, **data):
         super().__init__(**data)
         self.model_name = data.get("model_name", 'claude3')
-        self.api_key = data.get("api_key", None)
+        self._client = None
+
+    def _get_client(self) -> AsyncAnthropic:
+        """
+        Get the Anthropic client of the running event loop. It is built once on the pooled httpx client, instead of
+        once per request.
+        """
+        http_client = get_httpx_client(DefaultAsyncHttpxClient)
+        if self._client is None or self._client[0] is not http_client:
+            self._client = (http_client, AsyncAnthropic(api_key=self.credentials.api_key,
+                                                        base_url=self.credentials.api_base,
+                                                        http_client=http_client))
+        return self._client[1]
 
     @classmethod
     async def create(cls, config_data):
@@ -66,6 +78,22 @@ class ClaudeClient(BaseLLM, ABC):
     def get_model_name(self) -> str:
         return self.model_name
 
+    def _build_messages(self, prompt: str, input_imgs: Optional[List] = None) -> List[dict]:
+        message_content = [
+            {
+                "type": "text", "text": self.fit_prompt(prompt)
+            }
+        ]
+        if input_imgs:
+            image_cache = get_image_cache()
+            for img in input_imgs:
+                # Encoded once per image content, not in every round
+                message_content.append({"type": "image",
+                                        "source": image_cache.get_or_build(img, "claude", encode_image)})
+
+        logger.info(f"The message send to LLM is: {message_content[0]['text']} with {len(message_content) - 1} images")
+        return [{"role": "user", "content": message_content}]
+
     async def async_completion(self, prompt: str, input_imgs: Optional[List[str]] = None, **kwargs) -> BaseCompletion:
         """
         Completion method for OpenAI GPT API.
@@ -78,37 +106,12 @@ class ClaudeClient(BaseLLM, ABC):
         :rtype: BaseCompletion
 
         """
-        message_content = [
-            {
-                "type": "text", "text": prompt[-(self.params.get('max_tokens', 4096) - MAX_GEN_LENGTH):]
-            }
-        ]
-        if input_imgs:
-            for img in input_imgs:
-                file_name = f"./src/infiagent/tmp/{img.sandbox_path}"
-                compressed_file_name = file_name[:-4] + '_compressed.png'
-                if compress_image(file_name, compressed_file_name):
-                    file_name = compressed_file_name
-
-                with open(file_name, "rb") as image_file:
-                    image_data = image_file.read()
-
-                message_content.append({
-                    "type": "image", "source": {"type": "base64",
-                                                "media_type": "image/png",
-                                                "data": base64.b64encode(image_data).decode("utf-8")}
-                })
-
-        logger.info(f"The message send to LLM is: {message_content}")
-
         response = await async_chat_completion_with_backoff(
+            self._get_client(),
             model=self.get_model_name(),
-            messages=[
-                {"role": "user", "content": message_content}
-            ],
+            messages=self._build_messages(prompt, input_imgs),
             max_tokens=self.params.get('max_tokens', 4096),
             temperature=self.params.get('temperature', 0.7),
-            api_key=self.api_key,
             # top_p=self.params.get('top_p', 0.9),
             # frequency_penalty=self.params.get('frequency_penalty', 1.0),
             **kwargs
@@ -119,7 +122,33 @@ class ClaudeClient(BaseLLM, ABC):
                               prompt_token=response.usage.input_tokens,
                               completion_token=response.usage.output_tokens)
 
+    async def async_stream_completion(self, prompt: str, input_imgs: Optional[List[str]] = None,
+                                      stop: Optional[List[str]] = None, **kwargs):
+        """
+        Streaming completion method for the messages API, the stop sequences are passed to the server.
 
-
-
-
+        :param prompt: The prompt to use for completion.
+        :type prompt: str
+        :param stop: The stop sequences.
+        :type stop: Optional[List[str]]
+        :return: The text deltas of the completion.
+        :rtype: AsyncIterator[str]
+        """
+        if stop:
+            kwargs["stop_sequences"] = stop
+        stream = await async_chat_completion_with_backoff(
+            self._get_client(),
+            model=self.get_model_name(),
+            messages=self._build_messages(prompt, input_imgs),
+            max_tokens=self.params.get('max_tokens', 4096),
+            temperature=self.params.get('temperature', 0.7),
+            stream=True,
+            **kwargs
+        )
+        try:
+            async for event in stream:
+                if event.type == "content_block_delta" and getattr(event.delta, "text", None):
+                    yield event.delta.text
+        finally:
+            # Closes the response, the generation is cancelled when the caller stops early
+            await stream.close()
@@ -13,22 +13,35 @@ from tenacity import (  # for exponential backoff
 )
 
 from ..base_llm import BaseLLM
+from ..rate_limiter import before_sleep_throttle
+from ..transport import run_blocking
 from ...schemas import *
 
 logger = logging.getLogger(__name__)
 
 MAX_GEN_LENGTH = 2048
 
-@retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(100), reraise=True)
+@retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(100), reraise=True,
+       before_sleep=before_sleep_throttle())
 def completion_with_backoff(**kwargs):
     return genai.GenerativeModel('gemini-pro').generate_content(**kwargs)
 
 
+@retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(100), reraise=True,
+       before_sleep=before_sleep_throttle())
+async def async_completion_with_backoff(**kwargs):
+    # The SDK call is blocking, it runs in the SDK executor instead of on the event loop, and the retries wait
+    # without holding an executor thread
+    return await run_blocking(genai.GenerativeModel('gemini-pro').generate_content, **kwargs)
+
+
 class GeminiClient(BaseLLM, ABC):
     """
     Wrapper class for OpenAI GPT API collections.
     """
 
+    max_gen_length = MAX_GEN_LENGTH
+
     def __init__(self, **data):
         super().__init__(**data)
         genai.configure(api_key=data.get("api_key", None))
@@ -53,10 +66,10 @@ class GeminiClient(BaseLLM, ABC):
 
         """
         messages = [{'role': 'user',
-                     'parts': [prompt[-self.params.get('max_tokens', 30720):]]}]
+                     'parts': [self.fit_prompt(prompt)]}]
 
-        response = completion_with_backoff(contents=messages,
-                                           generation_config=genai.types.GenerationConfig(
-                                               temperature=self.params.get('temperature', 0.7)))
+        response = await async_completion_with_backoff(contents=messages,
+                                                       generation_config=genai.types.GenerationConfig(
+                                                           temperature=self.params.get('temperature', 0.7)))
         return BaseCompletion(state="success", content=response.text)
 
@@ -1,4 +1,5 @@
 import http.client
+import io
 import typing
 import urllib.request
 import json
@@ -23,21 +24,47 @@ from tenacity import (  # for exponential backoff
 )
 
 from ..base_llm import BaseLLM
+from ..image_cache import get_image_cache, prepare_image
+from ..rate_limiter import before_sleep_throttle
+from ..transport import run_blocking
 from ...schemas import *
 
 logger = logging.getLogger(__name__)
 
 MAX_GEN_LENGTH = 4096
 
+
+MAX_IMAGE_EDGE = 3072
+
+
+def encode_image(image_path: str) -> bytes:
+    """
+    Get the image data sent to the API, downscaled to MAX_IMAGE_EDGE pixels and converted to a supported format.
+    """
+    return prepare_image(image_path, max_edge=MAX_IMAGE_EDGE, formats=("JPEG", "PNG", "WEBP"))[0]
+
+
+def load_image(image_path: str) -> PIL.Image.Image:
+    """
+    Decode the image data of an image, precomputed by activities/preprocess_images.py when it is on disk.
+    """
+    with PIL.Image.open(io.BytesIO(get_image_cache().get_or_build(image_path, "gemini", encode_image))) as img:
+        img.load()
+        return img
+
+
 @retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(3), reraise=True,
-       before_sleep=before_sleep_log(logger, logging.WARNING))
+       before_sleep=before_sleep_throttle(before_sleep_log(logger, logging.WARNING)))
 async def async_chatcompletion_with_backoff(model, inputs, generation_config):
     async def _internal_coroutine():
-        return model.generate_content(inputs, generation_config=generation_config)
+        # The SDK call is blocking, it runs in the SDK executor instead of on the event loop
+        return await run_blocking(model.generate_content, inputs, generation_config=generation_config)
     return await _internal_coroutine()
 
 
 class geminiGenAIClient(BaseLLM, ABC):
+    max_gen_length = MAX_GEN_LENGTH
+
     def __init__(self, **data):
         super().__init__(**data)
         genai.configure(api_key=data.get("api_key", None))
@@ -52,17 +79,14 @@ class geminiGenAIClient(BaseLLM, ABC):
 
     async def async_completion(self, prompt: str, input_imgs: Optional[List[str]] = None, **kwargs) -> BaseCompletion:
         message_content = [
-            prompt[-(self.params.get('max_tokens', 4096) - MAX_GEN_LENGTH):]
+            self.fit_prompt(prompt)
         ]
 
-        root_directory = os.path.abspath(__file__)
-        while 'infiagent' not in os.path.basename(root_directory):
-            root_directory = os.path.dirname(root_directory)
         if input_imgs:
+            image_cache = get_image_cache()
             for img in input_imgs:
-                img_path = os.path.join(root_directory,'tmp',img.sandbox_path)
-                img_content = PIL.Image.open(img_path)
-                message_content.append(img_content)
+                # Decoded once per image content, not in every round
+                message_content.append(image_cache.get_or_build(img, "pil", load_image))
 
         generation_config = {
             'top_p': self.params.get('top_p', 0.2),
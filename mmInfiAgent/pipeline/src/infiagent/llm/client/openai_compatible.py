@@ -0,0 +1,427 @@
+import base64
+import json
+import logging
+import os
+from abc import ABC
+from dataclasses import dataclass, field, fields
+from typing import Callable, Dict, List, Optional
+
+from tenacity import (  # for exponential backoff
+    AsyncRetrying,
+    Retrying,
+    before_sleep_log,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from ..base_llm import BaseLLM
+from ..image_cache import get_image_cache, prepare_image
+from ..rate_limiter import before_sleep_throttle
+from ..transport import LLMCredentials, get_request_deadline, get_request_timeout, iter_openai_deltas, \
+    openai_chat_completion, openai_chat_completion_sync
+from ...exceptions.exceptions import InputErrorException
+from ...schemas import *
+from ...utils import get_logger
+
+logger = get_logger()
+
+IMAGE_TRANSPORT_URL = "url"
+IMAGE_TRANSPORT_BASE64 = "base64"
+IMAGE_TRANSPORT_NONE = "none"
+IMAGE_TRANSPORTS = (IMAGE_TRANSPORT_URL, IMAGE_TRANSPORT_BASE64, IMAGE_TRANSPORT_NONE)
+
+# Longer images are downscaled by the OpenAI API anyway
+MAX_IMAGE_EDGE = 2048
+
+
+def encode_image_url(image_path: str, max_edge: int = MAX_IMAGE_EDGE) -> str:
+    """
+    Get the base64 data URL of an image for the image_url content of the chat completions API. Images longer than
+    max_edge pixels are resized in memory.
+    """
+    image_data, media_type = prepare_image(image_path, max_edge=max_edge)
+    return f"data:{media_type};base64,{base64.b64encode(image_data).decode('utf-8')}"
+
+
+@dataclass(frozen=True)
+class OpenAICompatibleConfig:
+    """
+    Settings of one OpenAI-compatible client, read from the llm section of an agent config. Unset keys fall back
+    to the defaults of the client class.
+
+    :param api_base: The endpoint, e.g. http://localhost:8000/v1.
+    :param api_key: The key, api_key_env names an environment variable holding it instead.
+    :param api_type: The auth style of the openai SDK, open_ai sends a bearer token, azure an api-key header.
+    :param model_field: model sends the model name in the body, engine puts it into the path as Azure and some
+        self-hosted servers expect. Defaults to engine for azure.
+    :param image_transport: url sends the open_path of the input images, base64 sends them inline as data URLs,
+        none sends the prompt only.
+    :param stream: Stream the completions the agent cuts at the end of a step, for the servers known to support
+        streaming.
+    :param sampling_params: Request params with their defaults, the params of the config override them. Params
+        defaulting to None are only sent when they are set.
+    """
+    api_base: Optional[str] = None
+    api_key: Optional[str] = None
+    api_key_env: Optional[str] = None
+    api_type: Optional[str] = None
+    api_version: Optional[str] = None
+    model_field: Optional[str] = None
+    image_transport: str = IMAGE_TRANSPORT_URL
+    image_max_edge: int = MAX_IMAGE_EDGE
+    max_gen_length: int = 1500
+    timeout: Optional[float] = 600
+    stream: bool = False
+    retry_attempts: int = 3
+    retry_min_wait: float = 1
+    retry_max_wait: float = 10
+    sampling_params: Dict[str, object] = field(default_factory=lambda: {"temperature": 0.7})
+
+    @classmethod
+    def create(cls, config_data: dict) -> "OpenAICompatibleConfig":
+        """
+        Build the settings from a config, keys other than the settings are ignored.
+
+        :param config_data: The llm section of an agent config.
+        :type config_data: dict
+        :return: The settings.
+        :rtype: OpenAICompatibleConfig
+        """
+        config = cls(**{f.name: config_data[f.name] for f in fields(cls) if f.name in config_data})
+        if config.image_transport not in IMAGE_TRANSPORTS:
+            raise InputErrorException("Invalid image_transport {}, expect one of {}".format(
+                config.image_transport, ", ".join(IMAGE_TRANSPORTS)))
+        if config.model_field not in (None, "model", "engine"):
+            raise InputErrorException("Invalid model_field {}, expect model or engine".format(config.model_field))
+        return config
+
+    @property
+    def credentials(self) -> LLMCredentials:
+        api_key = self.api_key
+        if self.api_key_env:
+            api_key = os.environ.get(self.api_key_env, api_key)
+        return LLMCredentials(api_key=api_key, api_base=self.api_base, api_type=self.api_type,
+                              api_version=self.api_version)
+
+    @property
+    def model_key(self) -> str:
+        if self.model_field:
+            return self.model_field
+        return "engine" if self.api_type == "azure" else "model"
+
+
+class OpenAICompatibleClient(BaseLLM, ABC):
+    """
+    Client of the servers speaking the OpenAI chat completions protocol, e.g. OpenAI, Azure OpenAI, vLLM and the
+    LLaVA and InternVL servers. Everything that differs between them is configured per instance, see
+    OpenAICompatibleConfig, so clients of several backends run side by side in one process.
+
+    Subclasses only set default_config, the defaults of their backend.
+    """
+
+    default_config: dict = {}
+
+    def __init__(self, **data):
+        data = {**self.default_config, **data}
+        super().__init__(**data)
+        self.config = OpenAICompatibleConfig.create(data)
+        self.credentials = self.config.credentials
+        self.max_gen_length = self.config.max_gen_length
+
+    @classmethod
+    async def create(cls, config_data):
+        return cls(**config_data)
+
+    def get_model_name(self) -> str:
+        return self.model_name
+
+    def get_model_param(self):
+        return self.params
+
+    @property
+    def supports_streaming(self) -> bool:
+        return self.config.stream
+
+    def _build_messages(self, prompt: str, input_imgs: Optional[List] = None) -> List[dict]:
+        prompt = self.fit_prompt(prompt)
+        if self.config.image_transport == IMAGE_TRANSPORT_NONE:
+            return [{"role": "user", "content": prompt}]
+
+        message_content = [{"type": "text", "text": prompt}]
+        image_cache = get_image_cache()
+        for img in input_imgs or []:
+            if self.config.image_transport == IMAGE_TRANSPORT_URL:
+                url = img.open_path
+            else:
+                # Encoded once per image content, not in every round
+                max_edge = self.config.image_max_edge
+                url = image_cache.get_or_build(img, f"data_url_{max_edge}",
+                                               lambda path: encode_image_url(path, max_edge))
+            message_content.append({"type": "image_url", "image_url": {"url": url}})
+
+        logger.info(f"The message send to LLM is: {prompt} with {len(message_content) - 1} images")
+        return [{"role": "user", "content": message_content}]
+
+    def _request_kwargs(self, messages: List[dict], **kwargs) -> dict:
+        request = {self.config.model_key: self.get_model_name(), "messages": messages}
+        timeout = get_request_timeout(self.config.timeout)
+        if timeout is not None:
+            request["timeout"] = timeout
+        if get_request_deadline() is not None:
+            # The HTTP timeout of the openai SDK, the request ends with the question
+            request["request_timeout"] = timeout
+        for name, default in self.config.sampling_params.items():
+            value = self.params.get(name, default)
+            if value is not None:
+                request[name] = value
+        request.update(kwargs)
+        return request
+
+    def _retry_kwargs(self) -> dict:
+        return dict(wait=wait_random_exponential(min=self.config.retry_min_wait, max=self.config.retry_max_wait),
+                    stop=stop_after_attempt(self.config.retry_attempts), reraise=True,
+                    before_sleep=before_sleep_throttle(before_sleep_log(logger, logging.WARNING)))
+
+    async def _async_chat_completion(self, **request):
+        return await AsyncRetrying(**self._retry_kwargs())(openai_chat_completion, self.credentials, **request)
+
+    def _chat_completion(self, **request):
+        return Retrying(**self._retry_kwargs())(openai_chat_completion_sync, self.credentials, **request)
+
+    @staticmethod
+    def _to_completion(response) -> BaseCompletion:
+        return BaseCompletion(state="success",
+                              content=response.choices[0].message["content"],
+                              prompt_token=response.get("usage", {}).get("prompt_tokens", 0),
+                              completion_token=response.get("usage", {}).get("completion_tokens", 0))
+
+    def completion(self, prompt: str, **kwargs) -> BaseCompletion:
+        """
+        Completion method for OpenAI GPT API.
+
+        :param prompt: The prompt to use for completion.
+        :type prompt: str
+        :param kwargs: Additional keyword arguments.
+        :type kwargs: dict
+        :return: BaseCompletion object.
+        :rtype: BaseCompletion
+
+        """
+        response = self._chat_completion(**self._request_kwargs(self._build_messages(prompt), **kwargs))
+        return self._to_completion(response)
+
+    async def async_completion(self, prompt: str, input_imgs: Optional[List] = None, **kwargs) -> BaseCompletion:
+        """
+        Completion method for OpenAI GPT API.
+
+        :param prompt: The prompt to use for completion.
+        :type prompt: str
+        :param input_imgs: The input images, sent as configured by image_transport.
+        :type input_imgs: Optional[List]
+        :param kwargs: Additional keyword arguments.
+        :type kwargs: dict
+        :return: BaseCompletion object.
+        :rtype: BaseCompletion
+
+        """
+        response = await self._async_chat_completion(
+            **self._request_kwargs(self._build_messages(prompt, input_imgs), **kwargs))
+        return self._to_completion(response)
+
+    async def async_stream_completion(self, prompt: str, input_imgs: Optional[List] = None,
+                                      stop: Optional[List[str]] = None, **kwargs):
+        """
+        Streaming completion method for OpenAI GPT API, the stop sequences are passed to the server.
+
+        :param prompt: The prompt to use for completion.
+        :type prompt: str
+        :param input_imgs: The input images, sent as configured by image_transport.
+        :type input_imgs: Optional[List]
+        :param stop: The stop sequences.
+        :type stop: Optional[List[str]]
+        :return: The text deltas of the completion.
+        :rtype: AsyncIterator[str]
+        """
+        if stop:
+            kwargs["stop"] = stop
+        response = await self._async_chat_completion(
+            **self._request_kwargs(self._build_messages(prompt, input_imgs), stream=True, **kwargs))
+        deltas = iter_openai_deltas(response)
+        try:
+            async for delta in deltas:
+                yield delta
+        finally:
+            await deltas.aclose()
+
+    def chat_completion(self, message: List[dict]) -> ChatCompletion:
+        """
+        Chat completion method for OpenAI GPT API.
+
+        :param message: The message to use for completion.
+        :type message: List[dict]
+        :return: ChatCompletion object.
+        :rtype: ChatCompletion
+        """
+        try:
+            response = self._chat_completion(**self._request_kwargs(message))
+            return ChatCompletion(
+                state="success",
+                role=response.choices[0].message["role"],
+                content=response.choices[0].message["content"],
+                prompt_token=response.get("usage", {}).get("prompt_tokens", 0),
+                completion_token=response.get("usage", {}).get("completion_tokens", 0),
+            )
+        except Exception as exception:
+            logger.error(f"Failed to get response {str(exception)}", exc_info=True)
+            return ChatCompletion(state="error", content=str(exception))
+
+    def stream_chat_completion(self, message: List[dict], **kwargs):
+        """
+        Stream output chat completion for OpenAI GPT API.
+
+        :param message: The message (scratchpad) to use for completion. Usually contains json of role and content.
+        :type message: List[dict]
+        :param kwargs: Additional keyword arguments.
+        :type kwargs: dict
+        :return: ChatCompletion object.
+        :rtype: ChatCompletion
+        """
+        try:
+            response = self._chat_completion(**self._request_kwargs(message, stream=True, **kwargs))
+            role = next(response).choices[0].delta["role"]
+            ## TODO: Calculate prompt_token and for stream mode
+            for resp in response:
+                yield ChatCompletion(
+                    state="success",
+                    role=role,
+                    content=resp.choices[0].delta.get("content", ""),
+                    prompt_token=0,
+                    completion_token=0,
+                )
+        except Exception as exception:
+            logger.error(f"Failed to get response {str(exception)}", exc_info=True)
+            return ChatCompletion(state="error", content=str(exception))
+
+    def function_chat_completion(
+            self,
+            message: List[dict],
+            function_map: Dict[str, Callable],
+            function_schema: List[Dict],
+    ) -> ChatCompletionWithHistory:
+        """
+        Chat completion method for OpenAI GPT API.
+
+        :param message: The message to use for completion.
+        :type message: List[dict]
+        :param function_map: The function map to use for completion.
+        :type function_map: Dict[str, Callable]
+        :param function_schema: The function schema to use for completion.
+        :type function_schema: List[Dict]
+        :return: ChatCompletionWithHistory object.
+        :rtype: ChatCompletionWithHistory
+        """
+        assert len(function_schema) == len(function_map)
+        try:
+            response = self._chat_completion(**self._request_kwargs(message, functions=function_schema))
+            response_message = response.choices[0]["message"]
+
+            if response_message.get("function_call"):
+                function_name = response_message["function_call"]["name"]
+                fuction_to_call = function_map[function_name]
+                function_args = json.loads(
+                    response_message["function_call"]["arguments"]
+                )
+                function_response = fuction_to_call(**function_args)
+
+                # Postprocess function response
+                if isinstance(function_response, str):
+                    plugin_cost = 0
+                    plugin_token = 0
+                elif isinstance(function_response, AgentOutput):
+                    plugin_cost = function_response.cost
+                    plugin_token = function_response.token_usage
+                    function_response = function_response.output
+                else:
+                    raise Exception(
+                        "Invalid tool response type. Must be on of [AgentOutput, str]"
+                    )
+
+                message.append(dict(response_message))
+                message.append(
+                    {
+                        "role": "function",
+                        "name": function_name,
+                        "content": function_response,
+                    }
+                )
+                second_response = self._chat_completion(**self._request_kwargs(message))
+                message.append(dict(second_response.choices[0].message))
+                return ChatCompletionWithHistory(
+                    state="success",
+                    role=second_response.choices[0].message["role"],
+                    content=second_response.choices[0].message["content"],
+                    prompt_token=response.get("usage", {}).get("prompt_tokens", 0)
+                                 + second_response.get("usage", {}).get("prompt_tokens", 0),
+                    completion_token=response.get("usage", {}).get(
+                        "completion_tokens", 0
+                    )
+                                     + second_response.get("usage", {}).get("completion_tokens", 0),
+                    message_scratchpad=message,
+                    plugin_cost=plugin_cost,
+                    plugin_token=plugin_token,
+                )
+            else:
+                message.append(dict(response_message))
+                return ChatCompletionWithHistory(
+                    state="success",
+                    role=response.choices[0].message["role"],
+                    content=response.choices[0].message["content"],
+                    prompt_token=response.get("usage", {}).get("prompt_tokens", 0),
+                    completion_token=response.get("usage", {}).get(
+                        "completion_tokens", 0
+                    ),
+                    message_scratchpad=message,
+                )
+
+        except Exception as exception:
+            logger.error(f"Failed to get response {str(exception)}", exc_info=True)
+            return ChatCompletionWithHistory(state="error", content=str(exception))
+
+    def function_chat_stream_completion(
+            self,
+            message: List[dict],
+            function_map: Dict[str, Callable],
+            function_schema: List[Dict],
+    ) -> ChatCompletionWithHistory:
+        assert len(function_schema) == len(function_map)
+        try:
+            response = self._chat_completion(**self._request_kwargs(message, functions=function_schema, stream=True))
+            tmp = next(response)
+            role = tmp.choices[0].delta["role"]
+            _type = (
+                "function_call"
+                if tmp.choices[0].delta["content"] is None
+                else "content"
+            )
+            if _type == "function_call":
+                name = tmp.choices[0].delta["function_call"]["name"]
+                yield _type, ChatCompletionWithHistory(
+                    state="success",
+                    role=role,
+                    content="{" + f'"name":"{name}", "arguments":',
+                    message_scratchpad=message,
+                )
+            for resp in response:
+                content = resp.choices[0].delta.get(_type, "")
+                if isinstance(content, dict):
+                    content = content["arguments"]
+                yield _type, ChatCompletionWithHistory(
+                    state="success",
+                    role=role,
+                    content=content,
+                    message_scratchpad=message,
+                )
+
+        except Exception as e:
+            logger.error(f"Failed to get response {str(e)}", exc_info=True)
+            raise e
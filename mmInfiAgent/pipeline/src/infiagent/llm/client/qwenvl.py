@@ -19,6 +19,8 @@ from tenacity import (  # for exponential backoff
 )
 
 from ..base_llm import BaseLLM
+from ..rate_limiter import before_sleep_throttle
+from ..transport import run_blocking
 from ...schemas import *
 
 logger = logging.getLogger(__name__)
@@ -27,10 +29,11 @@ MAX_GEN_LENGTH = 4096
 
 
 @retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(3), reraise=True,
-       before_sleep=before_sleep_log(logger, logging.WARNING))
+       before_sleep=before_sleep_throttle(before_sleep_log(logger, logging.WARNING)))
 async def async_chatcompletion_with_backoff(**kwargs):
     async def _internal_coroutine():
-        return dashscope.MultiModalConversation.call(**kwargs)
+        # The SDK call is blocking, it runs in the SDK executor instead of on the event loop
+        return await run_blocking(dashscope.MultiModalConversation.call, **kwargs)
     return await _internal_coroutine()
 
 
@@ -41,9 +44,10 @@ class qwenvlGPTClient(BaseLLM, ABC):
     https://help.aliyun.com/zh/dashscope/developer-reference/vl-plus-quick-start
     """
 
+    max_gen_length = MAX_GEN_LENGTH
+
     def __init__(self, **data):
         super().__init__(**data)
-        dashscope.api_key = data.get("api_key", None)
 
     @classmethod
     async def create(cls, config_data):
@@ -55,7 +59,7 @@ class qwenvlGPTClient(BaseLLM, ABC):
     async def async_completion(self, prompt: str, input_imgs: Optional[List[str]] = None, **kwargs) -> BaseCompletion:
         message_content = [
             {
-                "text": prompt[-(self.params.get('max_tokens', 4096) - MAX_GEN_LENGTH):]
+                "text": self.fit_prompt(prompt)
             }
         ]
         if input_imgs:
@@ -66,6 +70,7 @@ class qwenvlGPTClient(BaseLLM, ABC):
 
         task = asyncio.create_task(async_chatcompletion_with_backoff(
             model=self.get_model_name(),
+            api_key=self.credentials.api_key,
             messages=[{
                 "role": "user",
                 "content": message_content
@@ -0,0 +1,262 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from ..utils import get_logger
+from ..utils.file_utils import file_content_hash
+from .token_budget import estimate_image_tokens
+
+logger = get_logger()
+
+root_directory = os.path.abspath(__file__)
+while 'infiagent' not in os.path.basename(root_directory):
+    root_directory = os.path.dirname(root_directory)
+
+IMAGE_CACHE_MAX_SIZE = 512 * 1024 * 1024
+# Directory of the payloads precomputed by activities/preprocess_images.py
+IMAGE_CACHE_DIR = f"{root_directory}/tmp/image_cache"
+# Payload kind of the image info, see read_image_info
+IMAGE_INFO_KIND = "info"
+# Each round of a resize that still exceeds the byte limit shrinks the image by this factor
+_RESIZE_STEP = 0.75
+
+# File suffixes of the payloads persisted on disk, by payload type
+_DISK_FORMATS = {bytes: "bin", str: "txt", dict: "json"}
+
+
+def get_image_path(image) -> str:
+    """
+    Get the local path of an input image, a MediaFile staged in the sandbox or a path. A MediaFile is read from its
+    source file, the staged copy may still be written in the background during the first round.
+    """
+    source_path = getattr(image, "source_path", None)
+    if source_path and os.path.isfile(source_path):
+        return source_path
+    sandbox_path = getattr(image, "sandbox_path", None)
+    if sandbox_path:
+        return os.path.join(root_directory, "tmp", sandbox_path)
+    return image
+
+
+def prepare_image(image_path: str, max_edge: Optional[int] = None, max_bytes: Optional[int] = None,
+                  formats: Sequence[str] = ("JPEG", "PNG", "GIF", "WEBP")) -> Tuple[bytes, str]:
+    """
+    Get the bytes of an image within the limits of a provider. Images within the limits are sent as they are,
+    larger ones are downscaled and images of other formats converted, both to PNG.
+
+    :param image_path: The image path.
+    :type image_path: str
+    :param max_edge: The max pixels of the longer edge.
+    :type max_edge: Optional[int]
+    :param max_bytes: The max size of the image data.
+    :type max_bytes: Optional[int]
+    :param formats: The PIL formats the provider accepts.
+    :type formats: Sequence[str]
+    :return: The image data and its media type.
+    :rtype: Tuple[bytes, str]
+    """
+    file_size = os.path.getsize(image_path)
+    with Image.open(image_path) as img:
+        scale = 1.0
+        if max_edge and max(img.size) > max_edge:
+            scale = max_edge / max(img.size)
+        if max_bytes and file_size > max_bytes:
+            scale = min(scale, (max_bytes / file_size) ** 0.5)
+        if scale >= 1.0 and img.format in formats:
+            with open(image_path, "rb") as fr:
+                return fr.read(), Image.MIME[img.format]
+
+        if img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            img = img.convert("RGB")
+        while True:
+            size = (max(int(img.width * scale), 1), max(int(img.height * scale), 1))
+            buffer = io.BytesIO()
+            (img.resize(size, Image.LANCZOS) if scale < 1.0 else img).save(buffer, format="PNG")
+            if not max_bytes or buffer.tell() <= max_bytes:
+                return buffer.getvalue(), "image/png"
+            # PNG may be larger than the original encoding
+            scale *= _RESIZE_STEP
+
+
+def read_image_info(image_path: str) -> dict:
+    """
+    Read the dimensions of an image and estimate the tokens it costs per provider.
+    """
+    with Image.open(image_path) as img:
+        width, height = img.size
+        image_format = img.format
+    return {
+        "width": width,
+        "height": height,
+        "format": image_format,
+        "bytes": os.path.getsize(image_path),
+        "tokens": {provider: estimate_image_tokens(width, height, provider)
+                   for provider in ("openai", "claude", "gemini", "qwen")},
+    }
+
+
+def _payload_size(payload: Any) -> int:
+    if isinstance(payload, (bytes, str)):
+        return len(payload)
+    if isinstance(payload, dict):
+        return sum(_payload_size(value) for value in payload.values())
+    if hasattr(payload, "width") and hasattr(payload, "height"):
+        # Decoded PIL images hold a byte per band and pixel
+        return payload.width * payload.height * len(payload.getbands())
+    return sys.getsizeof(payload)
+
+
+class ImagePayloadCache:
+    """
+    Cache of the provider-ready payloads of input images, e.g. resized base64 data or decoded PIL images.
+
+    Payloads are keyed by the content hash of the image and the payload kind, so the same image is encoded once for
+    all rounds and sessions, even when every session stages it under another sandbox path. The payloads are kept
+    in memory up to max_size bytes, least recently used first out. With a directory, bytes, str and dict payloads
+    are also persisted on disk, so other processes and later runs skip the encoding.
+    """
+
+    def __init__(self, max_size: int = IMAGE_CACHE_MAX_SIZE, directory: Optional[str] = None):
+        self.max_size = max_size
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Any, int]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get_or_build(self, image, kind: str, build: Callable[[str], Any]) -> Any:
+        """
+        Get the payload of an image, built and cached on a miss.
+
+        :param image: The image, a MediaFile or a local path.
+        :param kind: The payload kind, e.g. the provider and the encoding, part of the cache key.
+        :type kind: str
+        :param build: Builds the payload from the image path.
+        :type build: Callable[[str], Any]
+        :return: The payload, shared with other callers, so it must not be modified.
+        """
+        image_path = get_image_path(image)
+        key = (file_content_hash(image_path), kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        payload = self._load(key)
+        if payload is None:
+            self.misses += 1
+            payload = build(image_path)
+            self._store(key, payload)
+        else:
+            self.hits += 1
+        self._put(key, payload)
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _put(self, key: Tuple[str, str], payload: Any):
+        size = _payload_size(payload)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (payload, size)
+            self._size += size
+            while self._size > self.max_size and len(self._entries) > 1:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def _disk_path(self, key: Tuple[str, str], payload_type: type) -> str:
+        content_hash, kind = key
+        return os.path.join(self.directory, content_hash[:2], f"{content_hash}.{kind}.{_DISK_FORMATS[payload_type]}")
+
+    def _load(self, key: Tuple[str, str]) -> Any:
+        if not self.directory:
+            return None
+        for payload_type in _DISK_FORMATS:
+            path = self._disk_path(key, payload_type)
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb") as fr:
+                data = fr.read()
+            if payload_type is bytes:
+                return data
+            if payload_type is str:
+                return data.decode("utf-8")
+            return json.loads(data)
+        return None
+
+    def _store(self, key: Tuple[str, str], payload: Any):
+        if not self.directory or type(payload) not in _DISK_FORMATS:
+            return
+        path = self._disk_path(key, type(payload))
+        if isinstance(payload, str):
+            data = payload.encode("utf-8")
+        elif isinstance(payload, dict):
+            try:
+                data = json.dumps(payload).encode("utf-8")
+            except TypeError:
+                # Dicts of raw bytes are only kept in memory
+                return
+        else:
+            data = payload
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temp file first, so another process never reads a partial payload
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as fw:
+                fw.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to persist the image payload {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+_IMAGE_CACHE = ImagePayloadCache()
+
+
+def configure_image_cache(max_size: int = IMAGE_CACHE_MAX_SIZE, directory: Optional[str] = None) -> ImagePayloadCache:
+    """
+    Replace the image payload cache shared by all LLM clients of the process.
+
+    :param max_size: The bytes of payloads kept in memory.
+    :type max_size: int
+    :param directory: The directory payloads are persisted in, not persisted when None.
+    :type directory: Optional[str]
+    :return: The image payload cache.
+    :rtype: ImagePayloadCache
+    """
+    global _IMAGE_CACHE
+    _IMAGE_CACHE = ImagePayloadCache(max_size=max_size, directory=directory)
+    return _IMAGE_CACHE
+
+
+def get_image_cache() -> ImagePayloadCache:
+    return _IMAGE_CACHE
+
+
+def get_image_info(image) -> dict:
+    """
+    Get the dimensions and the estimated token costs of an input image, see read_image_info.
+    """
+    return _IMAGE_CACHE.get_or_build(image, IMAGE_INFO_KIND, read_image_info)
@@ -0,0 +1,289 @@
+import asyncio
+import functools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple
+
+from ..utils import get_logger
+
+logger = get_logger()
+
+DEFAULT_MAX_CONCURRENCY = 64
+THROTTLE_STATUS_CODES = (429,)
+
+_CURRENT_LIMITER: ContextVar[Optional["RateLimiter"]] = ContextVar("infiagent-rate-limiter", default=None)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at a rate per minute. The level may go negative when the actual cost of a call is
+    higher than reserved, later callers then wait until the debt is paid back.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.capacity = float(rate_per_minute)
+        self.level = self.capacity
+        self._rate = self.capacity / 60.0
+        self._updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    def consume(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    async def take(self, amount: float):
+        # A call costing more than the whole bucket waits for a full bucket instead of forever
+        needed = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.level >= needed:
+                self.level -= amount
+                return
+            await asyncio.sleep((needed - self.level) / self._rate)
+
+
+class RateLimiter:
+    """
+    Process-wide limiter of the calls to one provider and model.
+
+    Calls take a request from the requests per minute bucket and reserve their estimated tokens from the tokens
+    per minute bucket. The reservation is settled with the usage reported in the completion. Concurrency is
+    adapted with AIMD: every successful call raises the limit by 1 / limit, about one more slot per round of
+    calls, and a throttled call (429 or 5xx) multiplies it by decrease_factor, at most once per cooldown.
+    """
+
+    def __init__(self, name: str, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 min_concurrency: int = 1, decrease_factor: float = 0.5, cooldown: float = 1.0):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._limit = float(self.max_concurrency)
+        self._in_flight = 0
+        self._waiters = deque()
+        self._decreased_at = 0.0
+
+    @property
+    def concurrency(self) -> int:
+        return max(self.min_concurrency, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @asynccontextmanager
+    async def limit(self, estimated_tokens: int = 0):
+        """
+        Hold a slot of the limiter during a call. The caller records the usage of the call with
+        slot.record(completion) before leaving the block, throttling errors raised in the block shrink the
+        concurrency.
+
+        :param estimated_tokens: Tokens reserved for the call until its usage is known.
+        :type estimated_tokens: int
+        """
+        await self._acquire_slot()
+        slot = _Slot(estimated_tokens)
+        context_token = _CURRENT_LIMITER.set(self)
+        try:
+            if self._requests is not None:
+                await self._requests.take(1)
+            if self._tokens is not None:
+                await self._tokens.take(estimated_tokens)
+            yield slot
+        except Exception as exception:
+            if is_throttle_error(exception):
+                self.on_throttle()
+            raise
+        else:
+            self.on_success()
+        finally:
+            _CURRENT_LIMITER.reset(context_token)
+            if self._tokens is not None and slot.used_tokens is not None:
+                self._tokens.consume(slot.used_tokens - estimated_tokens)
+            self._release_slot()
+
+    def on_success(self):
+        self._limit = min(float(self.max_concurrency), self._limit + 1.0 / self._limit)
+        self._wake_waiters()
+
+    def on_throttle(self):
+        now = time.monotonic()
+        # The calls in flight when the provider starts throttling all fail, shrink once for the whole burst
+        if now - self._decreased_at < self.cooldown:
+            return
+        self._decreased_at = now
+        self._limit = max(float(self.min_concurrency), self._limit * self.decrease_factor)
+        logger.warning(f"Rate limiter {self.name} is throttled, concurrency reduced to {self.concurrency}")
+
+    def on_retry(self, exception: BaseException):
+        """
+        Account for a retried request, it is sent again without leaving the slot of the call.
+        """
+        if is_throttle_error(exception):
+            self.on_throttle()
+        if self._requests is not None:
+            self._requests.consume(1)
+
+    async def _acquire_slot(self):
+        while self._in_flight >= self.concurrency:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Cancelled after being woken up, e.g. by a timeout, hand the free slot to the next waiter
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_waiters()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self._in_flight += 1
+
+    def _release_slot(self):
+        self._in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        free_slots = self.concurrency - self._in_flight
+        while free_slots > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done() and not waiter.get_loop().is_closed():
+                waiter.set_result(None)
+                free_slots -= 1
+
+
+class _Slot:
+
+    def __init__(self, estimated_tokens: int):
+        self.estimated_tokens = estimated_tokens
+        self.used_tokens = None
+
+    def record(self, completion):
+        prompt_token = getattr(completion, "prompt_token", None) or 0
+        completion_token = getattr(completion, "completion_token", None) or 0
+        if prompt_token or completion_token:
+            self.used_tokens = prompt_token + completion_token
+
+
+def is_throttle_error(exception: BaseException) -> bool:
+    """
+    Whether an error of an LLM SDK means the provider is overloaded, i.e. an HTTP 429 or 5xx response.
+    """
+    for attribute in ("http_status", "status_code", "code"):
+        status = getattr(exception, attribute, None)
+        if isinstance(status, int):
+            return status in THROTTLE_STATUS_CODES or 500 <= status < 600
+    return type(exception).__name__ in ("RateLimitError", "ServiceUnavailableError", "ResourceExhausted")
+
+
+_LIMITERS: Dict[Tuple[str, str], RateLimiter] = {}
+_DEFAULT_LIMITS: dict = {}
+
+
+def configure_rate_limits(**limits):
+    """
+    Set the default limits of the limiters created afterwards, see RateLimiter for the options. The rate_limit
+    section of an LLM config overrides them for its model.
+    """
+    _DEFAULT_LIMITS.update(limits)
+
+
+def get_rate_limiter(provider: str, model_name: str, **limits) -> RateLimiter:
+    """
+    Get the limiter shared by all clients of a provider and model, it is created with the given limits on the
+    first call.
+
+    :param provider: The provider, e.g. the API base URL.
+    :type provider: str
+    :param model_name: The model name.
+    :type model_name: str
+    :return: The rate limiter.
+    :rtype: RateLimiter
+    """
+    key = (provider, model_name)
+    limiter = _LIMITERS.get(key)
+    if limiter is None:
+        limiter = RateLimiter(name=f"{provider}/{model_name}", **{**_DEFAULT_LIMITS, **limits})
+        _LIMITERS[key] = limiter
+    return limiter
+
+
+def rate_limited(async_completion: Callable) -> Callable:
+    """
+    Run an async_completion method under the rate limiter of its LLM, BaseLLM applies it to every subclass.
+    """
+    @functools.wraps(async_completion)
+    async def wrapper(self, prompt, *args, **kwargs):
+        limiter = self.rate_limiter
+        if _CURRENT_LIMITER.get() is limiter:
+            # An override calling the completion of its parent already holds the slot
+            return await async_completion(self, prompt, *args, **kwargs)
+        # Tokens per minute are reserved with the prompt token count before the usage of the call is known
+        estimated_tokens = self.token_budget.count(prompt) if isinstance(prompt, str) else 0
+        async with limiter.limit(estimated_tokens) as slot:
+            completion = await async_completion(self, prompt, *args, **kwargs)
+            slot.record(completion)
+        return completion
+
+    return wrapper
+
+
+def rate_limited_stream(async_stream_completion: Callable) -> Callable:
+    """
+    Run an async_stream_completion method under the rate limiter of its LLM, the slot is held until the stream is
+    exhausted or closed. A stream closed early by its consumer counts as a successful call.
+    """
+    @functools.wraps(async_stream_completion)
+    async def wrapper(self, prompt, *args, **kwargs) -> AsyncIterator[str]:
+        limiter = self.rate_limiter
+        if _CURRENT_LIMITER.get() is limiter:
+            async for delta in async_stream_completion(self, prompt, *args, **kwargs):
+                yield delta
+            return
+        estimated_tokens = self.token_budget.count(prompt) if isinstance(prompt, str) else 0
+        async with limiter.limit(estimated_tokens) as slot:
+            stream = async_stream_completion(self, prompt, *args, **kwargs)
+            deltas = []
+            try:
+                async for delta in stream:
+                    deltas.append(delta)
+                    try:
+                        yield delta
+                    except GeneratorExit:
+                        # Leave the limiter normally, a GeneratorExit passing through it is not a success
+                        break
+            finally:
+                await stream.aclose()
+                # Streams report no usage, the completion tokens are counted with the tokenizer of the model
+                slot.used_tokens = estimated_tokens + self.token_budget.count("".join(deltas))
+
+    return wrapper
+
+
+def before_sleep_throttle(callback: Optional[Callable] = None) -> Callable:
+    """
+    Tenacity before_sleep hook telling the limiter of the running call about a failed attempt, so the retries of
+    all sessions back off together instead of each hammering the provider on its own.
+
+    :param callback: Another before_sleep hook called afterwards, e.g. before_sleep_log.
+    :type callback: Optional[Callable]
+    """
+    def _before_sleep(retry_state):
+        limiter = _CURRENT_LIMITER.get()
+        if limiter is not None and retry_state.outcome is not None and retry_state.outcome.failed:
+            limiter.on_retry(retry_state.outcome.exception())
+        if callback is not None:
+            callback(retry_state)
+
+    return _before_sleep
@@ -0,0 +1,223 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from contextvars import ContextVar
+from typing import Callable, List, Optional
+
+from ..exceptions.exceptions import InputErrorException, LLMCacheMissException
+from ..schemas import BaseCompletion
+from ..utils import get_logger
+from ..utils.file_utils import file_content_hash
+from .image_cache import get_image_path
+
+logger = get_logger()
+
+root_directory = os.path.abspath(__file__)
+while 'infiagent' not in os.path.basename(root_directory):
+    root_directory = os.path.dirname(root_directory)
+
+CACHE_MODE_OFF = "off"
+# Always call the LLM and store the response
+CACHE_MODE_RECORD = "record"
+# Serve stored responses, call the LLM and store the response on a miss
+CACHE_MODE_REPLAY = "replay"
+# Serve stored responses, fail on a miss without calling the LLM
+CACHE_MODE_REPLAY_OR_FAIL = "replay_or_fail"
+CACHE_MODES = [CACHE_MODE_OFF, CACHE_MODE_RECORD, CACHE_MODE_REPLAY, CACHE_MODE_REPLAY_OR_FAIL]
+
+# Bump the version when the key or the stored value changes, older entries are then never hit
+RESPONSE_CACHE_VERSION = "v1"
+RESPONSE_CACHE_PATH = f"{root_directory}/tmp/llm_response_cache.sqlite"
+RESPONSE_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+# Eviction frees space down to this fraction of the max size, so it doesn't run on every insert
+RESPONSE_CACHE_EVICT_TO = 0.9
+# Completions in these states are not stored, a replay calls the LLM again
+UNCACHED_STATES = ("error", "fail")
+
+# Sandbox ids are random per session, they are masked so a re-run prompts the same text
+_SANDBOX_PATH_PATTERN = re.compile(r"upload_files/[^/\s'\"]+/")
+_SANDBOX_PATH_MASK = "upload_files/<sandbox>/"
+
+_IN_CACHED_COMPLETION: ContextVar[bool] = ContextVar("infiagent-cached-completion", default=False)
+
+
+class ResponseCache:
+    """
+    On-disk cache of LLM completions in a sqlite file.
+
+    Completions are keyed by the model name, the sampling params, the prompt and the content hashes of the input
+    images. Values are zlib compressed JSON. When the stored values exceed max_size bytes the least recently used
+    entries are evicted.
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, mode: str = CACHE_MODE_REPLAY,
+                 max_size: int = RESPONSE_CACHE_MAX_SIZE):
+        if mode not in CACHE_MODES:
+            raise InputErrorException(f"Invalid LLM cache mode {mode}, expect one of {CACHE_MODES}")
+        self.path = path
+        self.mode = mode
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Shard workers of eval.py share the file, WAL lets them read while one of them writes
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                                 "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                                 "accessed_at REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key: str) -> Optional[BaseCompletion]:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return BaseCompletion(**json.loads(zlib.decompress(row[0])))
+
+    def put(self, key: str, completion: BaseCompletion):
+        value = zlib.compress(json.dumps(completion.to_dict(), ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            row = self._connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._connection.execute("INSERT OR REPLACE INTO responses (key, value, size, accessed_at) "
+                                     "VALUES (?, ?, ?, ?)", (key, value, len(value), time.time()))
+            self._size += len(value) - (row[0] if row else 0)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        target = int(self.max_size * RESPONSE_CACHE_EVICT_TO)
+        # Other processes may have written to the file since the size was counted
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        evicted = 0
+        rows = self._connection.execute("SELECT key, size FROM responses ORDER BY accessed_at, rowid").fetchall()
+        for key, size in rows:
+            if self._size <= target:
+                break
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._size -= size
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} LLM responses from {self.path}, {self._size} bytes left")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def make_key(model_name: str, params: dict, prompt: str, input_imgs: Optional[List] = None,
+                 **kwargs) -> str:
+        """
+        Make the cache key of a completion.
+
+        :param model_name: The model name.
+        :type model_name: str
+        :param params: The sampling params of the LLM.
+        :type params: dict
+        :param prompt: The composed prompt.
+        :type prompt: str
+        :param input_imgs: The input images, MediaFile objects, hashed by content.
+        :type input_imgs: Optional[List]
+        :param kwargs: The extra arguments of the completion.
+        :return: The key.
+        :rtype: str
+        """
+        key_data = {
+            "version": RESPONSE_CACHE_VERSION,
+            "model_name": model_name,
+            "params": params,
+            "prompt": _SANDBOX_PATH_PATTERN.sub(_SANDBOX_PATH_MASK, prompt),
+            "images": [_image_hash(image) for image in input_imgs or []],
+            "kwargs": kwargs,
+        }
+        key_json = json.dumps(key_data, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(key_json.encode("utf-8")).hexdigest()
+
+
+def _image_hash(image) -> str:
+    if isinstance(image, str):
+        return _SANDBOX_PATH_PATTERN.sub(_SANDBOX_PATH_MASK, image)
+    # The same file as the image clients read, so the key doesn't depend on the progress of the staging
+    image_path = get_image_path(image)
+    if isinstance(image_path, str) and os.path.isfile(image_path):
+        return file_content_hash(image_path)
+    # Images that are not on disk are keyed by name
+    return getattr(image, "open_path", None) or getattr(image, "file_name", None) or str(image)
+
+
+_RESPONSE_CACHE: Optional[ResponseCache] = None
+
+
+def configure_response_cache(mode: str = CACHE_MODE_REPLAY, path: str = RESPONSE_CACHE_PATH,
+                             max_size: int = RESPONSE_CACHE_MAX_SIZE) -> Optional[ResponseCache]:
+    """
+    Enable the response cache for all LLM clients of the process, mode off disables it.
+
+    :return: The response cache, None when it is off.
+    :rtype: Optional[ResponseCache]
+    """
+    global _RESPONSE_CACHE
+    if _RESPONSE_CACHE is not None:
+        _RESPONSE_CACHE.close()
+        _RESPONSE_CACHE = None
+    if mode != CACHE_MODE_OFF:
+        _RESPONSE_CACHE = ResponseCache(path=path, mode=mode, max_size=max_size)
+    return _RESPONSE_CACHE
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    return _RESPONSE_CACHE
+
+
+def cached(async_completion: Callable) -> Callable:
+    """
+    Serve an async_completion method from the response cache when it is enabled, BaseLLM applies it to every
+    subclass. Cache hits skip the rate limiter.
+    """
+    @functools.wraps(async_completion)
+    async def wrapper(self, prompt, *args, **kwargs):
+        cache = _RESPONSE_CACHE
+        if cache is None or _IN_CACHED_COMPLETION.get():
+            return await async_completion(self, prompt, *args, **kwargs)
+
+        key_kwargs = dict(kwargs)
+        input_imgs = key_kwargs.pop("input_imgs", None)
+        if args:
+            input_imgs, key_args = args[0], args[1:]
+        else:
+            key_args = ()
+        key = ResponseCache.make_key(self.model_name, self.params, prompt, input_imgs, args=key_args, **key_kwargs)
+        if cache.mode != CACHE_MODE_RECORD:
+            completion = cache.get(key)
+            if completion is not None:
+                cache.hits += 1
+                return completion
+            cache.misses += 1
+            if cache.mode == CACHE_MODE_REPLAY_OR_FAIL:
+                raise LLMCacheMissException(f"No cached response of {self.model_name} for the prompt, "
+                                            f"key {key}")
+
+        context_token = _IN_CACHED_COMPLETION.set(True)
+        try:
+            completion = await async_completion(self, prompt, *args, **kwargs)
+        finally:
+            _IN_CACHED_COMPLETION.reset(context_token)
+        if isinstance(completion, BaseCompletion) and completion.state not in UNCACHED_STATES:
+            cache.put(key, completion)
+        return completion
+
+    return wrapper
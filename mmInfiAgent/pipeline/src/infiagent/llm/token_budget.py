@@ -0,0 +1,261 @@
+import functools
+import math
+import re
+from typing import List, Optional, Tuple
+
+from ..utils import get_logger
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = get_logger()
+
+# Context windows by model name prefix, the longest matching prefix wins. The context_window param of an LLM
+# config overrides them.
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4-1106": 128000,
+    "gpt-4-0125": 128000,
+    "gpt-4-vision": 128000,
+    "gpt-4-32k": 32768,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-35-turbo-16k": 16385,
+    "gpt-3.5-turbo": 4096,
+    "gpt-35-turbo": 4096,
+    "claude-3": 200000,
+    "claude3": 200000,
+    "claude": 100000,
+    "gemini-1.5": 1048576,
+    "gemini-pro": 30720,
+    "gemini": 30720,
+    "qwen-vl": 6000,
+}
+# Without a known context window, the max_tokens param is read as the context window, like the former character
+# budget did
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Marker put in place of the text dropped from a prompt
+TRUNCATION_MARKER = "\n...[truncated]...\n"
+
+
+class Tokenizer:
+    """
+    Token counter of a model. Counts of recent texts are cached, as a prompt is counted by the agent, the rate
+    limiter and the client.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = functools.lru_cache(maxsize=64)(self._count)
+
+    def _count(self, text: str) -> int:
+        raise NotImplementedError
+
+    def head(self, text: str, max_tokens: int) -> str:
+        """The longest start of the text within max_tokens tokens."""
+        raise NotImplementedError
+
+    def tail(self, text: str, max_tokens: int) -> str:
+        """The longest end of the text within max_tokens tokens."""
+        raise NotImplementedError
+
+
+class TiktokenTokenizer(Tokenizer):
+
+    def __init__(self, encoding):
+        super().__init__(encoding.name)
+        self._encoding = encoding
+
+    def _count(self, text: str) -> int:
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def head(self, text: str, max_tokens: int) -> str:
+        tokens = self._encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else self._encoding.decode(tokens[:max(max_tokens, 0)])
+
+    def tail(self, text: str, max_tokens: int) -> str:
+        tokens = self._encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return self._encoding.decode(tokens[len(tokens) - max(max_tokens, 0):])
+
+
+# Words, CJK characters, single punctuation marks and whitespace runs, close to how BPE vocabularies split text
+_PIECE_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]|[^\W_]+|\s+|[^\w\s]|_")
+# Characters per token of a long word
+_CHARS_PER_WORD_TOKEN = 4
+
+
+class ApproximateTokenizer(Tokenizer):
+    """
+    Token counter for models without a local tokenizer. A word costs a token per 4 characters, every CJK
+    character and punctuation mark a token, and a whitespace run other than a single space a token.
+    """
+
+    def __init__(self):
+        super().__init__("approximate")
+
+    @staticmethod
+    def _piece_tokens(piece: str) -> int:
+        if piece == " ":
+            # Merged into the following word
+            return 0
+        if piece[0].isspace() or len(piece) == 1:
+            return 1
+        return math.ceil(len(piece) / _CHARS_PER_WORD_TOKEN)
+
+    def _pieces(self, text: str) -> List[Tuple[int, int]]:
+        return [(match.end(), self._piece_tokens(match.group())) for match in _PIECE_PATTERN.finditer(text)]
+
+    def _count(self, text: str) -> int:
+        return sum(self._piece_tokens(match.group()) for match in _PIECE_PATTERN.finditer(text))
+
+    def head(self, text: str, max_tokens: int) -> str:
+        used, end = 0, 0
+        for piece_end, tokens in self._pieces(text):
+            if used + tokens > max_tokens:
+                break
+            used, end = used + tokens, piece_end
+        return text[:end]
+
+    def tail(self, text: str, max_tokens: int) -> str:
+        pieces = self._pieces(text)
+        used, start = 0, len(text)
+        for index in range(len(pieces) - 1, -1, -1):
+            tokens = pieces[index][1]
+            if used + tokens > max_tokens:
+                break
+            used, start = used + tokens, pieces[index - 1][0] if index > 0 else 0
+        return text[start:]
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model_name: str) -> Tokenizer:
+    """
+    Get the tokenizer of a model, loaded once per model. tiktoken is used when it is installed, with the encoding
+    of OpenAI models or cl100k_base as an approximation for the others, otherwise the counts are estimated.
+
+    :param model_name: The model name.
+    :type model_name: str
+    :return: The tokenizer.
+    :rtype: Tokenizer
+    """
+    if tiktoken is not None:
+        try:
+            return TiktokenTokenizer(tiktoken.encoding_for_model(model_name))
+        except KeyError:
+            pass
+        try:
+            return TiktokenTokenizer(tiktoken.get_encoding("cl100k_base"))
+        except Exception as e:
+            # The encoding files are downloaded on first use, which fails offline
+            logger.warning(f"Failed to load the tiktoken encoding for {model_name}, estimating token counts: {e}")
+    return ApproximateTokenizer()
+
+
+def get_context_window(model_name: str, params: Optional[dict] = None) -> int:
+    """
+    Get the context window of a model, from the context_window param, the known models or the max_tokens param.
+    """
+    params = params or {}
+    if params.get("context_window"):
+        return int(params["context_window"])
+    name = (model_name or "").lower()
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if name.startswith(prefix)]
+    if matches:
+        return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+    return int(params.get("max_tokens", DEFAULT_CONTEXT_WINDOW))
+
+
+def estimate_image_tokens(width: int, height: int, provider: str) -> int:
+    """
+    Estimate the prompt tokens of an image from the published sizing rules of a provider.
+
+    :param width: The image width in pixels.
+    :type width: int
+    :param height: The image height in pixels.
+    :type height: int
+    :param provider: openai (high detail), claude, gemini or qwen.
+    :type provider: str
+    :return: The estimated tokens.
+    :rtype: int
+    """
+    if provider == "openai":
+        # Fit in 2048x2048, scale the shorter side down to 768, then 170 tokens per 512px tile and 85 base tokens
+        scale = min(1.0, 2048 / max(width, height))
+        if min(width, height) * scale > 768:
+            scale = 768 / min(width, height)
+        tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+        return 170 * tiles + 85
+    if provider == "claude":
+        # Longer edge scaled down to 1568 pixels, about 750 pixels per token
+        scale = min(1.0, 1568 / max(width, height))
+        return math.ceil(width * scale * height * scale / 750)
+    if provider == "gemini":
+        return 258
+    if provider == "qwen":
+        return 256
+    raise ValueError(f"Unknown image token sizing of provider {provider}")
+
+
+class TokenBudget:
+    """
+    Token budget of the prompts of a model, the context window minus the tokens reserved for the completion.
+    """
+
+    def __init__(self, model_name: str, max_prompt_tokens: int):
+        self.model_name = model_name
+        self.max_prompt_tokens = max(max_prompt_tokens, 1)
+        self.tokenizer = get_tokenizer(model_name)
+
+    @classmethod
+    def create(cls, model_name: str, params: Optional[dict] = None, max_gen_length: int = 0) -> "TokenBudget":
+        """
+        Create the budget of a model.
+
+        :param model_name: The model name.
+        :type model_name: str
+        :param params: The LLM params, see get_context_window.
+        :type params: Optional[dict]
+        :param max_gen_length: The tokens reserved for the completion.
+        :type max_gen_length: int
+        :return: The budget.
+        :rtype: TokenBudget
+        """
+        context_window = get_context_window(model_name, params)
+        # A generation length reserved for a larger model must not leave a small one without room for the prompt
+        return cls(model_name, max(context_window - max_gen_length, context_window // 2))
+
+    def count(self, text: str) -> int:
+        return self.tokenizer.count(text)
+
+    def fits(self, text: str) -> bool:
+        return self.count(text) <= self.max_prompt_tokens
+
+    def truncate(self, text: str, max_tokens: Optional[int] = None, head_fraction: float = 0.5) -> Tuple[str, int]:
+        """
+        Cut the middle of a text to fit it in max_tokens tokens, the budget by default. The start of a prompt holds
+        the instructions and the end the latest steps, so both are kept.
+
+        :param text: The text to fit.
+        :type text: str
+        :param max_tokens: The token limit.
+        :type max_tokens: Optional[int]
+        :param head_fraction: The fraction of the limit kept from the start of the text.
+        :type head_fraction: float
+        :return: The text within the limit and its token count.
+        :rtype: Tuple[str, int]
+        """
+        max_tokens = self.max_prompt_tokens if max_tokens is None else max_tokens
+        token_count = self.count(text)
+        if token_count <= max_tokens:
+            return text, token_count
+        available = max(max_tokens - self.count(TRUNCATION_MARKER), 0)
+        head_tokens = int(available * head_fraction)
+        truncated = self.tokenizer.head(text, head_tokens) + TRUNCATION_MARKER + \
+            self.tokenizer.tail(text, available - head_tokens)
+        return truncated, self.count(truncated)
@@ -0,0 +1,273 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import importlib.util
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import AsyncIterator, Callable, Dict, Optional, Type
+
+import aiohttp
+import httpx
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+@dataclass(frozen=True)
+class TransportConfig:
+    """
+    Connection pool limits shared by all LLM clients of the process.
+    """
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 10.0
+    request_timeout: float = 600.0
+    # Only used by the httpx transport, and only when the h2 package is installed
+    http2: bool = True
+    # Threads running the calls of SDKs without an async API, see run_blocking
+    sdk_max_workers: int = 32
+
+
+@dataclass(frozen=True)
+class LLMCredentials:
+    """
+    Endpoint and credentials of one LLM client. They are passed with every request, so clients of different
+    backends can coexist in one process instead of overwriting the module globals of the SDKs.
+    """
+    api_key: Optional[str] = None
+    api_base: Optional[str] = None
+    api_type: Optional[str] = None
+    api_version: Optional[str] = None
+
+    def openai_kwargs(self) -> dict:
+        """The per request arguments of the openai SDK, unset fields fall back to the SDK defaults."""
+        return {key: value for key, value in self.__dict__.items() if value is not None}
+
+
+_CONFIG = TransportConfig()
+# Pooled clients are bound to the event loop they were created in, eval.py and the tests run several loops
+_AIOHTTP_SESSIONS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = \
+    weakref.WeakKeyDictionary()
+_HTTPX_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Type, httpx.AsyncClient]]" = \
+    weakref.WeakKeyDictionary()
+_SDK_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_SDK_EXECUTOR_LOCK = threading.Lock()
+
+
+def configure_transport(**kwargs) -> TransportConfig:
+    """
+    Update the connection pool limits, see TransportConfig for the options. Clients pooled before the call keep
+    their limits until close_transport.
+
+    :return: The new transport config.
+    :rtype: TransportConfig
+    """
+    global _CONFIG
+    _CONFIG = replace(_CONFIG, **kwargs)
+    return _CONFIG
+
+
+def get_transport_config() -> TransportConfig:
+    return _CONFIG
+
+
+def get_aiohttp_session() -> aiohttp.ClientSession:
+    """
+    Get the keep-alive aiohttp session of the running event loop, it is the transport of the async openai calls.
+    """
+    loop = asyncio.get_running_loop()
+    session = _AIOHTTP_SESSIONS.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=_CONFIG.max_connections,
+                                         keepalive_timeout=_CONFIG.keepalive_expiry,
+                                         ttl_dns_cache=300)
+        session = aiohttp.ClientSession(connector=connector)
+        _AIOHTTP_SESSIONS[loop] = session
+    return session
+
+
+def get_httpx_client(client_class: Type = httpx.AsyncClient):
+    """
+    Get the keep-alive httpx client of the running event loop. HTTP/2 is negotiated when the h2 package is
+    installed.
+
+    :param client_class: The client class, SDKs that vendor their own httpx build pass their client class, e.g.
+        anthropic.DefaultAsyncHttpxClient.
+    :type client_class: Type
+    :return: The pooled client.
+    :rtype: httpx.AsyncClient
+    """
+    loop = asyncio.get_running_loop()
+    clients = _HTTPX_CLIENTS.setdefault(loop, {})
+    client = clients.get(client_class)
+    if client is None or client.is_closed:
+        httpx_module = _get_httpx_module(client_class)
+        client = client_class(
+            http2=_CONFIG.http2 and _HTTP2_AVAILABLE,
+            limits=httpx_module.Limits(max_connections=_CONFIG.max_connections,
+                                       max_keepalive_connections=_CONFIG.max_keepalive_connections,
+                                       keepalive_expiry=_CONFIG.keepalive_expiry),
+            timeout=httpx_module.Timeout(_CONFIG.request_timeout, connect=_CONFIG.connect_timeout))
+        clients[client_class] = client
+    return client
+
+
+def _get_httpx_module(client_class: Type):
+    # Limits and Timeout must come from the httpx package the client class is built on
+    for base in client_class.__mro__:
+        if base.__name__ == "AsyncClient":
+            return importlib.import_module(base.__module__.split(".")[0])
+    return httpx
+
+
+async def openai_chat_completion(credentials: LLMCredentials, **kwargs):
+    """
+    Call openai.ChatCompletion.acreate with the credentials of a client on the pooled aiohttp session. Without a
+    session the SDK opens and closes a new one, and a TLS connection, for every request.
+    """
+    token = openai.aiosession.set(get_aiohttp_session())
+    try:
+        return await openai.ChatCompletion.acreate(**credentials.openai_kwargs(), **kwargs)
+    finally:
+        openai.aiosession.reset(token)
+
+
+async def iter_openai_deltas(response) -> AsyncIterator[str]:
+    """
+    Yield the content deltas of a streamed openai chat completion, see openai_chat_completion with stream=True.
+    Closing the iterator early closes the response, so the server stops generating.
+    """
+    try:
+        async for chunk in response:
+            if chunk.get("choices"):
+                delta = chunk["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+    finally:
+        await response.aclose()
+
+
+def openai_chat_completion_sync(credentials: LLMCredentials, **kwargs):
+    """
+    Call openai.ChatCompletion.create with the credentials of a client. The SDK keeps a session per thread, its
+    pool is sized by _make_requests_session.
+    """
+    return openai.ChatCompletion.create(**credentials.openai_kwargs(), **kwargs)
+
+
+def get_sdk_executor() -> ThreadPoolExecutor:
+    """
+    Get the executor of the blocking SDK calls, its threads are only used by run_blocking.
+    """
+    global _SDK_EXECUTOR
+    with _SDK_EXECUTOR_LOCK:
+        if _SDK_EXECUTOR is None:
+            _SDK_EXECUTOR = ThreadPoolExecutor(max_workers=_CONFIG.sdk_max_workers, thread_name_prefix="llm-sdk")
+        return _SDK_EXECUTOR
+
+
+# The time.time() deadline of the question the LLM requests of the running task are made for
+_REQUEST_DEADLINE: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("infiagent-request-deadline",
+                                                                                    default=None)
+
+
+@contextlib.contextmanager
+def request_deadline(deadline: Optional[float]):
+    """
+    Bound the timeouts of the LLM requests made in the block, and in the tasks it starts, by a time.time() deadline.
+    """
+    token = _REQUEST_DEADLINE.set(deadline)
+    try:
+        yield
+    finally:
+        _REQUEST_DEADLINE.reset(token)
+
+
+def get_request_deadline() -> Optional[float]:
+    return _REQUEST_DEADLINE.get()
+
+
+def get_request_timeout(timeout: Optional[float] = None) -> Optional[float]:
+    """
+    Get the timeout of an LLM request, lowered to the time left until the deadline of its question.
+
+    :param timeout: The timeout of the client, None for no timeout.
+    :type timeout: Optional[float]
+    :return: The timeout in seconds, None for no timeout.
+    :rtype: Optional[float]
+    """
+    deadline = _REQUEST_DEADLINE.get()
+    if deadline is None:
+        return timeout
+    remaining = max(0.0, deadline - time.time())
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+async def run_blocking(fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+    """
+    Run a blocking SDK call in the bounded SDK executor, so it doesn't block the event loop and the sessions of
+    other questions. Calls beyond sdk_max_workers wait in the executor queue.
+
+    On a timeout or a cancellation of the caller, a call still queued is dropped. A call already running can't be
+    interrupted, it finishes in its thread and its result is discarded.
+
+    :param fn: The blocking function.
+    :type fn: Callable
+    :param timeout: Seconds to wait for the call, including its time in the queue, request_timeout by default. It
+        is lowered to the time left until the request deadline.
+    :type timeout: Optional[float]
+    :return: The result of the call.
+    :raises asyncio.TimeoutError: If the call didn't finish in time.
+    """
+    # The context carries the rate limiter of the running completion to the tenacity hooks of the SDK call
+    context = contextvars.copy_context()
+    future = get_sdk_executor().submit(context.run, functools.partial(fn, *args, **kwargs))
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future),
+                                      timeout=get_request_timeout(_CONFIG.request_timeout if timeout is None
+                                                                  else timeout))
+    finally:
+        future.cancel()
+
+
+async def close_transport():
+    """
+    Close the pooled clients of the running event loop, call it before the loop is closed.
+    """
+    loop = asyncio.get_running_loop()
+    session = _AIOHTTP_SESSIONS.pop(loop, None)
+    if session is not None and not session.closed:
+        await session.close()
+    for client in _HTTPX_CLIENTS.pop(loop, {}).values():
+        if not client.is_closed:
+            await client.aclose()
+
+
+def shutdown_sdk_executor():
+    """
+    Stop the threads of the SDK executor once no more calls are made, queued calls are dropped.
+    """
+    global _SDK_EXECUTOR
+    with _SDK_EXECUTOR_LOCK:
+        executor, _SDK_EXECUTOR = _SDK_EXECUTOR, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _make_requests_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=_CONFIG.max_keepalive_connections, pool_maxsize=_CONFIG.max_connections)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# The openai SDK calls the factory once per thread
+openai.requestssession = _make_requests_session
@@ -1,4 +1,5 @@
 from .prompt_template import *
 from .simple_react_prompt import SimpleReactPrompt
 from .zero_shot_react_prompt import ZeroShotReactPrompt
+from .prompt_builder import PromptBuilder
 # from .qwenvl_react_prompt import QWenVLReactPrompt
\ No newline at end of file
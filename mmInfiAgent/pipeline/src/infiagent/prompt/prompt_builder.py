@@ -0,0 +1,143 @@
+import dataclasses
+from typing import TYPE_CHECKING, List, Optional
+
+from .prompt_template import PromptTemplate
+from ..schemas import AgentObservation, BaseAgentResponse
+
+if TYPE_CHECKING:
+    from ..llm.token_budget import TokenBudget
+
+# Observations of old steps are cut to this many tokens before old steps are dropped
+CONDENSED_OBSERVATION_TOKENS = 64
+CONDENSED_OBSERVATION_SUFFIX = " ...[condensed]"
+# Put in place of the dropped steps
+OMITTED_STEPS_MARKER = "\n[{} earlier steps omitted]\n"
+# The latest action and its observation are never condensed or dropped
+KEEP_LATEST_STEPS = 2
+
+
+class PromptBuilder:
+    """
+    Incremental prompt of a conversation.
+
+    The template is formatted once per conversation. Each agent step is rendered once when it is appended, and the
+    prompt of a round is the cached prefix followed by the rendered steps, so a round costs a single join instead
+    of rebuilding the scratchpad and re-formatting the template.
+
+    With a token budget, the steps are counted once when they are appended. A prompt over the budget keeps the
+    template and the latest steps, the oldest observations are condensed first and then the oldest steps dropped.
+    """
+
+    def __init__(self, prompt_template: PromptTemplate, **kwargs):
+        """
+        :param prompt_template: The template of the agent.
+        :type prompt_template: PromptTemplate
+        :param kwargs: The template variables except the scratchpad, they must not change during the conversation.
+        """
+        self._prompt_template = prompt_template
+        self._variables = kwargs
+        self._prefix, self._suffix = prompt_template.format_parts(**kwargs)
+        self._responses: List[BaseAgentResponse] = []
+        self._steps: List[str] = []
+        self._prompt: Optional[str] = None
+        self._budget: Optional["TokenBudget"] = None
+        self._fitted_prompt: Optional[str] = None
+        self._token_count: Optional[int] = None
+        self._fixed_tokens = 0
+        self._step_tokens: List[int] = []
+
+    @property
+    def prefix(self) -> str:
+        """
+        The part of the prompt before the scratchpad. It is the same in every round, so backends caching prompt
+        prefixes can reuse it.
+        """
+        return self._prefix
+
+    @property
+    def variables(self) -> dict:
+        return self._variables
+
+    @property
+    def step_count(self) -> int:
+        return len(self._steps)
+
+    @property
+    def scratchpad(self) -> str:
+        return "".join(self._steps)
+
+    @property
+    def token_count(self) -> Optional[int]:
+        """
+        The token count of the prompt last built with a budget, for telemetry. When the prompt fits, it is the sum
+        of the counts of its parts.
+        """
+        return self._token_count
+
+    def append(self, agent_response: BaseAgentResponse):
+        self._responses.append(agent_response)
+        self._steps.append(self._prompt_template.construct_step(agent_response))
+        self._prompt = None
+        self._fitted_prompt = None
+
+    def build(self, budget: Optional["TokenBudget"] = None) -> str:
+        """
+        Build the prompt of the round.
+
+        :param budget: The token budget of the LLM, the prompt is not fitted without it.
+        :type budget: Optional[TokenBudget]
+        :return: The prompt.
+        :rtype: str
+        """
+        if self._prompt is None:
+            self._prompt = "".join([self._prefix, *self._steps, self._suffix])
+        if budget is None:
+            return self._prompt
+        if self._fitted_prompt is None or self._budget is not budget:
+            self._fitted_prompt, self._token_count = self._fit(budget)
+        return self._fitted_prompt
+
+    def _fit(self, budget: "TokenBudget"):
+        if self._budget is not budget:
+            self._budget = budget
+            self._fixed_tokens = budget.count(self._prefix) + budget.count(self._suffix)
+            self._step_tokens = []
+        self._step_tokens.extend(budget.count(step) for step in self._steps[len(self._step_tokens):])
+
+        total = self._fixed_tokens + sum(self._step_tokens)
+        if total <= budget.max_prompt_tokens:
+            return self._prompt, total
+
+        steps, step_tokens = list(self._steps), list(self._step_tokens)
+        kept_from = max(len(steps) - KEEP_LATEST_STEPS, 0)
+        for index in range(kept_from):
+            if total <= budget.max_prompt_tokens:
+                break
+            if isinstance(self._responses[index], AgentObservation):
+                steps[index] = self._condense(self._responses[index], budget)
+                condensed_tokens = budget.count(steps[index])
+                total -= step_tokens[index] - condensed_tokens
+                step_tokens[index] = condensed_tokens
+
+        dropped = 0
+        marker_tokens = 0
+        while total + marker_tokens > budget.max_prompt_tokens and dropped < kept_from:
+            total -= step_tokens[dropped]
+            dropped += 1
+            marker_tokens = budget.count(OMITTED_STEPS_MARKER.format(dropped))
+        if 0 < dropped < kept_from and isinstance(self._responses[dropped], AgentObservation):
+            # An observation is not kept without its action
+            total -= step_tokens[dropped]
+            dropped += 1
+        marker = OMITTED_STEPS_MARKER.format(dropped) if dropped else ""
+
+        prompt = "".join([self._prefix, marker, *steps[dropped:], self._suffix])
+        # The template and the latest steps alone may exceed the budget, their middle is cut then
+        return budget.truncate(prompt)
+
+    def _condense(self, observation: AgentObservation, budget: "TokenBudget") -> str:
+        formatted_output = budget.tokenizer.head(observation.formatted_output, CONDENSED_OBSERVATION_TOKENS)
+        if formatted_output != observation.formatted_output:
+            formatted_output += CONDENSED_OBSERVATION_SUFFIX
+        return self._prompt_template.construct_step(dataclasses.replace(observation,
+                                                                        formatted_output=formatted_output))
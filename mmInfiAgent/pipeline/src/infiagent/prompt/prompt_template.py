@@ -16,6 +16,9 @@ DEFAULT_OBSERVATION = "Observation:"
 DEFAULT_THOUGHT = "Thought:"
 DEFAULT_FINAL_ANSWER = "Final Answer:"
 
+SCRATCHPAD_KEY = "agent_scratchpad"
+_SCRATCHPAD_PLACEHOLDER = "\x00agent_scratchpad\x00"
+
 
 class PromptTemplate(BaseModel, ABC):
     _input_variables: List[str]
@@ -53,21 +56,32 @@ class PromptTemplate(BaseModel, ABC):
 
         return self._template.format(**filtered_kwargs)
 
+    def format_parts(self, **kwargs) -> Tuple[str, str]:
+        """
+        Format the template around the scratchpad. Return the text before and after the scratchpad, the text
+        before it is the same in every round of a conversation.
+        """
+        formatted = self.format(**kwargs, **{SCRATCHPAD_KEY: _SCRATCHPAD_PLACEHOLDER})
+        if _SCRATCHPAD_PLACEHOLDER not in formatted:
+            return formatted, ""
+        prefix, suffix = formatted.split(_SCRATCHPAD_PLACEHOLDER, 1)
+        return prefix, suffix
+
+    def construct_step(self, agent_response: BaseAgentResponse) -> str:
+        """Construct the part of the scratchpad for a single agent step."""
+        if isinstance(agent_response, AgentAction):
+            # for agent action, use thought
+            return agent_response.raw_output
+        elif isinstance(agent_response, AgentObservation):
+            # for agent observation use observation
+            return f"\n{self.keywords.get(OBSERVATION_KEY, DEFAULT_OBSERVATION)}\n" \
+                   f"{agent_response.formatted_output}\n\n" \
+                   f"{self.keywords.get(THOUGHT_KEY, DEFAULT_THOUGHT)}\n"
+        return ""
+
     def construct_scratchpad(self, intermediate_steps: List[BaseAgentResponse]) -> str:
         """Construct the scratchpad that lets the agent continue its thought process."""
-        thoughts = ""
-
-        for agent_response in intermediate_steps:
-            if isinstance(agent_response, AgentAction):
-                # for agent action, use thought
-                thoughts += agent_response.raw_output
-            elif isinstance(agent_response, AgentObservation):
-                # for agent observation use observation
-                thoughts += f"\n{self.keywords.get(OBSERVATION_KEY, DEFAULT_OBSERVATION)}\n" \
-                            f"{agent_response.formatted_output}\n\n" \
-                            f"{self.keywords.get(THOUGHT_KEY, DEFAULT_THOUGHT)}\n"
-
-        return thoughts
+        return "".join(self.construct_step(agent_response) for agent_response in intermediate_steps)
 
     @classmethod
     @root_validator(skip_on_failure=True)
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import abc
+import time
 from dataclasses import dataclass, field
 from enum import Enum
 from typing import List, NamedTuple, Optional, Union
@@ -73,6 +74,74 @@ class AgentOutput(BaseModel):
     token_usage: int
 
 
+@dataclass
+class QuestionBudget:
+    """
+    The resources answering one question may use, None for no limit. The agent checks the budget before every LLM
+    and sandbox call, bounds their timeouts by the time left, and finishes once the budget is exhausted.
+
+    :param max_seconds: Wall clock seconds of the question, counted from the creation of the budget.
+    :param max_tokens: Prompt and completion tokens of all the LLM calls of the question.
+    :param max_sandbox_seconds: Seconds of all the code runs of the question.
+    :param run_deadline: The time.time() at which the whole run ends, shared by all its questions.
+    """
+    max_seconds: Optional[float] = None
+    max_tokens: Optional[int] = None
+    max_sandbox_seconds: Optional[float] = None
+    run_deadline: Optional[float] = None
+    started_at: float = field(default_factory=time.time)
+    used_tokens: int = 0
+    used_sandbox_seconds: float = 0.0
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """
+        The time.time() at which the question has to be finished.
+        """
+        deadlines = [self.run_deadline, None if self.max_seconds is None else self.started_at + self.max_seconds]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def remaining_seconds(self) -> Optional[float]:
+        deadline = self.deadline
+        return None if deadline is None else max(0.0, deadline - time.time())
+
+    def remaining_tokens(self) -> Optional[int]:
+        return None if self.max_tokens is None else max(0, self.max_tokens - self.used_tokens)
+
+    def remaining_sandbox_seconds(self) -> Optional[float]:
+        """
+        The seconds the next code run may take, the sandbox time left bounded by the time left.
+        """
+        remaining = [self.remaining_seconds()]
+        if self.max_sandbox_seconds is not None:
+            remaining.append(max(0.0, self.max_sandbox_seconds - self.used_sandbox_seconds))
+        remaining = [seconds for seconds in remaining if seconds is not None]
+        return min(remaining) if remaining else None
+
+    def add_tokens(self, tokens: int):
+        self.used_tokens += tokens
+
+    def add_sandbox_seconds(self, seconds: float):
+        self.used_sandbox_seconds += seconds
+
+    @property
+    def exhausted(self) -> Optional[str]:
+        """
+        The name of the exhausted limit, None while the question may go on.
+        """
+        now = time.time()
+        if self.run_deadline is not None and now >= self.run_deadline:
+            return "run time"
+        if self.max_seconds is not None and now >= self.started_at + self.max_seconds:
+            return "time"
+        if self.max_tokens is not None and self.used_tokens >= self.max_tokens:
+            return "token"
+        if self.max_sandbox_seconds is not None and self.used_sandbox_seconds >= self.max_sandbox_seconds:
+            return "sandbox time"
+        return None
+
+
 @dataclass
 class AgentRequest:
     sandbox_id: Optional[str] = None
@@ -80,6 +149,7 @@ class AgentRequest:
     input_files: List[MediaFile] = field(default_factory=list)
     sandbox_status: Optional[SandboxStatus] = None
     is_cn: bool = False
+    budget: Optional[QuestionBudget] = None
 
 
 
@@ -141,6 +211,7 @@ class MediaFile:
     open_path: Optional[str] = None  # 文件的外网路径
     sandbox_path: Optional[str] = None  # 上传到sandbox的路径，模型需要
     file_basic_info: Optional[str] = None # 文件的基本信息，如果是csv，就是info()
+    source_path: Optional[str] = None  # The local file staged to sandbox_path, read while the staging is pending
 
     def __dict__(self):
         return {
@@ -151,4 +222,5 @@ class MediaFile:
             'sandbox_path': self.sandbox_path if self.sandbox_path is not None else "",
             'open_path': self.open_path if self.open_path is not None else "",
             'file_basic_info': self.file_basic_info if self.file_basic_info is not None else "",
+            'source_path': self.source_path if self.source_path is not None else "",
         }
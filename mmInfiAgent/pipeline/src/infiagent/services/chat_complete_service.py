@@ -1,5 +1,5 @@
 import time
-from typing import Union, List, Any, Dict
+from typing import Union, List, Any, Dict, Optional
 from io import BytesIO
 
 from fastapi import UploadFile
@@ -8,6 +8,7 @@ from starlette.datastructures import UploadFile as StarletteUploadFile
 from ..conversation_sessions import CodeInterpreterSession
 from ..schemas import (
     Message,
+    QuestionBudget,
     RoleType
 )
 from werkzeug.datastructures import FileStorage
@@ -26,37 +27,21 @@ async def predict(
         uploaded_files: Any,
         uploaded_imgs: Any,
         open_path_img: str,
+        stage_mode: Union[None, str] = None,
+        budget: Optional[QuestionBudget] = None,
         **kwargs: Dict[str, Any]):
     start_time = time.time()
 
-    # create new session
+    # create new session, its kernel boots in the background
     session = await CodeInterpreterSession.create(**kwargs)
-    uploaded_files_imgs = uploaded_files + uploaded_imgs
-    files = upload_files(uploaded_files_imgs, session.session_id)
+    try:
+        await _upload_files(session, uploaded_files + uploaded_imgs, open_path_img, stage_mode)
+    except BaseException:
+        await _close_session(session)
+        raise
 
     logger.info(f"Session Creation Latency: {time.time() - start_time}")
 
-    # upload file
-    if isinstance(files, str):
-        logger.info(f"Upload {files} as file path")
-        await session.upload_to_sandbox(files, open_path_img)
-    # upload list of file
-    elif isinstance(files, list):
-        for file in files:
-            if isinstance(file, str):
-                await session.upload_to_sandbox(file, open_path_img)
-            elif isinstance(file, UploadFile) or isinstance(file, StarletteUploadFile):
-                file_content = file.file.read()  # get file content
-                file_like_object = BytesIO(file_content)
-                file_storage = FileStorage(
-                    stream=file_like_object,
-                    filename=file.filename,
-                    content_type=file.content_type
-                )
-                await session.upload_to_sandbox(file_storage)
-            else:
-                raise InputErrorException("The file type {} not supported, can't be uploaded".format(type(file)))
-
     # chat
     try:
         logger.info(f"Instruction message: {prompt}\n[Prompt End]")
@@ -64,7 +49,7 @@ async def predict(
         output_files = []
         user_messages = [Message(RoleType.User, prompt)]
 
-        async for response in session.chat(user_messages):
+        async for response in session.chat(user_messages, budget=budget):
             logger.info(f'Session Chat Response: {response}\n[Response End]')
             if content is None:
                 content = response.output_text
@@ -74,7 +59,6 @@ async def predict(
             output_files.extend([output_file.__dict__() for output_file in response.output_files])
 
         session.messages.append(Message(RoleType.Agent, content))
-        AsyncPythonSandBoxTool.kill_kernels(session.session_id)
 
         logger.info(f"Total Latency: {time.time() - start_time}")
         return content
@@ -95,3 +79,44 @@ async def predict(
         logger.error(err_msg, exc_info=True)
 
         raise Exception(err_msg)
+    finally:
+        await _close_session(session)
+
+
+async def _upload_files(session: CodeInterpreterSession, uploaded_files_imgs: Any, open_path_img: str,
+                        stage_mode: Union[None, str] = None):
+    if stage_mode:
+        # uploaded files are local file paths, link them into the sandbox instead of copying their content. The
+        # staging runs while the first LLM round does, only code runs wait for it
+        await session.stage_to_sandbox(uploaded_files_imgs, open_path_img, stage_mode)
+        return
+
+    files = upload_files(uploaded_files_imgs, session.session_id)
+    # upload file
+    if isinstance(files, str):
+        logger.info(f"Upload {files} as file path")
+        await session.upload_to_sandbox(files, open_path_img)
+    # upload list of file
+    elif isinstance(files, list):
+        for file in files:
+            if isinstance(file, str):
+                await session.upload_to_sandbox(file, open_path_img)
+            elif isinstance(file, UploadFile) or isinstance(file, StarletteUploadFile):
+                file_content = file.file.read()  # get file content
+                file_like_object = BytesIO(file_content)
+                file_storage = FileStorage(
+                    stream=file_like_object,
+                    filename=file.filename,
+                    content_type=file.content_type
+                )
+                await session.upload_to_sandbox(file_storage)
+            else:
+                raise InputErrorException("The file type {} not supported, can't be uploaded".format(type(file)))
+
+
+async def _close_session(session: CodeInterpreterSession):
+    # Release the kernel and sandbox files on failure too, concurrent eval runs would otherwise leak kernels. A
+    # kernel still booting is cancelled, files still being staged are waited for before they are cleared
+    await AsyncPythonSandBoxTool.cancel_setup(session.session_id)
+    AsyncPythonSandBoxTool.kill_kernels(session.session_id)
+    session.close()
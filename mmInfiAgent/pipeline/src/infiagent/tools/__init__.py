@@ -1,5 +1,6 @@
 from .base_tool import BaseTool
-from .code_sandbox import PythonSandBoxToolResponse, AsyncPythonSandBoxTool
+from .code_sandbox import PythonSandBoxToolResponse, AsyncPythonSandBoxTool, KernelPool, SandboxKernel, \
+    ExecutionCache, configure_execution_cache, get_execution_cache
 try:
     import docker
 except:
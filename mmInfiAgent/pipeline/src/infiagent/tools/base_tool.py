@@ -1,3 +1,4 @@
+import copy
 from dataclasses import dataclass
 from typing import Optional, Type
 from abc import ABC
@@ -121,6 +122,21 @@ class BaseTool(ABC):
     def setup(self):
         pass
 
+    def clone(self):
+        """
+        Create a copy of the tool for another agent. Tools created from the same config share their configuration,
+        subclasses holding per-session state should reset it here.
+        """
+        tool = copy.copy(self)
+        tool.clear()
+        return tool
+
+    def clear(self):
+        """
+        Reset the per-session state of the tool.
+        """
+        pass
+
     def run(self, req: BaseToolRequest):
         pass
 
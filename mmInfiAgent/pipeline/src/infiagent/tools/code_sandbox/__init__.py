@@ -1 +1,3 @@
 from .python_code_sandbox import PythonSandBoxToolResponse, AsyncPythonSandBoxTool
+from .kernel_pool import KernelPool, SandboxKernel
+from .execution_cache import ExecutionCache, configure_execution_cache, get_execution_cache, is_cacheable_cell
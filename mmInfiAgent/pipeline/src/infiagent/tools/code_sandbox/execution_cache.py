@@ -0,0 +1,236 @@
+import ast
+import builtins
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Optional, Tuple
+
+from ...utils import get_logger
+from ...utils.file_utils import file_content_hash
+
+logger = get_logger()
+
+root_directory = os.path.abspath(__file__)
+while 'infiagent' not in os.path.basename(root_directory):
+    root_directory = os.path.dirname(root_directory)
+
+# Bump the version when the key, the purity check or the stored value changes, older entries are then never hit
+EXECUTION_CACHE_VERSION = "v1"
+EXECUTION_CACHE_PATH = f"{root_directory}/tmp/sandbox_execution_cache.sqlite"
+EXECUTION_CACHE_MAX_SIZE = 256 * 1024 * 1024
+# Eviction frees space down to this fraction of the max size, so it doesn't run on every insert
+EXECUTION_CACHE_EVICT_TO = 0.9
+
+# Sandbox ids are random per session, they are masked in the code and in the stored output
+_SANDBOX_PATH_PATTERN = re.compile(r"upload_files/[^/\s'\"]+/")
+_SANDBOX_PATH_MASK = "upload_files/<sandbox>/"
+
+# Modules whose use makes the output depend on more than the code and the input files: the clock, randomness,
+# the environment, the network or other processes
+_IMPURE_MODULES = {"os", "sys", "subprocess", "shutil", "pathlib", "glob", "io", "tempfile", "random", "secrets",
+                   "uuid", "time", "datetime", "socket", "requests", "urllib", "http", "pickle", "joblib",
+                   "threading", "multiprocessing", "asyncio", "sklearn", "tensorflow", "torch", "IPython"}
+# Calls writing files, reading the clock or drawing random numbers, by function or method name
+_IMPURE_CALLS = {"open", "exec", "eval", "compile", "input", "globals", "locals", "vars", "__import__", "setattr",
+                 "delattr", "get_ipython", "to_csv", "to_excel", "to_json", "to_parquet", "to_pickle", "to_feather",
+                 "to_hdf", "to_sql", "to_html", "to_latex", "to_markdown", "savefig", "imsave", "save", "savez",
+                 "savetxt", "tofile", "dump", "write", "writelines", "now", "today", "utcnow", "sample", "shuffle",
+                 "permutation", "choice", "rand", "randn", "randint", "random", "default_rng", "seed"}
+_BUILTIN_NAMES = set(dir(builtins))
+
+
+def is_cacheable_cell(code: str) -> bool:
+    """
+    Check whether the output of a cell only depends on its code and the input files, when it is the first cell of a
+    session. Cells writing files, using randomness, the clock, the environment or other processes, or reading names
+    they don't define, are not cacheable, nor are cells with IPython magics or shell commands.
+
+    :param code: The code of the cell.
+    :type code: str
+    :return: Whether the cell is side-effect free.
+    :rtype: bool
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+
+    defined = set(_BUILTIN_NAMES)
+    loaded = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Global, ast.Nonlocal, ast.Delete, ast.AsyncFunctionDef, ast.Await)):
+            return False
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            modules = [node.module or ""] if isinstance(node, ast.ImportFrom) else \
+                [alias.name for alias in node.names]
+            if any(module.split(".")[0] in _IMPURE_MODULES or "random" in module.split(".") for module in modules):
+                return False
+            for alias in node.names:
+                defined.add((alias.asname or alias.name).split(".")[0])
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            defined.add(node.name)
+            if isinstance(node, ast.FunctionDef):
+                arguments = node.args
+                for arg in arguments.posonlyargs + arguments.args + arguments.kwonlyargs + \
+                        [arguments.vararg, arguments.kwarg]:
+                    if arg is not None:
+                        defined.add(arg.arg)
+        elif isinstance(node, ast.Lambda):
+            defined.update(arg.arg for arg in node.args.args)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            defined.add(node.name)
+        elif isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Store):
+                defined.add(node.id)
+            else:
+                loaded.add(node.id)
+        elif isinstance(node, ast.Attribute) and node.attr in _IMPURE_CALLS:
+            return False
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _IMPURE_CALLS:
+            return False
+    # A name read but never defined comes from the state of the kernel
+    return loaded <= defined
+
+
+def normalize_code(code: str) -> str:
+    """
+    Normalize a cell for the cache key, the sandbox paths are masked and the formatting and comments dropped.
+    """
+    return ast.dump(ast.parse(_SANDBOX_PATH_PATTERN.sub(_SANDBOX_PATH_MASK, code)))
+
+
+def mask_sandbox_paths(text: str) -> str:
+    return _SANDBOX_PATH_PATTERN.sub(_SANDBOX_PATH_MASK, text)
+
+
+def unmask_sandbox_paths(text: str, sandbox_id: str) -> str:
+    return text.replace(_SANDBOX_PATH_MASK, f"upload_files/{sandbox_id}/")
+
+
+class ExecutionCache:
+    """
+    On-disk cache of the output of the first cell of sandbox sessions, in a sqlite file.
+
+    Outputs are keyed by the normalized code and the content hashes of the files staged into the sandbox. Values
+    are zlib compressed JSON. When the stored values exceed max_size bytes the least recently used entries are
+    evicted.
+    """
+
+    def __init__(self, path: str = EXECUTION_CACHE_PATH, max_size: int = EXECUTION_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Shard workers of eval.py share the file, WAL lets them read while one of them writes
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS executions ("
+                                 "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                                 "accessed_at REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS executions_accessed_at ON executions (accessed_at)")
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM executions").fetchone()[0]
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key: str) -> Optional[Tuple[str, int]]:
+        """
+        Get the output and the response type value of a cell, with its sandbox paths masked.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM executions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute("UPDATE executions SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        value = json.loads(zlib.decompress(row[0]))
+        return value["output"], value["type"]
+
+    def put(self, key: str, output: str, output_type: int):
+        value = zlib.compress(json.dumps({"output": mask_sandbox_paths(output), "type": output_type},
+                                         ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            row = self._connection.execute("SELECT size FROM executions WHERE key = ?", (key,)).fetchone()
+            self._connection.execute("INSERT OR REPLACE INTO executions (key, value, size, accessed_at) "
+                                     "VALUES (?, ?, ?, ?)", (key, value, len(value), time.time()))
+            self._size += len(value) - (row[0] if row else 0)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        target = int(self.max_size * EXECUTION_CACHE_EVICT_TO)
+        # Other processes may have written to the file since the size was counted
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM executions").fetchone()[0]
+        evicted = 0
+        rows = self._connection.execute("SELECT key, size FROM executions ORDER BY accessed_at, rowid").fetchall()
+        for key, size in rows:
+            if self._size <= target:
+                break
+            self._connection.execute("DELETE FROM executions WHERE key = ?", (key,))
+            self._size -= size
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} sandbox outputs from {self.path}, {self._size} bytes left")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def make_key(code: str, input_dir: str) -> str:
+        """
+        Make the cache key of a cell.
+
+        :param code: The code of the cell, see is_cacheable_cell.
+        :type code: str
+        :param input_dir: The directory of the files staged into the sandbox, hashed by content.
+        :type input_dir: str
+        :return: The key.
+        :rtype: str
+        """
+        input_files: Dict[str, str] = {}
+        if os.path.isdir(input_dir):
+            for file_name in sorted(os.listdir(input_dir)):
+                file_path = os.path.join(input_dir, file_name)
+                if os.path.isfile(file_path):
+                    input_files[file_name] = file_content_hash(file_path)
+        key_data = {
+            "version": EXECUTION_CACHE_VERSION,
+            "code": normalize_code(code),
+            "input_files": input_files,
+        }
+        key_json = json.dumps(key_data, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key_json.encode("utf-8")).hexdigest()
+
+
+_EXECUTION_CACHE: Optional[ExecutionCache] = None
+
+
+def configure_execution_cache(enabled: bool = True, path: str = EXECUTION_CACHE_PATH,
+                              max_size: int = EXECUTION_CACHE_MAX_SIZE) -> Optional[ExecutionCache]:
+    """
+    Enable the execution cache for all sandboxes of the process, enabled False disables it.
+
+    :return: The execution cache, None when it is disabled.
+    :rtype: Optional[ExecutionCache]
+    """
+    global _EXECUTION_CACHE
+    if _EXECUTION_CACHE is not None:
+        _EXECUTION_CACHE.close()
+        _EXECUTION_CACHE = None
+    if enabled:
+        _EXECUTION_CACHE = ExecutionCache(path=path, max_size=max_size)
+    return _EXECUTION_CACHE
+
+
+def get_execution_cache() -> Optional[ExecutionCache]:
+    return _EXECUTION_CACHE
@@ -0,0 +1,459 @@
+import asyncio
+import atexit
+import os
+import shutil
+import signal
+import sys
+import time
+import uuid
+from collections import deque
+from typing import Deque, List, Optional, Set
+
+from jupyter_client import AsyncKernelClient
+
+from ...exceptions.exceptions import SandboxException
+from ...utils import get_logger
+
+logger = get_logger()
+
+DEFAULT_PRELOAD_MODULES = ["numpy", "pandas", "matplotlib.pyplot"]
+KERNEL_RESET_TIMEOUT = 30
+KERNEL_STARTUP_TIMEOUT = 60
+# Seconds an interrupted kernel gets to stop the running code and get idle again
+KERNEL_INTERRUPT_TIMEOUT = 10
+# Env var holding the fd the launch script writes to once the kernel wrote its connection file and bound its sockets
+KERNEL_READY_FD_ENV = "INFIAGENT_KERNEL_READY_FD"
+# Attribute of the sys module of a kernel holding the global state it is reset to, %reset doesn't clear it
+KERNEL_BASELINE_ATTR = "_infiagent_kernel_baseline"
+
+# Snapshot of the global state sandbox code may change outside its namespace, taken once the kernel is started
+KERNEL_SNAPSHOT_CODE = f"""\
+import os as _os, sys as _sys, warnings as _warnings
+_baseline = {{'path': list(_sys.path), 'environ': dict(_os.environ), 'warnings': list(_warnings.filters)}}
+if 'numpy' in _sys.modules:
+    _baseline['numpy'] = (_sys.modules['numpy'].get_printoptions(), _sys.modules['numpy'].geterr())
+if 'matplotlib' in _sys.modules:
+    _baseline['matplotlib'] = {{key: value for key, value in _sys.modules['matplotlib'].rcParams.items()
+                                if key != 'backend'}}
+setattr(_sys, {KERNEL_BASELINE_ATTR!r}, _baseline)
+"""
+
+# Restores the snapshot, numpy or matplotlib imported after it can't be restored and fail the reset, so the kernel
+# is replaced instead of reused
+KERNEL_RESTORE_CODE = f"""\
+import os as _os, sys as _sys, warnings as _warnings
+_baseline = getattr(_sys, {KERNEL_BASELINE_ATTR!r})
+for _module in ('numpy', 'matplotlib'):
+    if _module in _sys.modules and _module not in _baseline:
+        raise RuntimeError(f'{{_module}} was imported after the kernel started, its global state cannot be reset')
+if 'matplotlib.pyplot' in _sys.modules:
+    _sys.modules['matplotlib.pyplot'].close('all')
+_sys.path[:] = _baseline['path']
+_os.environ.clear()
+_os.environ.update(_baseline['environ'])
+with _warnings.catch_warnings():
+    _warnings.simplefilter('ignore')
+    if 'numpy' in _baseline:
+        _sys.modules['numpy'].set_printoptions(**_baseline['numpy'][0])
+        _sys.modules['numpy'].seterr(**_baseline['numpy'][1])
+    if 'matplotlib' in _baseline:
+        _sys.modules['matplotlib'].rcParams.update(_baseline['matplotlib'])
+    if 'pandas' in _sys.modules:
+        _sys.modules['pandas'].reset_option(r'^(?!plotting\\.)')
+        try:
+            _sys.modules['pandas'].reset_option(r'^plotting\\.')
+        except ImportError:
+            # The plotting options import matplotlib, without it they can't have been changed either
+            pass
+_warnings.filters[:] = _baseline['warnings']
+getattr(_warnings, '_filters_mutated', lambda: None)()
+"""
+
+
+def build_launch_kernel_py(kernel_cwd: str) -> str:
+    return (f"import os\nos.chdir('{kernel_cwd}')\n"
+            f"def input(*args, **kwargs):\n"
+            f"    raise NotImplementedError('Python input() function is disabled.')\n"
+            f"from ipykernel.kernelapp import IPKernelApp\n"
+            f"app = IPKernelApp.instance()\n"
+            f"app.initialize()\n"
+            f"ready_fd = os.environ.pop('{KERNEL_READY_FD_ENV}', None)\n"
+            f"if ready_fd is not None:\n"
+            f"    os.write(int(ready_fd), b'ready\\n')\n"
+            f"    os.close(int(ready_fd))\n"
+            f"app.start()")
+
+
+class SandboxKernel:
+    """
+    A running ipykernel process and the client connected to it.
+    """
+
+    def __init__(self,
+                 kernel_id: str,
+                 kernel_dir: str,
+                 process: asyncio.subprocess.Process,
+                 client: AsyncKernelClient):
+        self.kernel_id = kernel_id
+        self.kernel_dir = kernel_dir
+        self.process = process
+        self.client = client
+        self.uses = 0
+
+    @classmethod
+    async def start(cls,
+                    work_dir: str,
+                    kernel_id: str,
+                    kernel_cwd: str,
+                    timeout: float = KERNEL_STARTUP_TIMEOUT) -> "SandboxKernel":
+        """
+        Launch a kernel process in work_dir/kernel_id and connect a client to it once it is ready.
+
+        The launch script signals on a pipe once the kernel is initialized, which is awaited without blocking the
+        event loop, instead of polling for the connection file.
+
+        :raises SandboxException: If the kernel process exits or is not ready within the timeout.
+        """
+        kernel_dir = os.path.join(work_dir, kernel_id)
+        connection_file = os.path.join(kernel_dir, f'kernel_connection_file_{kernel_id}.json')
+        launch_kernel_script = os.path.join(kernel_dir, f'launch_kernel_{kernel_id}.py')
+        for f in [connection_file, launch_kernel_script]:
+            if os.path.exists(f):
+                os.remove(f)
+
+        os.makedirs(kernel_dir, exist_ok=True)
+        with open(launch_kernel_script, 'w') as fout:
+            fout.write(build_launch_kernel_py(kernel_cwd))
+
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        ready_read_fd, ready_write_fd = os.pipe()
+        try:
+            try:
+                kernel_process = await asyncio.create_subprocess_exec(
+                    sys.executable,
+                    launch_kernel_script,
+                    '--IPKernelApp.connection_file',
+                    connection_file,
+                    '--matplotlib=inline',
+                    '--quiet',
+                    cwd=work_dir,
+                    env={**os.environ, KERNEL_READY_FD_ENV: str(ready_write_fd)},
+                    pass_fds=(ready_write_fd,))
+            finally:
+                # Only the kernel holds the write end, so the pipe hits EOF if it dies before it is ready
+                os.close(ready_write_fd)
+        except BaseException:
+            # The spawn failed or was cancelled, e.g. the session ended while its kernel was being leased
+            os.close(ready_read_fd)
+            shutil.rmtree(kernel_dir, ignore_errors=True)
+            raise
+
+        ready_reader = asyncio.StreamReader()
+        ready_pipe = os.fdopen(ready_read_fd, 'rb', 0)
+        try:
+            transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(ready_reader), ready_pipe)
+        except BaseException:
+            ready_pipe.close()
+            _kill_process(kernel_process)
+            shutil.rmtree(kernel_dir, ignore_errors=True)
+            raise
+        try:
+            try:
+                ready = await asyncio.wait_for(ready_reader.readline(), timeout=max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                raise SandboxException(f"Kernel {kernel_id} is not ready after {timeout}s")
+            finally:
+                transport.close()
+            if not ready:
+                return_code = await kernel_process.wait()
+                raise SandboxException(f"Kernel {kernel_id} exited with code {return_code} during startup")
+
+            # Client
+            kc = AsyncKernelClient(connection_file=connection_file)
+            kc.load_connection_file()
+            kc.start_channels()
+            try:
+                await kc.wait_for_ready(timeout=max(0.0, deadline - time.monotonic()))
+            except RuntimeError as e:
+                kc.stop_channels()
+                raise SandboxException(f"Kernel {kernel_id} is not ready: {e}") from e
+        except BaseException:
+            _kill_process(kernel_process)
+            shutil.rmtree(kernel_dir, ignore_errors=True)
+            raise
+        return cls(kernel_id, kernel_dir, kernel_process, kc)
+
+    def is_alive(self) -> bool:
+        return self.process.returncode is None and self.client.hb_channel.is_beating()
+
+    def interrupt(self):
+        """
+        Send SIGINT to the kernel, which raises KeyboardInterrupt in the running code and keeps its namespace.
+        """
+        if self.process.returncode is None:
+            try:
+                self.process.send_signal(signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+    async def run_silent(self, code: str, timeout: float = KERNEL_RESET_TIMEOUT) -> bool:
+        """
+        Run code without output or history, e.g. to reset the kernel. Return whether it ran successfully.
+        """
+        try:
+            reply = await self.client.execute_interactive(code, silent=True, store_history=False, timeout=timeout,
+                                                          output_hook=lambda msg: None)
+        except Exception as e:
+            logger.warning(f"Failed to run code on kernel {self.kernel_id}, error: {e}")
+            return False
+        return reply['content'].get('status') == 'ok'
+
+    async def shutdown(self):
+        """
+        Ask the kernel to shut down and wait for its process to exit, kill it if it doesn't.
+        """
+        try:
+            if self.process.returncode is None:
+                self.client.shutdown()
+                await asyncio.wait_for(self.process.wait(), 5)
+        except Exception:
+            pass
+        finally:
+            self.kill()
+        await self.process.wait()
+
+    def kill(self):
+        """
+        Kill the kernel process right away, e.g. when no event loop is left to shut it down gracefully.
+        """
+        _kill_process(self.process)
+        self.client.stop_channels()
+        if os.path.exists(self.kernel_dir):
+            shutil.rmtree(self.kernel_dir, ignore_errors=True)
+
+
+def _kill_process(process: asyncio.subprocess.Process):
+    # Signal the pid directly, the event loop owning the process may be closed already
+    if process.returncode is None:
+        try:
+            os.kill(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class KernelPool:
+    """
+    Pool of pre-started kernels leased by sandboxes.
+
+    Idle kernels already imported the preload modules, so the first code run of a sandbox does not pay for the
+    kernel start nor for importing the data science stack. A released kernel gets its namespace cleared and its
+    cwd reset before it is leased again, and is shut down instead once it served max_uses sandboxes. With the
+    defaults nothing is pre-started and every kernel serves a single sandbox, as without a pool.
+
+    :param work_dir: The directory holding the connection file and launch script of each kernel.
+    :param kernel_cwd: The cwd of the kernels, sandbox files are addressed relative to it.
+    :param min_size: Number of idle kernels kept started ahead of time.
+    :param max_size: Maximum number of kernels, idle or leased. Sandboxes wait for a kernel beyond it, None for
+        no limit.
+    :param max_uses: Number of sandboxes a kernel serves before it is replaced by a fresh one.
+    :param preload_modules: Modules imported by a kernel before it gets idle.
+    """
+
+    def __init__(self,
+                 work_dir: str,
+                 kernel_cwd: str,
+                 min_size: int = 0,
+                 max_size: Optional[int] = None,
+                 max_uses: int = 1,
+                 preload_modules: Optional[List[str]] = None):
+        if max_size is not None and max_size < max(min_size, 1):
+            raise ValueError(f"Invalid kernel pool size, max_size {max_size} must be >= max(min_size, 1)")
+        self._work_dir = work_dir
+        self._kernel_cwd = kernel_cwd
+        self._min_size = min_size
+        self._max_size = max_size
+        self._max_uses = max(1, max_uses)
+        self._preload_modules = DEFAULT_PRELOAD_MODULES if preload_modules is None else preload_modules
+
+        self._idle: Deque[SandboxKernel] = deque()
+        self._leased: Set[SandboxKernel] = set()
+        # Released kernels being reset, close() shuts them down too when it cancels their reset
+        self._recycling: Set[SandboxKernel] = set()
+        self._starting = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._background_tasks: Set[asyncio.Task] = set()
+        atexit.register(self.shutdown)
+
+    @property
+    def size(self) -> int:
+        return len(self._idle) + len(self._leased) + self._starting
+
+    @property
+    def idle_size(self) -> int:
+        return len(self._idle)
+
+    def _preload_code(self) -> str:
+        imports = "\n".join(f"try:\n    import {module}\nexcept ImportError:\n    pass"
+                            for module in self._preload_modules)
+        # Modules stay imported, but the names are cleared so the namespace is the one of a fresh kernel
+        return f"{imports}\n{KERNEL_SNAPSHOT_CODE}%reset -f"
+
+    def _reset_code(self) -> str:
+        # %reset only clears the namespace, the options of the imported modules, sys.path, the environment and the
+        # warning filters are restored from the snapshot taken at startup
+        return (f"%reset -f\n"
+                f"import os as _os\n"
+                f"_os.chdir({self._kernel_cwd!r})\n"
+                f"{KERNEL_RESTORE_CODE}"
+                f"%reset -f")
+
+    async def _start_kernel(self) -> SandboxKernel:
+        kernel = await SandboxKernel.start(self._work_dir, f"kernel_{uuid.uuid4().hex[:12]}", self._kernel_cwd)
+        try:
+            # Without a snapshot the reset fails, and the kernel serves a single sandbox
+            if not await kernel.run_silent(self._preload_code()):
+                logger.warning(f"Failed to preload modules {self._preload_modules} on kernel {kernel.kernel_id}")
+        except BaseException:
+            kernel.kill()
+            raise
+        return kernel
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    def _can_start(self) -> bool:
+        return self._max_size is None or self.size < self._max_size
+
+    async def _start_idle_kernel(self):
+        self._starting += 1
+        try:
+            kernel = await self._start_kernel()
+        except Exception as e:
+            logger.error(f"Failed to start pooled kernel, error: {e}", exc_info=True)
+            return
+        finally:
+            self._starting -= 1
+        self._put_idle(kernel)
+
+    def _put_idle(self, kernel: SandboxKernel):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._leased.add(kernel)
+                waiter.set_result(kernel)
+                return
+        self._idle.append(kernel)
+
+    def _fill(self):
+        """
+        Start kernels in the background until min_size kernels are idle or starting.
+        """
+        missing = self._min_size - len(self._idle) - self._starting
+        for _ in range(missing):
+            if not self._can_start():
+                break
+            self._spawn(self._start_idle_kernel())
+
+    async def warm_up(self):
+        """
+        Start the min_size idle kernels and wait for them.
+        """
+        self._fill()
+        await asyncio.gather(*self._background_tasks)
+
+    async def acquire(self) -> SandboxKernel:
+        """
+        Lease a healthy kernel, started now if none is idle, or as soon as one is released if the pool is full.
+        """
+        while self._idle:
+            kernel = self._idle.popleft()
+            if kernel.is_alive():
+                self._leased.add(kernel)
+                self._fill()
+                return kernel
+            logger.warning(f"Pooled kernel {kernel.kernel_id} died, drop it")
+            self._spawn(self._shutdown_kernel(kernel))
+
+        if self._can_start():
+            self._starting += 1
+            try:
+                kernel = await self._start_kernel()
+            finally:
+                self._starting -= 1
+            self._leased.add(kernel)
+            self._fill()
+            return kernel
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            # Cancelled after a released kernel was handed over, give it back to the next waiter
+            if waiter.done() and not waiter.cancelled():
+                self.release(waiter.result())
+            raise
+
+    def release(self, kernel: SandboxKernel):
+        """
+        Give back a leased kernel. It is reset or replaced in the background.
+        """
+        if kernel not in self._leased:
+            return
+        self._leased.discard(kernel)
+        kernel.uses += 1
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            kernel.kill()
+            return
+        self._recycling.add(kernel)
+        self._spawn(self._recycle(kernel))
+
+    async def _recycle(self, kernel: SandboxKernel):
+        try:
+            reusable = kernel.uses < self._max_uses and kernel.is_alive() and \
+                await kernel.run_silent(self._reset_code())
+        finally:
+            self._recycling.discard(kernel)
+        if reusable:
+            self._put_idle(kernel)
+            return
+
+        await self._shutdown_kernel(kernel)
+        if self._waiters and self._can_start():
+            await self._start_idle_kernel()
+        self._fill()
+
+    async def _shutdown_kernel(self, kernel: SandboxKernel):
+        await kernel.shutdown()
+
+    async def close(self):
+        """
+        Shut down all the kernels of the pool, including the ones still starting.
+        """
+        for task in list(self._background_tasks):
+            task.cancel()
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        kernels = list(self._idle) + list(self._leased) + list(self._recycling)
+        self._idle.clear()
+        self._leased.clear()
+        self._recycling.clear()
+        await asyncio.gather(*[kernel.shutdown() for kernel in kernels])
+
+    def shutdown(self):
+        """
+        Kill all the kernels of the pool right away, e.g. at exit when the event loop is gone.
+        """
+        for task in list(self._background_tasks):
+            task.cancel()
+        while self._idle:
+            self._idle.popleft().kill()
+        for kernel in list(self._leased) + list(self._recycling):
+            kernel.kill()
+        self._leased.clear()
+        self._recycling.clear()
@@ -1,18 +1,21 @@
-from typing import Union, Dict
+from typing import Callable, Union, Dict, List, Optional
 from werkzeug.datastructures import FileStorage
+from ...exceptions.exceptions import SandboxException
+from ...schemas.agent_models import QuestionBudget
 from ...tools.base_tool import BaseTool
 from ...utils import clean_ansi, get_logger
-from jupyter_client import BlockingKernelClient
-import json
+from jupyter_client import AsyncKernelClient
+import asyncio
 import os
 import queue
 import re
-import subprocess
 import sys
 import time
 import traceback
 from enum import Enum
 from ...utils.file_utils import clear_files
+from .kernel_pool import KernelPool, SandboxKernel, build_launch_kernel_py, KERNEL_INTERRUPT_TIMEOUT
+from .execution_cache import ExecutionCache, get_execution_cache, is_cacheable_cell, unmask_sandbox_paths
 import sys
 
 logger = get_logger()
@@ -23,6 +26,9 @@ while 'infiagent' not in os.path.basename(root_directory):
 
 WORK_DIR = f'{root_directory}/tmp/ci_workspace'
 FILE_DIR = f'{root_directory}/tmp/upload_files'
+KERNEL_CWD = f'{root_directory}/tmp'
+# Seconds a code run may take before the kernel is interrupted
+STEP_TIMEOUT = 60 * 10
 
 class _Type(Enum):
     SUCCESS = 1
@@ -63,77 +69,163 @@ class PythonSandBoxToolResponse:
 
 
 class AsyncPythonSandBoxTool(BaseTool):
-    _KERNEL_CLIENTS: Dict[int, BlockingKernelClient] = {}
-    LAUNCH_KERNEL_PY = (f"import os\nos.chdir('{root_directory}/tmp')\n"
-                        f"def input(*args, **kwargs):\n"
-                        f"    raise NotImplementedError('Python input() function is disabled.')\n"
-                        f"from ipykernel import kernelapp as "
-                        f"app\napp.launch_new_instance()")
-
-    def __init__(self, name, description, **kwargs):
+    _KERNELS: Dict[str, SandboxKernel] = {}
+    _KERNEL_POOL: Union[KernelPool, None] = None
+    # Work started for a sandbox ahead of its first code run, the kernel lease and e.g. the staging of its files
+    _KERNEL_TASKS: Dict[str, asyncio.Task] = {}
+    _SETUP_TASKS: Dict[str, List[asyncio.Future]] = {}
+    LAUNCH_KERNEL_PY = build_launch_kernel_py(KERNEL_CWD)
+    # Deadlines of the sandboxes without their own in the tool config, see configure_deadlines
+    STEP_TIMEOUT: float = STEP_TIMEOUT
+    QUESTION_TIMEOUT: Optional[float] = None
+
+    def __init__(self, name, description, step_timeout: Optional[float] = None,
+                 question_timeout: Optional[float] = None, **kwargs):
         super().__init__(name, description, **kwargs)
         self._sandbox_id = None
+        self._step_timeout = step_timeout
+        self._question_timeout = question_timeout
+        self._question_deadline = None
+        self._budget: Optional[QuestionBudget] = None
+        self._code_runs = 0
+        # A first cell served from the execution cache, it still has to run before the next cell
+        self._replay_code = None
 
     @classmethod
     async def create(cls, config_data, **params):
         # Unpack the config_data dictionary and any additional parameters
-        instance = cls(name=config_data['name'], description=config_data['description'], **params)
+        if 'kernel_pool' in config_data and cls._KERNEL_POOL is None:
+            cls.configure_kernel_pool(**config_data['kernel_pool'])
+        instance = cls(name=config_data['name'], description=config_data['description'],
+                       step_timeout=config_data.get('step_timeout'),
+                       question_timeout=config_data.get('question_timeout'), **params)
         return instance
 
+    @classmethod
+    def configure_deadlines(cls, step_timeout: float = STEP_TIMEOUT, question_timeout: Optional[float] = None):
+        """
+        Set the default deadlines of the sandboxes, the step_timeout and question_timeout of a tool config take
+        precedence. The code runs of a question with a budget are also cut to the time it has left, the earlier of
+        the question timeout and the budget deadline wins.
+
+        :param step_timeout: Seconds a code run may take before the kernel is interrupted.
+        :type step_timeout: float
+        :param question_timeout: Seconds all the code runs of a question may take, counted from the start of its
+            session, None for no limit.
+        :type question_timeout: Optional[float]
+        """
+        cls.STEP_TIMEOUT = step_timeout
+        cls.QUESTION_TIMEOUT = question_timeout
+
+    @property
+    def step_timeout(self) -> float:
+        return self._step_timeout if self._step_timeout is not None else AsyncPythonSandBoxTool.STEP_TIMEOUT
+
+    @property
+    def question_timeout(self) -> Optional[float]:
+        return self._question_timeout if self._question_timeout is not None \
+            else AsyncPythonSandBoxTool.QUESTION_TIMEOUT
+
+    @classmethod
+    def configure_kernel_pool(cls, **kwargs) -> KernelPool:
+        """
+        Replace the kernel pool shared by all sandboxes of the process, see KernelPool for the options.
+        """
+        if cls._KERNEL_POOL is not None:
+            cls._KERNEL_POOL.shutdown()
+        cls._KERNEL_POOL = KernelPool(work_dir=WORK_DIR, kernel_cwd=KERNEL_CWD, **kwargs)
+        return cls._KERNEL_POOL
+
+    @classmethod
+    def get_kernel_pool(cls) -> KernelPool:
+        if cls._KERNEL_POOL is None:
+            cls._KERNEL_POOL = KernelPool(work_dir=WORK_DIR, kernel_cwd=KERNEL_CWD)
+        return cls._KERNEL_POOL
+
+    @classmethod
+    async def cancel_setup(cls, sandbox_id):
+        """
+        Cancel the kernel lease of a sandbox if it is still pending and wait for its other setup tasks, so that
+        kill_kernels neither misses a kernel nor clears files still being staged.
+        """
+        kernel_task = cls._KERNEL_TASKS.pop(sandbox_id, None)
+        if kernel_task is not None:
+            kernel_task.cancel()
+        tasks = cls._SETUP_TASKS.pop(sandbox_id, [])
+        results = await asyncio.gather(*tasks, *([kernel_task] if kernel_task else []), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Setup of sandbox {sandbox_id} failed, error: {result}")
+
     @classmethod
     def kill_kernels(cls, sandbox_id):
-        if sandbox_id in AsyncPythonSandBoxTool._KERNEL_CLIENTS:
-            AsyncPythonSandBoxTool._KERNEL_CLIENTS[sandbox_id].shutdown()
-            del AsyncPythonSandBoxTool._KERNEL_CLIENTS[sandbox_id]
+        if sandbox_id in AsyncPythonSandBoxTool._KERNELS:
+            # The pool resets the kernel for another sandbox, or shuts it down
+            cls.get_kernel_pool().release(AsyncPythonSandBoxTool._KERNELS.pop(sandbox_id))
 
         if os.path.exists(os.path.join(WORK_DIR, sandbox_id)):
             clear_files(os.path.join(WORK_DIR, sandbox_id))
         if os.path.exists(os.path.join(FILE_DIR, sandbox_id)):
             clear_files(os.path.join(FILE_DIR, sandbox_id))
 
-    def _start_kernel(self) -> BlockingKernelClient:
-        connection_file = os.path.join(WORK_DIR, self.sandbox_id, f'kernel_connection_file_{self.sandbox_id}.json')
-        launch_kernel_script = os.path.join(WORK_DIR, self.sandbox_id, f'launch_kernel_{self.sandbox_id}.py')
-        for f in [connection_file, launch_kernel_script]:
-            if os.path.exists(f):
-                os.remove(f)
-
-        os.makedirs(os.path.join(WORK_DIR, self.sandbox_id), exist_ok=True)
-        with open(launch_kernel_script, 'w') as fout:
-            fout.write(AsyncPythonSandBoxTool.LAUNCH_KERNEL_PY)
-
-        kernel_process = subprocess.Popen([
-            sys.executable,
-            launch_kernel_script,
-            '--IPKernelApp.connection_file',
-            connection_file,
-            '--matplotlib=inline',
-            '--quiet',
-        ],
-            cwd=WORK_DIR)
-
-        # Wait for kernel connection file to be written
-        while True:
-            if not os.path.isfile(connection_file):
-                time.sleep(0.1)
-            else:
-                # Keep looping if JSON parsing fails, file may be partially written
-                try:
-                    with open(connection_file, 'r') as fp:
-                        json.load(fp)
-                    break
-                except json.JSONDecodeError:
-                    pass
-
-        # Client
-        kc = BlockingKernelClient(connection_file=connection_file)
-        kc.load_connection_file()
-        kc.start_channels()
-        kc.wait_for_ready()
-        return kc
-
     async def set_sandbox_id(self, sandbox_id):
         self._sandbox_id = sandbox_id
+        question_timeout = self.question_timeout
+        self._question_deadline = time.monotonic() + question_timeout if question_timeout is not None else None
+        self._code_runs = 0
+        self._replay_code = None
+
+    def set_budget(self, budget: Optional[QuestionBudget]):
+        """
+        Set the budget of the question, code runs are cut to the sandbox time and the time it has left and their
+        durations are charged to it. None removes the budget.
+        """
+        self._budget = budget
+
+    def start_kernel(self) -> asyncio.Task:
+        """
+        Lease the kernel of the sandbox in the background, the first code run only waits for what is left of it.
+        """
+        if self.sandbox_id not in AsyncPythonSandBoxTool._KERNEL_TASKS:
+            AsyncPythonSandBoxTool._KERNEL_TASKS[self.sandbox_id] = asyncio.create_task(
+                self._acquire_kernel(self.sandbox_id))
+        return AsyncPythonSandBoxTool._KERNEL_TASKS[self.sandbox_id]
+
+    def add_setup_task(self, task: asyncio.Future):
+        """
+        Register work the first code run of the sandbox has to wait for, e.g. staging its input files.
+        """
+        AsyncPythonSandBoxTool._SETUP_TASKS.setdefault(self.sandbox_id, []).append(task)
+
+    async def wait_for_setup(self) -> SandboxKernel:
+        """
+        Wait for the pending setup tasks of the sandbox and get its kernel, leased now if it was not started.
+
+        :raises Exception: The error of a failed setup task.
+        """
+        await self._wait_for_setup_tasks()
+        kernel_task = AsyncPythonSandBoxTool._KERNEL_TASKS.pop(self.sandbox_id, None)
+        if kernel_task is not None:
+            await kernel_task
+        return await self._acquire_kernel(self.sandbox_id)
+
+    async def _wait_for_setup_tasks(self):
+        tasks = AsyncPythonSandBoxTool._SETUP_TASKS.pop(self.sandbox_id, [])
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    @classmethod
+    async def _acquire_kernel(cls, sandbox_id) -> SandboxKernel:
+        if sandbox_id not in cls._KERNELS:
+            cls._KERNELS[sandbox_id] = await cls.get_kernel_pool().acquire()
+        return cls._KERNELS[sandbox_id]
+
+    def clear(self):
+        self._sandbox_id = None
+        self._question_deadline = None
+        self._budget = None
+        self._code_runs = 0
+        self._replay_code = None
 
     @property
     def sandbox_id(self):
@@ -161,30 +253,62 @@ class AsyncPythonSandBoxTool(BaseTool):
         return ansi_escape.sub('', line)
 
     @staticmethod
-    def _execute_code(kc: BlockingKernelClient, code: str) -> PythonSandBoxToolResponse:
-        kc.wait_for_ready()
-        kc.execute(code)
+    async def _execute_code(kc: AsyncKernelClient, code: str, timeout: float = STEP_TIMEOUT,
+                            interrupt: Optional[Callable[[], None]] = None) -> PythonSandBoxToolResponse:
+        """
+        Run code on a kernel and collect its output.
+
+        :param kc: The client of the kernel.
+        :type kc: AsyncKernelClient
+        :param code: The code to run.
+        :type code: str
+        :param timeout: Seconds the code may run.
+        :type timeout: float
+        :param interrupt: Interrupts the kernel once the code exceeds the timeout. The output up to then is kept,
+            and the kernel keeps its namespace for the next run.
+        :type interrupt: Optional[Callable[[], None]]
+        :raises SandboxException: The interrupted kernel did not get idle within KERNEL_INTERRUPT_TIMEOUT.
+        :return: The output of the code, a failure on a timeout.
+        :rtype: PythonSandBoxToolResponse
+        """
+        msg_id = kc.execute(code)
 
         result = []
         state = _Type.SUCCESS
-        start_time = time.time()
-        timeout = 60*10
+        deadline = time.monotonic() + timeout
+        interrupted = False
 
         while True:
-            if time.time() - start_time > timeout:
-                text = f'Timeout: Code execution exceeded the time limit of {timeout}'
-                result.append(text)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if interrupted:
+                    raise SandboxException(f"Kernel is still busy {KERNEL_INTERRUPT_TIMEOUT}s after an interrupt")
+                result.append(f'Timeout: Code execution exceeded the time limit of {timeout:g}s'
+                              + (' and was interrupted' if interrupt is not None else ''))
                 state = _Type.FAIL
-                break
+                if interrupt is None:
+                    break
+                # Wait for the kernel to get idle, so that the next code run is not queued behind this one
+                interrupt()
+                interrupted = True
+                deadline = time.monotonic() + KERNEL_INTERRUPT_TIMEOUT
+                continue
 
             finished = False
             try:
-                msg = kc.get_iopub_msg()
+                # Yield to the event loop while the kernel runs, other sessions keep going meanwhile
+                msg = await kc.get_iopub_msg(timeout=remaining)
+                if msg['parent_header'].get('msg_id') != msg_id:
+                    # Left over from an earlier request, e.g. the status messages of a kernel reset
+                    continue
                 msg_type = msg['msg_type']
                 logger.info(f"msg_type: {msg_type}")
                 if msg_type == 'status':
                     if msg['content'].get('execution_state') == 'idle':
                         finished = True
+                elif interrupted:
+                    # The KeyboardInterrupt traceback, and output flushed on the way out
+                    continue
                 elif msg_type == 'execute_result':
                     text = msg['content']['data'].get('text/plain', '')
                     result.append(text)
@@ -198,10 +322,8 @@ class AsyncPythonSandBoxTool(BaseTool):
                     result.append(text)
                     state = _Type.ERROR
             except queue.Empty:
-                text = 'Timeout: Code execution exceeded the time limit.'
-                result.append(text)
-                state = _Type.FAIL
-                finished = True
+                # The deadline is handled at the top of the loop
+                continue
             except Exception:
                 text = 'The code interpreter encountered an unexpected error.'
                 result.append(text)
@@ -215,12 +337,95 @@ class AsyncPythonSandBoxTool(BaseTool):
 
     async def async_run(self, req: str):
         formatted_input = self._input_handler(req)
-        if self.sandbox_id in AsyncPythonSandBoxTool._KERNEL_CLIENTS:
-            kc = AsyncPythonSandBoxTool._KERNEL_CLIENTS[self.sandbox_id]
-        else:
-            kc = self._start_kernel()
-            AsyncPythonSandBoxTool._KERNEL_CLIENTS[self.sandbox_id] = kc
-
-        return self._execute_code(kc, formatted_input)
+        timeout = self.step_timeout
+        if self._question_deadline is not None:
+            timeout = min(timeout, self._question_deadline - time.monotonic())
+            if timeout <= 0:
+                return PythonSandBoxToolResponse(
+                    sand_box_response=f'Timeout: The question exceeded its time limit of {self.question_timeout:g}s, '
+                                      f'the code was not run',
+                    _type=_Type.FAIL)
+        if self._budget is not None:
+            remaining = self._budget.remaining_sandbox_seconds()
+            if remaining is not None:
+                timeout = min(timeout, remaining)
+                if timeout <= 0:
+                    exhausted = self._budget.exhausted or "sandbox time"
+                    return PythonSandBoxToolResponse(
+                        sand_box_response=f'Timeout: The question used up its {exhausted} budget, the code was not run',
+                        _type=_Type.FAIL)
+        cache_key = None
+        self._code_runs += 1
+        if self._code_runs == 1:
+            cached_response, cache_key = await self._lookup_execution_cache(formatted_input)
+            if cached_response is not None:
+                return cached_response
+
+        if self._replay_code is not None:
+            # The first cell was served from the cache, the names it defines are used by the next cells
+            replay_code, self._replay_code = self._replay_code, None
+            # The replay is part of this step, the cell only gets what is left of its deadline
+            step_deadline = time.monotonic() + timeout
+            await self._run_code(replay_code, timeout)
+            remaining = step_deadline - time.monotonic()
+            if remaining <= 0:
+                return PythonSandBoxToolResponse(
+                    sand_box_response=f'Timeout: Code execution exceeded the time limit of {timeout:g}s while the '
+                                      f'first cell of the session was run again, the code was not run',
+                    _type=_Type.FAIL)
+            timeout = remaining
+        response = await self._run_code(formatted_input, timeout)
+        if cache_key is not None and response._type != _Type.FAIL:
+            get_execution_cache().put(cache_key, response.raw_output, response._type.value)
+        return response
+
+    async def _lookup_execution_cache(self, code: str):
+        """
+        Look up the first cell of the sandbox in the execution cache, when it is enabled and the cell is side-effect
+        free. Return the cached response, and the key to store the output under on a miss.
+        """
+        cache = get_execution_cache()
+        if cache is None:
+            return None, None
+        if not is_cacheable_cell(code):
+            cache.bypassed += 1
+            return None, None
+
+        # The key hashes the input files, which may still be being staged
+        await self._wait_for_setup_tasks()
+        cache_key = ExecutionCache.make_key(code, os.path.join(FILE_DIR, self.sandbox_id))
+        cached_output = cache.get(cache_key)
+        if cached_output is None:
+            cache.misses += 1
+            return None, cache_key
+        cache.hits += 1
+        self._replay_code = code
+        output, output_type = cached_output
+        return PythonSandBoxToolResponse(sand_box_response=unmask_sandbox_paths(output, self.sandbox_id),
+                                         _type=_Type(output_type)), None
+
+    async def _run_code(self, code: str, timeout: float) -> PythonSandBoxToolResponse:
+        start_time = time.monotonic()
+        try:
+            return await self._run_code_in_kernel(code, timeout)
+        finally:
+            if self._budget is not None:
+                self._budget.add_sandbox_seconds(time.monotonic() - start_time)
+
+    async def _run_code_in_kernel(self, code: str, timeout: float) -> PythonSandBoxToolResponse:
+        kernel = await self.wait_for_setup()
+        try:
+            return await self._execute_code(kernel.client, code, timeout, interrupt=kernel.interrupt)
+        except SandboxException as e:
+            # The code ignores the interrupt, e.g. it is stuck in a C extension. The kernel is replaced, the next
+            # code run of the sandbox starts from a fresh namespace
+            logger.warning(f"Replace kernel {kernel.kernel_id} of sandbox {self.sandbox_id}, error: {e}")
+            AsyncPythonSandBoxTool._KERNELS.pop(self.sandbox_id, None)
+            kernel.kill()
+            self.get_kernel_pool().release(kernel)
+            return PythonSandBoxToolResponse(
+                sand_box_response=f'Timeout: Code execution exceeded the time limit of {timeout:g}s and did not stop '
+                                  f'when interrupted, the interpreter was restarted and its variables are lost',
+                _type=_Type.FAIL)
 
 
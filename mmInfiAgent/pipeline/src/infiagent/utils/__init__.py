@@ -6,3 +6,5 @@ from .session_utils import *
 from .string_utils import *
 from .common_utils import *
 from .system_messages import *
+from .eval_utils import *
+from .csv_utils import *
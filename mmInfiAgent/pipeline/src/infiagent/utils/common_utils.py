@@ -0,0 +1,35 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LruMemo:
+    """
+    Thread-safe in-memory memo keeping the max_size most recently used entries.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -2,7 +2,6 @@ import yaml
 from typing import Dict, AnyStr, Union, Any
 from pathlib import Path
 
-from ..prompt import SimpleReactPrompt, ZeroShotReactPrompt
 from .logger import get_logger
 
 logger = get_logger()
@@ -15,6 +14,9 @@ class Config:
 
     @staticmethod
     def _prompt_constructor(loader, node):
+        # Imported here to avoid a cycle, the prompt package imports utils through schemas
+        from ..prompt import SimpleReactPrompt, ZeroShotReactPrompt
+
         value = node.value
         if value == "SimpleReactPrompt":
             return SimpleReactPrompt()
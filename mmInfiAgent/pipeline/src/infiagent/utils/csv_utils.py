@@ -0,0 +1,161 @@
+import os
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+from .common_utils import LruMemo
+from .file_utils import file_content_hash
+from .logger import get_logger
+
+logger = get_logger()
+
+root_directory = os.path.abspath(__file__)
+while 'infiagent' not in os.path.basename(root_directory):
+    root_directory = os.path.dirname(root_directory)
+
+# Bump the version when the summary format changes, summaries of older versions are then recomputed
+CSV_INFO_CACHE_VERSION = "v2"
+CSV_INFO_CACHE_DIR = f"{root_directory}/tmp/csv_info_cache"
+CSV_INFO_CHUNK_ROWS = 100000
+# Summaries memoised per process, by content hash
+CSV_INFO_MEMO_SIZE = 1024
+# Lines of df.info() put into the prompt, without the class and index lines
+CSV_INFO_LINES = slice(2, 20)
+
+_CSV_INFO_MEMO = LruMemo(CSV_INFO_MEMO_SIZE)
+_CSV_INFO_CACHE_DIR: Optional[str] = CSV_INFO_CACHE_DIR
+
+
+def configure_csv_info_cache(cache_dir: Optional[str] = CSV_INFO_CACHE_DIR):
+    """
+    Set the on-disk cache directory of the CSV summaries, None to only cache them in memory.
+    """
+    global _CSV_INFO_CACHE_DIR
+    _CSV_INFO_CACHE_DIR = cache_dir
+
+
+def get_csv_basic_info(file_path: str, cache_dir: Optional[str] = None) -> str:
+    """
+    Get the schema summary of a CSV file put into the prompt, i.e. the column lines of df.info().
+
+    Summaries are cached in memory and on disk by the content hash of the file, so a CSV shared by several
+    questions or runs is only summarised once. A miss hashes and scans the whole file, call it from a worker thread
+    in async code.
+
+    :param file_path: The CSV file path.
+    :type file_path: str
+    :param cache_dir: The on-disk cache directory, by default the one set by configure_csv_info_cache.
+    :type cache_dir: Optional[str]
+    :return: The schema summary.
+    :rtype: str
+    """
+    content_hash = file_content_hash(file_path)
+    info = _CSV_INFO_MEMO.get(content_hash)
+    if info is not None:
+        return info
+
+    cache_dir = cache_dir or _CSV_INFO_CACHE_DIR
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, CSV_INFO_CACHE_VERSION, content_hash[:2], f"{content_hash}.txt")
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as fr:
+                info = fr.read()
+            _CSV_INFO_MEMO.put(content_hash, info)
+            return info
+
+    info = summarize_csv(file_path)
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fw:
+            fw.write(info)
+        os.replace(tmp_path, cache_path)
+    _CSV_INFO_MEMO.put(content_hash, info)
+    return info
+
+
+def summarize_csv(file_path: str) -> str:
+    """
+    Summarise the schema of a CSV file like df.info(). The file is scanned in chunks of CSV_INFO_CHUNK_ROWS rows,
+    so at most one chunk is held in memory whatever the size of the file.
+    """
+    return "\n".join(_scan_csv_info_lines(file_path)[CSV_INFO_LINES])
+
+
+def _merge_dtypes(left, right):
+    """
+    The dtype pandas gives a column when the values of two chunks with these dtypes are read at once.
+    """
+    if left == right:
+        return left
+    if is_bool_dtype(left) or is_bool_dtype(right):
+        return np.dtype("object")
+    if is_numeric_dtype(left) and is_numeric_dtype(right):
+        return np.dtype("float64")
+    for dtype in (left, right):
+        if not is_numeric_dtype(dtype):
+            return dtype
+    return np.dtype("object")
+
+
+def _sizeof_fmt(num: float, size_qualifier: str) -> str:
+    for unit in ["bytes", "KB", "MB", "GB", "TB"]:
+        if num < 1024.0:
+            return f"{num:3.1f}{size_qualifier} {unit}"
+        num /= 1024.0
+    return f"{num:3.1f}{size_qualifier} PB"
+
+
+def _scan_csv_info_lines(file_path: str) -> List[str]:
+    columns = None
+    dtypes = None
+    non_null_counts = None
+    n_rows = 0
+    memory_usage = 0
+    for chunk in pd.read_csv(file_path, chunksize=CSV_INFO_CHUNK_ROWS):
+        if columns is None:
+            columns = list(chunk.columns)
+            dtypes = list(chunk.dtypes)
+            non_null_counts = [0] * len(columns)
+        else:
+            dtypes = [_merge_dtypes(left, right) for left, right in zip(dtypes, chunk.dtypes)]
+        non_null_counts = [count + int(chunk_count) for count, chunk_count in zip(non_null_counts, chunk.count())]
+        n_rows += len(chunk)
+        memory_usage += int(chunk.memory_usage(index=False).sum())
+
+    lines = ["<class 'pandas.core.frame.DataFrame'>", f"RangeIndex: {n_rows} entries, 0 to {n_rows - 1}"]
+    if not columns:
+        return lines + ["Empty DataFrame"]
+
+    # Same layout as df.info(), including the switches to a short summary for wide or long frames
+    dtype_names = [str(dtype) for dtype in dtypes]
+    if len(columns) > pd.get_option("display.max_info_columns"):
+        lines.append(f"Columns: {len(columns)} entries, {columns[0]} to {columns[-1]}")
+    else:
+        lines.append(f"Data columns (total {len(columns)} columns):")
+        with_counts = n_rows <= pd.get_option("display.max_info_rows")
+        headers = [" # ", "Column", "Non-Null Count", "Dtype"] if with_counts else [" # ", "Column", "Dtype"]
+        rows = []
+        for index, (column, count, dtype_name) in enumerate(zip(columns, non_null_counts, dtype_names)):
+            row = [f" {index}", str(column)]
+            if with_counts:
+                row.append(f"{count} non-null")
+            row.append(dtype_name)
+            rows.append(row)
+        widths = [max([len(header)] + [len(row[i]) for row in rows]) for i, header in enumerate(headers)]
+        lines.append("  ".join(header.ljust(width) for header, width in zip(headers, widths)))
+        lines.append("  ".join(("-" * len(header)).ljust(width) for header, width in zip(headers, widths)))
+        for row in rows:
+            lines.append("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+    dtype_counts = {}
+    for dtype_name in dtype_names:
+        dtype_counts[dtype_name] = dtype_counts.get(dtype_name, 0) + 1
+    lines.append(f"dtypes: {', '.join(f'{key}({value:d})' for key, value in sorted(dtype_counts.items()))}")
+    size_qualifier = "+" if "object" in dtype_counts else ""
+    # The RangeIndex of a frame takes 132 bytes
+    lines.append(f"memory usage: {_sizeof_fmt(memory_usage + 132, size_qualifier)}")
+    return lines
@@ -0,0 +1,364 @@
+import ast
+import glob
+import hashlib
+import json
+import os
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from .logger import get_logger
+
+logger = get_logger()
+
+SHARD_PART_INFIX = ".part-"
+RESULT_INDEX_SUFFIX = ".idx"
+RESULT_INDEX_HEADER = "#inode"
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Parse a shard spec of the form "i/n" into (shard_index, shard_count).
+
+    :param shard: The shard spec, e.g. "3/64".
+    :type shard: str
+    :raises ValueError: If the spec is malformed or the index is out of range.
+    :return: A tuple of the 0-based shard index and the number of shards.
+    :rtype: Tuple[int, int]
+    """
+    try:
+        index, count = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard spec {shard}, expected the format i/n, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard spec {shard}, shard index must be in [0, {count})")
+    return index, count
+
+
+def select_shard(rows: List[Any], shard_index: int, shard_count: int) -> List[Any]:
+    """
+    Select the rows owned by a shard. Rows are dealt round-robin so that every shard gets a similar mix of
+    question types, and a row always belongs to the same shard for a given shard count.
+    """
+    return [row for index, row in enumerate(rows) if index % shard_count == shard_index]
+
+
+def get_shard_output_path(output_path: str, shard_index: int, shard_count: int) -> str:
+    """
+    Get the part file a shard writes to, e.g. results.jsonl -> results.part-0003-of-0064.jsonl
+    """
+    root, ext = os.path.splitext(output_path)
+    return f"{root}{SHARD_PART_INFIX}{shard_index:04d}-of-{shard_count:04d}{ext}"
+
+
+def find_shard_output_paths(output_path: str) -> List[str]:
+    """
+    Find all the part files written by shards for the given output path.
+    """
+    root, ext = os.path.splitext(output_path)
+    return sorted(glob.glob(f"{glob.escape(root)}{SHARD_PART_INFIX}*-of-*{ext}"))
+
+
+def get_question_key(record: Dict[str, Any]) -> str:
+    """
+    Key identifying a benchmark question in a results file, the same key cal_eval_metric.py groups answers by.
+    """
+    return f"{record['prompt']}_{record['imgs']}"
+
+
+def _as_list(value: Any) -> Any:
+    if isinstance(value, str):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
+    return value
+
+
+def get_question_id(record: Dict[str, Any], config_path: Optional[str] = None) -> str:
+    """
+    Stable ID of a benchmark question run with a given config. Questions sharing a prompt but using different
+    images or attachments get different IDs, and so does the same question run with another config.
+
+    :param record: The benchmark row or result record, with prompt, imgs and attachments.
+    :type record: Dict[str, Any]
+    :param config_path: The agent config path the question is answered with.
+    :type config_path: Optional[str]
+    :return: The question ID.
+    :rtype: str
+    """
+    key = [record.get('prompt'), _as_list(record.get('imgs')), _as_list(record.get('attachments')), config_path]
+    return hashlib.sha256(json.dumps(key, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()[:32]
+
+
+def get_result_index_path(output_path: str) -> str:
+    return f"{output_path}{RESULT_INDEX_SUFFIX}"
+
+
+def read_result_records(path: str) -> List[Dict[str, Any]]:
+    """
+    Read the records of a results JSONL file, skipping empty and torn lines.
+    """
+    records = []
+    if not os.path.exists(path):
+        return records
+
+    with open(path, "r") as fr:
+        for line in fr:
+            try:
+                records.append(json.loads(line.strip()))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def merge_shard_outputs(output_path: str, part_paths: List[str]) -> int:
+    """
+    Merge shard part files into one deduplicated results file that cal_eval_metric.py can read directly.
+
+    Records already in the output file are kept, and the first record seen for a question wins. Questions are
+    identified by their prompt+imgs key, as cal_eval_metric.py groups them, so a record written before qids existed
+    and a re-run record with a qid are the same question. Records without a prompt or imgs fall back to their qid.
+    The merged file is written next to the output and moved into place, so a crash during the merge never leaves a
+    partial output.
+
+    :param output_path: The merged results file.
+    :type output_path: str
+    :param part_paths: The shard part files to merge into it.
+    :type part_paths: List[str]
+    :return: The number of records in the merged file.
+    :rtype: int
+    """
+    seen = set()
+    merged = []
+    for path in [output_path] + list(part_paths):
+        for record in read_result_records(path):
+            try:
+                key = get_question_key(record)
+            except KeyError:
+                key = record.get('qid')
+                if key is None:
+                    continue
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(record)
+
+    tmp_path = f"{output_path}.merging"
+    with open(tmp_path, "w") as fw:
+        for record in merged:
+            fw.write(json.dumps(record) + "\n")
+        fw.flush()
+        os.fsync(fw.fileno())
+    os.replace(tmp_path, output_path)
+    # The resume index points into the replaced file, drop it so that it is rebuilt on the next run
+    if os.path.exists(get_result_index_path(output_path)):
+        os.remove(get_result_index_path(output_path))
+
+    logger.info(f"Merged {len(part_paths)} part files into {output_path} with {len(merged)} questions")
+    return len(merged)
+
+
+class ResultWriter:
+    """
+    Append-only writer of a results JSONL file with a sidecar resume index.
+
+    Records are buffered and written in batches, each batch is fsync'd before its question IDs are added to the
+    index, so a question is never marked answered before its record is durable. The sidecar index holds one
+    "qid<TAB>end offset" line per record. On open, a torn last line left by a crash is truncated, and only the
+    records written after the last indexed offset are scanned, so resuming a large run does not re-parse the whole
+    output and checking whether a question is answered is a set lookup.
+    """
+
+    def __init__(self,
+                 output_path: str,
+                 question_id_fn: Callable[[Dict[str, Any]], str] = get_question_id,
+                 batch_size: int = 16):
+        self._output_path = output_path
+        self._index_path = get_result_index_path(output_path)
+        self._question_id_fn = question_id_fn
+        self._batch_size = batch_size
+        self._question_ids: Set[str] = set()
+        self._buffer: List[Tuple[str, str]] = []
+        self._output_file = None
+        self._index_file = None
+
+    @property
+    def question_ids(self) -> Set[str]:
+        return self._question_ids
+
+    def __contains__(self, question_id: str) -> bool:
+        return question_id in self._question_ids
+
+    def __len__(self) -> int:
+        return len(self._question_ids)
+
+    def open(self) -> "ResultWriter":
+        output_dir = os.path.dirname(os.path.abspath(self._output_path))
+        os.makedirs(output_dir, exist_ok=True)
+        if os.path.exists(self._output_path):
+            self._truncate_torn_tail()
+
+        self._output_file = open(self._output_path, "ab")
+        self._load_index(self._output_file.tell())
+        return self
+
+    @classmethod
+    def load_question_ids(cls,
+                          output_path: str,
+                          question_id_fn: Callable[[Dict[str, Any]], str] = get_question_id) -> Set[str]:
+        """
+        Read-only view of the question IDs answered in a results file, without repairing or re-indexing it.
+        """
+        if not os.path.exists(output_path):
+            return set()
+
+        question_ids, end_offset, _ = cls._read_index(get_result_index_path(output_path), output_path)
+        if question_ids is None:
+            question_ids, end_offset = set(), 0
+        for _, record in cls._scan_records(output_path, end_offset):
+            question_ids.add(cls._record_question_id(record, question_id_fn))
+        return question_ids
+
+    def write(self, record: Dict[str, Any]):
+        question_id = record.get('qid') or self._question_id_fn(record)
+        self._buffer.append((question_id, json.dumps(record) + "\n"))
+        if len(self._buffer) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+
+        offset = self._output_file.tell()
+        index_lines = []
+        chunks = []
+        for question_id, line in self._buffer:
+            data = line.encode("utf-8")
+            offset += len(data)
+            chunks.append(data)
+            index_lines.append(f"{question_id}\t{offset}\n")
+
+        self._output_file.write(b"".join(chunks))
+        self._output_file.flush()
+        os.fsync(self._output_file.fileno())
+
+        # The index is only a cache of the output, it does not need its own fsync: a lost tail is rescanned on open
+        self._index_file.write("".join(index_lines))
+        self._index_file.flush()
+
+        self._question_ids.update(question_id for question_id, _ in self._buffer)
+        self._buffer = []
+
+    def close(self):
+        if self._output_file is None:
+            return
+        self.flush()
+        self._output_file.close()
+        self._index_file.close()
+        self._output_file = None
+        self._index_file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def _truncate_torn_tail(self):
+        with open(self._output_path, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+
+            # Walk back to the last complete line
+            position = size
+            while position > 0:
+                step = min(4096, position)
+                position -= step
+                f.seek(position)
+                newline = f.read(step).rfind(b"\n")
+                if newline >= 0:
+                    position += newline + 1
+                    break
+            logger.warning(f"Truncate torn last line of {self._output_path} at offset {position}")
+            f.truncate(position)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _read_index(index_path: str, output_path: str) -> Tuple[Optional[Set[str]], int, int]:
+        """
+        Read the sidecar index. Return the indexed question IDs, the output offset they cover and the length of the
+        well-formed part of the index, or None if the index is missing or does not belong to the output file.
+        """
+        if not os.path.exists(index_path) or not os.path.exists(output_path):
+            return None, 0, 0
+
+        question_ids = set()
+        end_offset = 0
+        with open(index_path, "rb") as fr:
+            header = fr.readline()
+            if header.decode("utf-8", errors="replace").rstrip("\n").split("\t") != \
+                    [RESULT_INDEX_HEADER, str(os.stat(output_path).st_ino)]:
+                return None, 0, 0
+            valid_length = len(header)
+            for line in fr:
+                parts = line.decode("utf-8", errors="replace").rstrip("\n").split("\t")
+                # A line without newline was torn by a crash, its offset may be cut short
+                if not line.endswith(b"\n") or len(parts) != 2 or not parts[1].isdigit():
+                    break
+                question_ids.add(parts[0])
+                end_offset = int(parts[1])
+                valid_length += len(line)
+
+        if end_offset > os.path.getsize(output_path):
+            return None, 0, 0
+        return question_ids, end_offset, valid_length
+
+    @staticmethod
+    def _scan_records(output_path: str, start_offset: int):
+        """
+        Yield (end offset, record) for every complete record of the output file after the start offset.
+        """
+        end_offset = start_offset
+        with open(output_path, "rb") as fr:
+            fr.seek(start_offset)
+            for line in fr:
+                if not line.endswith(b"\n"):
+                    break
+                end_offset += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                yield end_offset, record
+
+    @staticmethod
+    def _record_question_id(record: Dict[str, Any], question_id_fn: Callable[[Dict[str, Any]], str]) -> str:
+        return record.get('qid') or question_id_fn(record)
+
+    def _load_index(self, output_size: int):
+        question_ids, end_offset, valid_length = self._read_index(self._index_path, self._output_path)
+        if question_ids is None:
+            logger.info(f"Rebuild resume index {self._index_path}")
+            question_ids, end_offset = set(), 0
+            with open(self._index_path, "w") as fw:
+                fw.write(f"{RESULT_INDEX_HEADER}\t{os.stat(self._output_path).st_ino}\n")
+        else:
+            with open(self._index_path, "rb+") as f:
+                f.truncate(valid_length)
+
+        self._question_ids = question_ids
+        self._index_file = open(self._index_path, "a")
+
+        if end_offset < output_size:
+            # Records written after the last indexed batch, e.g. when the run crashed before indexing them
+            missing = []
+            for record_end_offset, record in self._scan_records(self._output_path, end_offset):
+                question_id = self._record_question_id(record, self._question_id_fn)
+                self._question_ids.add(question_id)
+                missing.append(f"{question_id}\t{record_end_offset}\n")
+            self._index_file.write("".join(missing))
+            self._index_file.flush()
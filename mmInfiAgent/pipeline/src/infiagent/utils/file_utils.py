@@ -1,11 +1,17 @@
 import csv
+import errno
+import hashlib
 import io
 import logging
 import os
 import shutil
+import stat
+import sys
+import tempfile
 
 import chardet
 
+from .common_utils import LruMemo
 from .logger import get_logger
 
 root_directory = os.path.abspath(__file__)
@@ -15,11 +21,28 @@ while 'infiagent' not in os.path.basename(root_directory):
 TEMP_FILE_UPLOAD_DIR = f"{root_directory}/tmp/upload_files/"
 MAX_INPUT_FILE_SIZE = 1024 * 1024 * 1024
 SAMPLE_FILE_SIZE = 2048
+HASH_CHUNK_SIZE = 1024 * 1024
+# Content hashes memoised per process, by inode, size and modification time
+FILE_HASH_MEMO_SIZE = 4096
 CSV_DEFAULT_DELIMITER = ","
 CSV_DELIMITERS = [',', '\t', ';', '|', ' ']
+# Linux ioctl cloning a file into another one, sharing its blocks copy-on-write (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+STAGE_MODE_COPY = "copy"
+STAGE_MODE_REFLINK = "reflink"
+STAGE_MODE_HARDLINK = "hardlink"
+STAGE_MODE_SYMLINK = "symlink"
+STAGE_MODE_AUTO = "auto"
+STAGE_MODES = [STAGE_MODE_AUTO, STAGE_MODE_REFLINK, STAGE_MODE_HARDLINK, STAGE_MODE_SYMLINK, STAGE_MODE_COPY]
+# Directory under the upload directory holding the read-only copies the sandboxes share, see _link_shared_copy
+STAGE_SHARED_DIR = ".shared"
 
 logger = get_logger()
 
+_FILE_HASH_MEMO = LruMemo(FILE_HASH_MEMO_SIZE)
+_CSV_CONVERSION_MEMO = LruMemo(FILE_HASH_MEMO_SIZE)
+
 
 def clear_files(upload_file_dir):
     for filename in os.listdir(upload_file_dir):
@@ -105,6 +128,24 @@ def _process_local_csv_file(uploaded_file, output_dir):
     return new_file_path
 
 
+def _detect_delimiter(sample: bytes):
+    """
+    Detect the delimiter of a CSV file from a sample of its first bytes, None if it can't be determined.
+    """
+    # Use chardet to detect the encoding
+    detected = chardet.detect(sample)
+    encoding = detected.get('encoding', 'utf-8') or 'utf-8'
+    decoded_sample = sample.decode(encoding, errors='replace')
+
+    sniffer = csv.Sniffer()
+    try:
+        return sniffer.sniff(decoded_sample, delimiters=''.join(CSV_DELIMITERS)).delimiter
+    except (csv.Error, UnicodeDecodeError) as e:
+        logger.warning("Unable to confidently determine the delimiter for the CSV content. Return original file. "
+                       "error: {}".format(str(e)))
+        return None
+
+
 def convert_delimiter_to_comma(content_stream: io.BytesIO) -> (io.BytesIO, bool):
     """
     Detects the delimiter of a CSV content stream and converts it to comma if it's not already.
@@ -118,17 +159,8 @@ def convert_delimiter_to_comma(content_stream: io.BytesIO) -> (io.BytesIO, bool)
     sample = content_stream.read(SAMPLE_FILE_SIZE)
     content_stream.seek(0)
 
-    # Use chardet to detect the encoding
-    detected = chardet.detect(sample)
-    encoding = detected.get('encoding', 'utf-8') or 'utf-8'
-    decoded_sample = sample.decode(encoding, errors='replace')
-
-    sniffer = csv.Sniffer()
-    try:
-        delimiter = sniffer.sniff(decoded_sample, delimiters=''.join(CSV_DELIMITERS)).delimiter
-    except (csv.Error, UnicodeDecodeError) as e:
-        logger.warning("Unable to confidently determine the delimiter for the CSV content. Return original file. "
-                       "error: {}".format(str(e)))
+    delimiter = _detect_delimiter(sample)
+    if delimiter is None:
         return content_stream, False
 
     if delimiter == CSV_DEFAULT_DELIMITER:
@@ -153,4 +185,166 @@ def convert_delimiter_to_comma(content_stream: io.BytesIO) -> (io.BytesIO, bool)
 def get_file_name_and_path(input_file: str):
     file_name = input_file.split("/")[-1]
     tos_path = input_file.replace(file_name, "")
-    return file_name, tos_path
\ No newline at end of file
+    return file_name, tos_path
+
+
+def csv_needs_conversion(file_path: str) -> bool:
+    """
+    Check from a sample of its first bytes whether a CSV file uses another delimiter than comma. The result is
+    memoised per inode, size and modification time, like file_content_hash.
+    """
+    st = os.stat(file_path)
+    memo_key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    needs_conversion = _CSV_CONVERSION_MEMO.get(memo_key)
+    if needs_conversion is not None:
+        return needs_conversion
+
+    with open(file_path, 'rb') as f:
+        sample = f.read(SAMPLE_FILE_SIZE)
+    delimiter = _detect_delimiter(sample)
+    needs_conversion = delimiter is not None and delimiter != CSV_DEFAULT_DELIMITER
+    _CSV_CONVERSION_MEMO.put(memo_key, needs_conversion)
+    return needs_conversion
+
+
+def stage_files(file_paths, sandbox_id, mode=STAGE_MODE_AUTO, upload_dir=TEMP_FILE_UPLOAD_DIR):
+    """
+    Stage local files into the upload directory of a sandbox without reading them into memory.
+
+    Unlike upload_files, the files are cloned or linked into the sandbox directory instead of written from an
+    in-memory copy. Only a CSV whose delimiter has to be converted to comma is rewritten.
+
+    :param file_paths: The paths of the files to stage.
+    :type file_paths: List[str]
+    :param sandbox_id: The sandbox the files are staged for.
+    :type sandbox_id: str
+    :param mode: How to stage a file, one of STAGE_MODES. "auto" tries a reflink, then a hardlink to a read-only
+        copy of the source shared by all sandboxes, and falls back to a copy of its own, so sandbox code writing to
+        a staged file never changes the source file. "hardlink" and "symlink" share the source file itself with the
+        sandbox, it is not made read-only as that would change the permissions of the source, so they are only
+        safe for read-only code. All modes fall back to a copy when they are not supported.
+    :type mode: str
+    :param upload_dir: The root directory of the sandbox upload directories.
+    :type upload_dir: str
+    :raises ValueError: If the mode is unknown or a file is larger than MAX_INPUT_FILE_SIZE.
+    :return: The staged file paths.
+    :rtype: List[str]
+    """
+    if mode not in STAGE_MODES:
+        raise ValueError(f"Invalid stage mode {mode}, expected one of {STAGE_MODES}")
+
+    staged_files = []
+    if not file_paths:
+        logging.info("No file upload")
+        return staged_files
+
+    file_dir = os.path.join(upload_dir, sandbox_id)
+    if os.path.exists(file_dir):
+        clear_files(file_dir)
+    os.makedirs(file_dir)
+
+    for file_path in file_paths:
+        staged_files.append(_stage_file(file_path, file_dir, mode))
+
+    logging.info("Staged {} files with mode {}.".format(len(staged_files), mode))
+    return staged_files
+
+
+def _stage_file(file_path, output_dir, mode):
+    if os.path.getsize(file_path) > MAX_INPUT_FILE_SIZE:
+        raise ValueError(f"File {file_path} is larger than 1 GB")
+
+    new_file_path = os.path.join(output_dir, os.path.basename(file_path))
+    if file_path.endswith('.csv') and csv_needs_conversion(file_path):
+        with open(file_path, 'rb') as f:
+            converted_file_stream, _ = convert_delimiter_to_comma(io.BytesIO(f.read()))
+        with open(new_file_path, 'wb') as new_file:
+            new_file.write(converted_file_stream.getvalue())
+        return new_file_path
+
+    candidates = {
+        STAGE_MODE_AUTO: [_reflink_file, _link_shared_copy],
+        STAGE_MODE_REFLINK: [_reflink_file],
+        STAGE_MODE_HARDLINK: [_hardlink_file],
+        STAGE_MODE_SYMLINK: [_symlink_file],
+        STAGE_MODE_COPY: [],
+    }[mode]
+
+    for stage_fn in candidates:
+        try:
+            stage_fn(file_path, new_file_path)
+            return new_file_path
+        except OSError as e:
+            logger.debug(f"Failed to stage {file_path} with {stage_fn.__name__}, error: {e}")
+            if os.path.lexists(new_file_path):
+                os.unlink(new_file_path)
+
+    shutil.copyfile(file_path, new_file_path)
+    return new_file_path
+
+
+def _reflink_file(src, dst):
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.ENOTSUP, "reflink is only supported on linux")
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _link_shared_copy(src, dst):
+    # Without copy-on-write the source is copied once for all the sandboxes, which get hardlinks to the read-only copy.
+    # Root ignores the permissions and could change the copy of the other sandboxes, it gets a copy of its own
+    if getattr(os, "geteuid", None) is not None and os.geteuid() == 0:
+        raise OSError(errno.EPERM, "read-only files are writable by root")
+    st = os.stat(src)
+    shared_dir = os.path.join(os.path.dirname(os.path.dirname(dst)), STAGE_SHARED_DIR,
+                              f"{st.st_dev:x}-{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}")
+    shared_path = os.path.join(shared_dir, os.path.basename(src))
+    if not os.path.exists(shared_path):
+        os.makedirs(shared_dir, exist_ok=True)
+        # Written under a temp name first, so a concurrent session never links a partial copy
+        fd, tmp_path = tempfile.mkstemp(dir=shared_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp_path)
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp_path, shared_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    os.link(shared_path, dst)
+
+
+def _hardlink_file(src, dst):
+    # A hardlink shares the inode with the source file, sandbox code writing to it changes the source
+    os.link(src, dst)
+
+
+def _symlink_file(src, dst):
+    os.symlink(os.path.abspath(src), dst)
+
+
+def file_content_hash(file_path: str) -> str:
+    """
+    Get the sha256 of a file content. Hashes are memoised per inode, size and modification time, so that a file
+    staged again for another session, or hardlinked or symlinked to the same data, is only read once per process.
+
+    :param file_path: The file path.
+    :type file_path: str
+    :return: The hex digest of the file content.
+    :rtype: str
+    """
+    st = os.stat(file_path)
+    memo_key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    digest = _FILE_HASH_MEMO.get(memo_key)
+    if digest is not None:
+        return digest
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    _FILE_HASH_MEMO.put(memo_key, digest)
+    return digest
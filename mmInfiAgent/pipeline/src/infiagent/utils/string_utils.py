@@ -36,14 +36,33 @@ def extract_urls(text):
 
 def replace_latex_format(s):
     # replace \\(...\\) format
-    s = re.sub(r'\\\((.*?)\\\)', r'$$\1$$', s, flags=re.DOTALL)
+    s = _replace_delimited(s, '\\(', '\\)')
 
     # replace \\[...\\] format
-    s = re.sub(r'\\\[(.*?)\\\]', r'$$\1$$', s, flags=re.DOTALL)
+    s = _replace_delimited(s, '\\[', '\\]')
 
     return s
 
 
+def _replace_delimited(s, opener, closer):
+    # Each opener is paired with the first closer after it, like a lazy regex, but in one pass: without a closer
+    # after an opener there is none after the later openers either
+    parts = []
+    position = 0
+    while True:
+        start = s.find(opener, position)
+        if start < 0:
+            break
+        end = s.find(closer, start + len(opener))
+        if end < 0:
+            break
+        parts.append(s[position:start])
+        parts.append('$$' + s[start + len(opener):end] + '$$')
+        position = end + len(closer)
+    parts.append(s[position:])
+    return ''.join(parts)
+
+
 def extract_and_replace_url(text):
     url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
     all_matched_urls = re.findall(url_pattern, text)
@@ -25,3 +25,6 @@ AGENT_FAILED_CN = f"{SYSTEM_MESSAGE_PREFIX_CH} 对不起，模型暂时无法回
 AGENT_EXCEED_MAX_RETRY_EN = f"{SYSTEM_MESSAGE_PREFIX_EN} Sorry agent unable to answer the questions within max " \
                             f"retry, please try another question."
 AGENT_EXCEED_MAX_RETRY_CN = f"{SYSTEM_MESSAGE_PREFIX_CH} 对不起， 模型暂时无法在规定重试次数内回答这个问题，请换一个问题重试."
+AGENT_BUDGET_EXHAUSTED_EN = f"{SYSTEM_MESSAGE_PREFIX_EN} Sorry agent unable to answer the question within its " \
+                            f"{{}} budget."
+AGENT_BUDGET_EXHAUSTED_CN = f"{SYSTEM_MESSAGE_PREFIX_CH} 对不起，模型未能在{{}}预算内回答这个问题."
@@ -0,0 +1,89 @@
+import json
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+
+MOCK_SERVER_PATH = Path(__file__).parents[2] / "activities" / "mock_llm_server.py"
+
+AGENT_CONFIG = """
+name: react_agent
+module_name: infiagent.agent.react
+class_name: AsyncReactAgent
+prompt_template: !prompt ZeroShotReactPrompt
+llm:
+  model_name: local-model
+  module_name: infiagent.llm.client.vllm_openai
+  class_name: VLlmOpenAIClient
+  params:
+    temperature: 0.2
+plugins:
+  - name: python_code_sandbox
+    type: tool
+    config:
+      name: python_code_sandbox
+      description: Python code sandbox
+      module_name: infiagent.tools
+      class_name: AsyncPythonSandBoxTool
+"""
+
+
+def _write_agent_config(dir_path, api_base=None):
+    config = AGENT_CONFIG
+    if api_base is not None:
+        config = config.replace("  params:\n", f"  api_base: {api_base}\n  params:\n")
+    config_path = dir_path / "agent.yaml"
+    config_path.write_text(config)
+    return str(config_path)
+
+
+def _start_server(*server_args):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([sys.executable, str(MOCK_SERVER_PATH), "--port", str(port), *server_args])
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            httpx.get(f"{base_url}/stats")
+            return process, base_url
+        except httpx.TransportError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Mock LLM server did not start")
+
+
+@pytest.fixture(scope="class")
+def agent_config(request, tmp_path_factory):
+    """
+    Writes the agent config to a temporary file and sets its path as `config_path` on the test class.
+    """
+    request.cls.config_path = _write_agent_config(tmp_path_factory.mktemp("agent_config"))
+
+
+@pytest.fixture(scope="class")
+def mock_llm_server(request, tmp_path_factory):
+    """
+    Starts the mock LLM server for the test class and sets `base_url` and `config_path` on it.
+
+    The server is started with the class's `MOCK_SERVER_ARGS`, and with `MOCK_SERVER_SCRIPT` as its
+    script of completions when the class defines one.
+    """
+    tmp_dir = tmp_path_factory.mktemp("mock_llm_server")
+    server_args = list(getattr(request.cls, "MOCK_SERVER_ARGS", []))
+    script = getattr(request.cls, "MOCK_SERVER_SCRIPT", None)
+    if script is not None:
+        script_path = tmp_dir / "script.json"
+        script_path.write_text(json.dumps(script))
+        server_args = ["--script", str(script_path), *server_args]
+    process, base_url = _start_server(*server_args)
+    request.cls.base_url = base_url
+    request.cls.config_path = _write_agent_config(tmp_dir, api_base=f"{base_url}/v1")
+    yield
+    process.kill()
+    process.wait()
@@ -0,0 +1,48 @@
+import asyncio
+import unittest
+
+import pytest
+
+from infiagent.agent import AgentFactory
+from infiagent.schemas import AgentObservation
+
+
+
+@pytest.mark.usefixtures("agent_config")
+class TestAgentFactory(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = AgentFactory()
+
+    def test_agents_share_prototype(self):
+        async def _acquire():
+            return await asyncio.gather(*[self.factory.acquire(self.config_path) for _ in range(3)])
+
+        agents = asyncio.run(_acquire())
+        self.assertEqual(len(self.factory._prototypes), 1)
+        self.assertTrue(all(agent.llm is agents[0].llm for agent in agents))
+
+        sandboxes = [agent.plugins_map["python_code_sandbox"] for agent in agents]
+        asyncio.run(sandboxes[0].set_sandbox_id("abc"))
+        self.assertIsNone(sandboxes[1].sandbox_id)
+
+    def test_overrides_get_own_prototype(self):
+        agent = asyncio.run(self.factory.acquire(self.config_path, temperature=0.9))
+        self.assertEqual(agent.llm.params["temperature"], 0.9)
+        agent = asyncio.run(self.factory.acquire(self.config_path))
+        self.assertEqual(agent.llm.params["temperature"], 0.2)
+
+    def test_released_agent_is_cleared_and_reused(self):
+        agent = asyncio.run(self.factory.acquire(self.config_path))
+        asyncio.run(agent.plugins_map["python_code_sandbox"].set_sandbox_id("abc"))
+        agent.intermediate_steps.append(AgentObservation(formatted_output="", raw_output="", tool="x"))
+
+        self.factory.release(agent)
+        reused = asyncio.run(self.factory.acquire(self.config_path))
+        self.assertIs(reused, agent)
+        self.assertEqual(reused.intermediate_steps, [])
+        self.assertIsNone(reused.plugins_map["python_code_sandbox"].sandbox_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+from unittest import mock
+
+import pandas as pd
+
+from infiagent.utils import csv_utils, get_csv_basic_info, file_content_hash, LruMemo
+
+
+class TestCsvUtils(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        self.csv_path = os.path.join(self.tmp_dir, "data.csv")
+        with open(self.csv_path, "w") as fw:
+            fw.write("id,score,name,flag\n")
+            for i in range(25):
+                score = "" if i == 13 else str(i * 1.5)
+                name = "" if i % 7 == 0 else f"n{i}"
+                fw.write(f"{i},{score},{name},{i % 2 == 0}\n")
+
+    def test_scan_matches_full_read(self):
+        output = StringIO()
+        pd.read_csv(self.csv_path).info(buf=output)
+        expected = output.getvalue().splitlines()
+
+        with mock.patch.object(csv_utils, "CSV_INFO_CHUNK_ROWS", 10):
+            lines = csv_utils._scan_csv_info_lines(self.csv_path)
+        # The class and index lines are not put into the prompt and memory usage is an estimate
+        self.assertEqual(lines[2:-1], expected[2:-1])
+
+    def test_summary_is_cached_by_content(self):
+        info = get_csv_basic_info(self.csv_path, cache_dir=self.cache_dir)
+        self.assertTrue(info.startswith("Data columns (total 4 columns):"))
+
+        copy_path = os.path.join(self.tmp_dir, "copy.csv")
+        shutil.copyfile(self.csv_path, copy_path)
+        self.assertEqual(file_content_hash(copy_path), file_content_hash(self.csv_path))
+        csv_utils._CSV_INFO_MEMO.clear()
+        with mock.patch.object(csv_utils, "summarize_csv") as summarize_csv:
+            self.assertEqual(get_csv_basic_info(copy_path, cache_dir=self.cache_dir), info)
+        summarize_csv.assert_not_called()
+
+    def test_summary_is_scanned_in_chunks(self):
+        with mock.patch.object(csv_utils, "CSV_INFO_CHUNK_ROWS", 10), \
+                mock.patch.object(pd, "read_csv", wraps=pd.read_csv) as read_csv:
+            info = csv_utils.summarize_csv(self.csv_path)
+        self.assertEqual(read_csv.call_args.kwargs["chunksize"], 10)
+        self.assertIn("0   id      25 non-null     int64", info)
+
+    def test_memo_keeps_recent_entries(self):
+        memo = LruMemo(2)
+        memo.put("a", 1)
+        memo.put("b", 2)
+        self.assertEqual(memo.get("a"), 1)
+        memo.put("c", 3)
+        self.assertIsNone(memo.get("b"))
+        self.assertEqual((memo.get("a"), memo.get("c"), len(memo)), (1, 3, 2))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
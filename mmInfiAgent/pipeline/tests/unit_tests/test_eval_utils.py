@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from infiagent.utils import parse_shard, select_shard, get_shard_output_path, find_shard_output_paths, \
+    merge_shard_outputs, get_question_id, get_result_index_path, ResultWriter
+
+
+class TestEvalUtils(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.tmp_dir, "results.jsonl")
+
+    def _write_records(self, path, records, torn_tail=""):
+        with open(path, "w") as fw:
+            for record in records:
+                fw.write(json.dumps(record) + "\n")
+            fw.write(torn_tail)
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard("3/64"), (3, 64))
+        for shard in ["4/4", "-1/4", "1", "a/b", "0/0"]:
+            with self.assertRaises(ValueError):
+                parse_shard(shard)
+
+    def test_select_shard_covers_all_rows_once(self):
+        rows = list(range(10))
+        shards = [select_shard(rows, index, 3) for index in range(3)]
+        self.assertEqual(shards[0], [0, 3, 6, 9])
+        self.assertEqual(sorted(row for shard in shards for row in shard), rows)
+
+    def test_shard_output_path(self):
+        part_path = get_shard_output_path(self.output_path, 3, 64)
+        self.assertEqual(part_path, os.path.join(self.tmp_dir, "results.part-0003-of-0064.jsonl"))
+
+        for index in range(2):
+            open(get_shard_output_path(self.output_path, index, 2), "w").close()
+        self.assertEqual(len(find_shard_output_paths(self.output_path)), 2)
+
+    def test_merge_deduplicates_questions(self):
+        part_0 = get_shard_output_path(self.output_path, 0, 2)
+        part_1 = get_shard_output_path(self.output_path, 1, 2)
+        self._write_records(self.output_path, [{"prompt": "a", "imgs": "[]", "response": "old"}])
+        # A re-run record has a qid, the old record of the same question doesn't
+        self._write_records(part_0, [{"prompt": "a", "imgs": "[]", "qid": "q-a", "response": "new"},
+                                     {"prompt": "a", "imgs": "['1.png']", "response": "img"}])
+        self._write_records(part_1, [{"prompt": "b", "imgs": "[]", "response": "b"}], torn_tail='{"prompt": "c"')
+
+        self.assertEqual(merge_shard_outputs(self.output_path, [part_0, part_1]), 3)
+        with open(self.output_path) as fr:
+            records = [json.loads(line) for line in fr]
+        self.assertEqual([record["response"] for record in records], ["old", "img", "b"])
+
+    def test_question_id(self):
+        record = {"prompt": "a", "imgs": "['1.png']", "attachments": "[]"}
+        self.assertEqual(get_question_id(record), get_question_id(dict(record, imgs=['1.png'])))
+        self.assertNotEqual(get_question_id(record), get_question_id(dict(record, imgs="[]")))
+        self.assertNotEqual(get_question_id(record), get_question_id(record, config_path="other.yaml"))
+
+    def test_result_writer_resumes(self):
+        with ResultWriter(self.output_path, batch_size=2) as writer:
+            for prompt in ["a", "b", "c"]:
+                writer.write({"prompt": prompt, "imgs": "[]", "response": prompt})
+        self.assertEqual(len(ResultWriter.load_question_ids(self.output_path)), 3)
+
+        # A crash after writing a record but before indexing it, followed by a torn line
+        with open(self.output_path, "a") as fw:
+            fw.write(json.dumps({"prompt": "d", "imgs": "[]"}) + "\n" + '{"prompt": "e"')
+
+        with ResultWriter(self.output_path) as writer:
+            self.assertIn(get_question_id({"prompt": "d", "imgs": "[]"}), writer)
+            self.assertEqual(len(writer), 4)
+        with open(self.output_path) as fr:
+            self.assertEqual(len([json.loads(line) for line in fr]), 4)
+
+    def test_result_writer_rebuilds_invalid_index(self):
+        self._write_records(self.output_path, [{"prompt": "a", "imgs": "[]"}])
+        with open(get_result_index_path(self.output_path), "w") as fw:
+            fw.write("#inode\t0\nstale\t999\n")
+
+        with ResultWriter(self.output_path) as writer:
+            self.assertEqual(writer.question_ids, {get_question_id({"prompt": "a", "imgs": "[]"})})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
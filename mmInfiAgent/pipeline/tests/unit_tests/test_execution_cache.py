@@ -0,0 +1,114 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from infiagent.tools import AsyncPythonSandBoxTool, ExecutionCache, configure_execution_cache
+from infiagent.tools.code_sandbox import is_cacheable_cell
+from infiagent.tools.code_sandbox.python_code_sandbox import PythonSandBoxToolResponse, _Type
+from infiagent.utils import stage_files
+
+FIRST_CELL = ("```python\n"
+              "import pandas as pd\n"
+              "df = pd.read_csv('upload_files/{sandbox_id}/data.csv')\n"
+              "print(df.head())\n"
+              "```")
+
+
+class TestExecutionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmp_dir, "data.csv")
+        with open(self.csv_path, "w") as fw:
+            fw.write("a,b\n1,2\n3,4\n")
+
+    def test_cacheable_cells(self):
+        self.assertTrue(is_cacheable_cell("import pandas as pd\ndf = pd.read_csv('data.csv')\n"
+                                          "print([c for c in df.columns])\ndf.info()"))
+        self.assertTrue(is_cacheable_cell("def f(x):\n    return x + 1\nprint(f(1))"))
+        for code in ["df.head()",
+                     "import pandas as pd\npd.read_csv('data.csv').to_csv('out.csv')",
+                     "import numpy as np\nprint(np.random.rand(3))",
+                     "from numpy.random import rand",
+                     "import os\nprint(os.listdir('.'))",
+                     "print(open('data.csv').read())",
+                     "import pandas as pd\nprint(pd.Timestamp.now())",
+                     "%matplotlib inline"]:
+            self.assertFalse(is_cacheable_cell(code), code)
+
+    def test_keys(self):
+        input_dir = os.path.join(self.tmp_dir, "upload_files", "abc")
+        stage_files([self.csv_path], "abc", "copy", upload_dir=os.path.join(self.tmp_dir, "upload_files"))
+        key = ExecutionCache.make_key("x = pd.read_csv('upload_files/abc/data.csv')", input_dir)
+        # Formatting, comments and the sandbox id don't change the key
+        self.assertEqual(key, ExecutionCache.make_key("x=pd.read_csv( 'upload_files/def/data.csv' )  # load",
+                                                      input_dir))
+        with open(os.path.join(input_dir, "data.csv"), "a") as fw:
+            fw.write("5,6\n")
+        self.assertNotEqual(key, ExecutionCache.make_key("x = pd.read_csv('upload_files/abc/data.csv')", input_dir))
+
+    def test_first_cell_is_served_without_a_kernel(self):
+        async def _run():
+            cache = configure_execution_cache(path=os.path.join(self.tmp_dir, "cache.sqlite"))
+            recorded = AsyncPythonSandBoxTool(name="python_code_sandbox", description="")
+            await recorded.set_sandbox_id("recorded")
+            stage_files([self.csv_path], "recorded", "symlink")
+            output = await recorded.async_run(FIRST_CELL.format(sandbox_id="recorded"))
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+            replayed = AsyncPythonSandBoxTool(name="python_code_sandbox", description="")
+            await replayed.set_sandbox_id("replayed")
+            stage_files([self.csv_path], "replayed", "symlink")
+            self.assertEqual((await replayed.async_run(FIRST_CELL.format(sandbox_id="replayed"))).output_text,
+                             output.output_text)
+            self.assertEqual(cache.hits, 1)
+            self.assertNotIn("replayed", AsyncPythonSandBoxTool._KERNELS)
+
+            # The next cell sees the names the cached cell defines
+            second = await replayed.async_run("```python\nprint(df['b'].sum())\n```")
+            self.assertEqual(second.raw_output.strip(), "6")
+            # Only the first cell of a session is cached
+            await replayed.async_run("```python\nprint(1)\n```")
+            self.assertEqual((cache.hits, cache.misses, cache.bypassed), (1, 1, 0))
+
+            for sandbox_id in ["recorded", "replayed"]:
+                AsyncPythonSandBoxTool.kill_kernels(sandbox_id)
+            await AsyncPythonSandBoxTool.get_kernel_pool().close()
+            configure_execution_cache(enabled=False)
+
+        asyncio.run(_run())
+
+    def test_replay_runs_under_the_deadline_of_the_cell(self):
+        timeouts = []
+
+        async def _run_code_in_kernel(code, timeout):
+            timeouts.append(timeout)
+            # The replayed first cell takes 1.5 seconds
+            await asyncio.sleep(1.5 if code == "x = 1" else 0)
+            return PythonSandBoxToolResponse(sand_box_response="", _type=_Type.SUCCESS)
+
+        async def _run(step_timeout):
+            sandbox = AsyncPythonSandBoxTool(name="python_code_sandbox", description="", step_timeout=step_timeout)
+            await sandbox.set_sandbox_id("deadline")
+            sandbox._replay_code = "x = 1"
+            with mock.patch.object(sandbox, "_run_code_in_kernel", _run_code_in_kernel):
+                return await sandbox.async_run("```python\nprint(x)\n```")
+
+        asyncio.run(_run(2))
+        self.assertEqual(timeouts[0], 2)
+        self.assertLess(timeouts[1], 0.6)
+
+        timeouts.clear()
+        response = asyncio.run(_run(1))
+        self.assertEqual(len(timeouts), 1)
+        self.assertIn("the code was not run", response.output_text)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import csv
+import errno
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from infiagent.utils import file_utils, stage_files, csv_needs_conversion, clear_files
+
+
+def _no_reflink(src, dst):
+    raise OSError(errno.ENOTSUP, "reflink is not supported")
+
+
+class TestFileStaging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, "src")
+        self.upload_dir = os.path.join(self.tmp_dir, "upload_files")
+        os.makedirs(self.src_dir)
+
+        self.csv_comma = self._write("comma.csv", b"col1,col2,col3\n1,2,3\n4,5,6\n")
+        self.csv_semicolon = self._write("semicolon.csv", b"col1;col2;col3\n1;2;3\n4;5;6\n")
+        self.img = self._write("1.png", b"\x89PNG\r\n\x1a\n")
+
+    def _write(self, name, data):
+        path = os.path.join(self.src_dir, name)
+        with open(path, "wb") as fw:
+            fw.write(data)
+        return path
+
+    def test_csv_needs_conversion(self):
+        self.assertFalse(csv_needs_conversion(self.csv_comma))
+        self.assertTrue(csv_needs_conversion(self.csv_semicolon))
+        # The sniff is done once per file
+        with mock.patch.object(file_utils, "_detect_delimiter") as detect_delimiter:
+            self.assertTrue(csv_needs_conversion(self.csv_semicolon))
+        detect_delimiter.assert_not_called()
+
+    def test_stage_links_files(self):
+        for mode in ["hardlink", "symlink", "copy", "auto"]:
+            staged = stage_files([self.csv_comma, self.img], "sid", mode, upload_dir=self.upload_dir)
+            self.assertEqual(staged, [os.path.join(self.upload_dir, "sid", "comma.csv"),
+                                      os.path.join(self.upload_dir, "sid", "1.png")])
+            with open(staged[1], "rb") as fr:
+                self.assertEqual(fr.read(), b"\x89PNG\r\n\x1a\n")
+        self.assertFalse(os.path.islink(staged[0]))
+
+        staged = stage_files([self.img], "sid", "hardlink", upload_dir=self.upload_dir)
+        self.assertEqual(os.stat(staged[0]).st_ino, os.stat(self.img).st_ino)
+        staged = stage_files([self.img], "sid", "symlink", upload_dir=self.upload_dir)
+        self.assertTrue(os.path.islink(staged[0]))
+
+        # Clearing the sandbox removes the links only
+        clear_files(os.path.join(self.upload_dir, "sid"))
+        self.assertTrue(os.path.exists(self.img))
+
+    def test_auto_mode_protects_the_source(self):
+        mode = os.stat(self.csv_comma).st_mode
+        staged = stage_files([self.csv_comma], "sid", "auto", upload_dir=self.upload_dir)
+        self.assertNotEqual(os.stat(staged[0]).st_ino, os.stat(self.csv_comma).st_ino)
+        with open(staged[0], "w") as fw:
+            fw.write("changed\n")
+        with open(self.csv_comma, "rb") as fr:
+            self.assertEqual(fr.read(), b"col1,col2,col3\n1,2,3\n4,5,6\n")
+        # Linking doesn't touch the permissions of the source either
+        stage_files([self.csv_comma], "sid", "hardlink", upload_dir=self.upload_dir)
+        self.assertEqual(os.stat(self.csv_comma).st_mode, mode)
+
+    def test_auto_mode_shares_a_read_only_copy(self):
+        mode = os.stat(self.img).st_mode
+        no_reflink = mock.patch.object(file_utils, "_reflink_file", _no_reflink)
+        with no_reflink, mock.patch("os.geteuid", return_value=1000):
+            first = stage_files([self.img], "first", "auto", upload_dir=self.upload_dir)[0]
+            second = stage_files([self.img], "second", "auto", upload_dir=self.upload_dir)[0]
+        # Without copy-on-write the sandboxes link to the same read-only copy, the source keeps its permissions
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertNotEqual(os.stat(first).st_ino, os.stat(self.img).st_ino)
+        self.assertFalse(os.stat(first).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        self.assertEqual(os.stat(self.img).st_mode, mode)
+
+        # Root could write to the shared copy, it gets a copy of its own
+        with no_reflink, mock.patch("os.geteuid", return_value=0):
+            own = stage_files([self.img], "own", "auto", upload_dir=self.upload_dir)[0]
+        self.assertNotEqual(os.stat(own).st_ino, os.stat(first).st_ino)
+
+    def test_stage_converts_csv_delimiter(self):
+        staged = stage_files([self.csv_semicolon], "sid", "symlink", upload_dir=self.upload_dir)
+        self.assertFalse(os.path.islink(staged[0]))
+        with open(staged[0], "r") as fr:
+            self.assertEqual(list(csv.reader(fr)), [['col1', 'col2', 'col3'], ['1', '2', '3'], ['4', '5', '6']])
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            stage_files([self.img], "sid", "move", upload_dir=self.upload_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import base64
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from infiagent.llm import image_cache
+from infiagent.llm.client.claude_openai import encode_image
+from infiagent.llm.image_cache import ImagePayloadCache, prepare_image, read_image_info
+from infiagent.schemas import MediaFile
+
+
+class TestImagePayloadCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.builds = []
+
+    def _image(self, name, color, size=(64, 64)):
+        path = os.path.join(self.tmp_dir, name)
+        Image.new("RGB", size, color).save(path)
+        return path
+
+    def _build(self, image_path):
+        self.builds.append(image_path)
+        with open(image_path, "rb") as fr:
+            return base64.b64encode(fr.read()).decode("utf-8")
+
+    def test_same_content_is_encoded_once(self):
+        cache = ImagePayloadCache()
+        first, copy = self._image("a.png", "red"), self._image("copy.png", "red")
+        payload = cache.get_or_build(first, "b64", self._build)
+        # Another session stages the same image under another path
+        self.assertIs(cache.get_or_build(copy, "b64", self._build), payload)
+        self.assertEqual(len(self.builds), 1)
+        cache.get_or_build(first, "other", self._build)
+        self.assertEqual(len(self.builds), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_least_recently_used_are_evicted(self):
+        paths = [self._image(f"{color}.png", color) for color in ["red", "green", "blue"]]
+        payload_size = len(self._build(paths[0]))
+        cache = ImagePayloadCache(max_size=payload_size * 2)
+        cache.get_or_build(paths[0], "b64", self._build)
+        cache.get_or_build(paths[1], "b64", self._build)
+        cache.get_or_build(paths[0], "b64", self._build)
+        cache.get_or_build(paths[2], "b64", self._build)
+        self.builds.clear()
+        cache.get_or_build(paths[0], "b64", self._build)
+        self.assertEqual(self.builds, [])
+        cache.get_or_build(paths[1], "b64", self._build)
+        self.assertEqual(self.builds, [paths[1]])
+        self.assertLessEqual(cache.size, cache.max_size)
+
+    def test_payloads_are_persisted(self):
+        directory = os.path.join(self.tmp_dir, "cache")
+        path = self._image("a.png", "red")
+        payload = ImagePayloadCache(directory=directory).get_or_build(path, "claude", encode_image)
+        # Another process reads the payload from disk
+        cache = ImagePayloadCache(directory=directory)
+        self.assertEqual(cache.get_or_build(path, "claude", self._build), payload)
+        self.assertEqual(self.builds, [])
+
+    def test_claude_payload_is_resized(self):
+        os.makedirs(os.path.join(self.tmp_dir, "upload_files"))
+        path = os.path.join(self.tmp_dir, "upload_files", "photo.jpg")
+        Image.effect_noise((512, 512), 64).convert("RGB").save(path, quality=100)
+        self.assertEqual(encode_image(path)["media_type"], "image/jpeg")
+
+        max_size_mb = os.path.getsize(path) / 4 / 1024 / 1024
+        source = encode_image(path, max_size_mb=max_size_mb)
+        image_data = base64.b64decode(source["data"])
+        self.assertEqual(source["media_type"], "image/png")
+        self.assertLessEqual(len(image_data), max_size_mb * 1024 * 1024)
+        with Image.open(io.BytesIO(image_data)) as img:
+            self.assertLessEqual(img.width, 256)
+        # The resized image is not written next to the staged one
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["photo.jpg"])
+
+    def test_images_are_prepared_for_provider_limits(self):
+        path = os.path.join(self.tmp_dir, "large.bmp")
+        Image.new("RGB", (4000, 1000), "blue").save(path)
+        image_data, media_type = prepare_image(path, max_edge=1568)
+        self.assertEqual(media_type, "image/png")
+        with Image.open(io.BytesIO(image_data)) as img:
+            self.assertEqual(img.size, (1568, 392))
+
+        info = read_image_info(path)
+        self.assertEqual((info["width"], info["height"], info["format"]), (4000, 1000, "BMP"))
+        self.assertEqual(info["tokens"]["openai"], 170 * 4 + 85)
+        self.assertEqual(info["tokens"]["claude"], 820)
+
+    def test_media_files_are_read_from_the_sandbox(self):
+        # Images are read from the sandbox directory under tmp
+        os.makedirs(os.path.join(self.tmp_dir, "tmp", "upload_files"))
+        path = self._image(os.path.join("tmp", "upload_files", "a.png"), "red")
+        with mock.patch.object(image_cache, "root_directory", self.tmp_dir):
+            payload = ImagePayloadCache().get_or_build(MediaFile(sandbox_path="upload_files/a.png"), "b64",
+                                                       self._build)
+        self.assertEqual(self.builds, [path])
+        self.assertEqual(payload, self._build(path))
+
+    def test_media_files_are_read_from_the_source_while_staging(self):
+        source = self._image("source.png", "red")
+        image = MediaFile(sandbox_path="upload_files/a.png", source_path=source)
+        with mock.patch.object(image_cache, "root_directory", self.tmp_dir):
+            ImagePayloadCache().get_or_build(image, "b64", self._build)
+        self.assertEqual(self.builds, [source])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
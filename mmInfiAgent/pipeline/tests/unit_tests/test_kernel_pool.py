@@ -0,0 +1,183 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from infiagent.exceptions.exceptions import SandboxException
+from infiagent.tools import KernelPool, SandboxKernel, AsyncPythonSandBoxTool
+from infiagent.tools.code_sandbox import python_code_sandbox
+
+
+class TestKernelPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.work_dir = os.path.join(self.tmp_dir, "ci_workspace")
+
+    def test_released_kernel_is_reset_and_reused(self):
+        async def _run():
+            pool = KernelPool(work_dir=self.work_dir, kernel_cwd=self.tmp_dir, min_size=1, max_size=1, max_uses=2)
+            await pool.warm_up()
+            self.assertEqual(pool.idle_size, 1)
+
+            kernel = await pool.acquire()
+            self.assertTrue(await kernel.run_silent("x = 1\nimport os\nos.chdir('/')"))
+            pool.release(kernel)
+            await asyncio.gather(*pool._background_tasks)
+
+            reused = await pool.acquire()
+            self.assertIs(reused, kernel)
+            self.assertFalse(await reused.run_silent("x"))
+            self.assertTrue(await reused.run_silent(f"import os\nassert os.getcwd() == {self.tmp_dir!r}"))
+
+            # The kernel served max_uses sandboxes, it is replaced by a fresh one
+            pool.release(reused)
+            await asyncio.gather(*pool._background_tasks)
+            self.assertIsNot(await pool.acquire(), kernel)
+            self.assertFalse(kernel.is_alive())
+            await pool.close()
+
+        asyncio.run(_run())
+
+    def test_reset_restores_module_state(self):
+        async def _run():
+            pool = KernelPool(work_dir=self.work_dir, kernel_cwd=self.tmp_dir, max_size=1, max_uses=3,
+                              preload_modules=["numpy", "pandas"])
+            kernel = await pool.acquire()
+            self.assertTrue(await kernel.run_silent(
+                "import os, sys, warnings\nimport numpy as np\nimport pandas as pd\n"
+                "pd.set_option('display.max_rows', 3)\nnp.set_printoptions(precision=2)\nnp.seterr(all='raise')\n"
+                "sys.path.insert(0, '/question')\nos.environ['QUESTION'] = '1'\nwarnings.simplefilter('error')"))
+            pool.release(kernel)
+            await asyncio.gather(*pool._background_tasks)
+
+            reused = await pool.acquire()
+            self.assertIs(reused, kernel)
+            self.assertTrue(await reused.run_silent(
+                "import os, sys, warnings\nimport numpy as np\nimport pandas as pd\n"
+                "assert pd.get_option('display.max_rows') == 60\nassert np.get_printoptions()['precision'] == 8\n"
+                "assert np.geterr()['divide'] == 'warn'\nassert '/question' not in sys.path\n"
+                "assert 'QUESTION' not in os.environ\nwarnings.warn('not an error')"))
+            pool.release(reused)
+            await pool.close()
+
+        asyncio.run(_run())
+
+    def test_kernel_importing_stateful_modules_is_replaced(self):
+        async def _run():
+            pool = KernelPool(work_dir=self.work_dir, kernel_cwd=self.tmp_dir, max_size=1, max_uses=3,
+                              preload_modules=[])
+            kernel = await pool.acquire()
+            # numpy was not imported when the kernel started, its options can't be restored
+            self.assertTrue(await kernel.run_silent("import numpy as np\nnp.set_printoptions(precision=2)"))
+            pool.release(kernel)
+            await asyncio.gather(*pool._background_tasks)
+            self.assertIsNot(await pool.acquire(), kernel)
+            self.assertFalse(kernel.is_alive())
+            await pool.close()
+
+        asyncio.run(_run())
+
+    def test_acquire_waits_when_pool_is_full(self):
+        async def _run():
+            pool = KernelPool(work_dir=self.work_dir, kernel_cwd=self.tmp_dir, max_size=1, max_uses=2,
+                              preload_modules=[])
+            kernel = await pool.acquire()
+            waiter = asyncio.create_task(pool.acquire())
+            await asyncio.sleep(0.1)
+            self.assertFalse(waiter.done())
+
+            pool.release(kernel)
+            self.assertIs(await asyncio.wait_for(waiter, timeout=30), kernel)
+            await pool.close()
+
+        asyncio.run(_run())
+
+    def test_kernels_run_concurrently(self):
+        async def _run():
+            pool = KernelPool(work_dir=self.work_dir, kernel_cwd=self.tmp_dir, preload_modules=[])
+            kernels = await asyncio.gather(pool.acquire(), pool.acquire())
+
+            start_time = time.time()
+            responses = await asyncio.gather(*[
+                AsyncPythonSandBoxTool._execute_code(kernel.client, f"import time\ntime.sleep(2)\nprint({index})")
+                for index, kernel in enumerate(kernels)])
+            self.assertLess(time.time() - start_time, 3.5)
+            self.assertEqual([response.raw_output.strip() for response in responses], ["0", "1"])
+            await pool.close()
+
+        asyncio.run(_run())
+
+    def test_timeout_interrupts_kernel(self):
+        async def _run():
+            pool = KernelPool(work_dir=self.work_dir, kernel_cwd=self.tmp_dir, preload_modules=[])
+            kernel = await pool.acquire()
+            start_time = time.time()
+            response = await AsyncPythonSandBoxTool._execute_code(
+                kernel.client, "x = 1\nprint('started', flush=True)\nwhile True:\n    pass", timeout=1,
+                interrupt=kernel.interrupt)
+            self.assertLess(time.time() - start_time, 5)
+            self.assertIn("started", response.raw_output)
+            self.assertIn("exceeded the time limit of 1s and was interrupted", response.output_text)
+            self.assertNotIn("KeyboardInterrupt", response.output_text)
+
+            # The kernel is idle again and kept its namespace
+            response = await AsyncPythonSandBoxTool._execute_code(kernel.client, "print(x)", timeout=5)
+            self.assertEqual(response.raw_output.strip(), "1")
+            await pool.close()
+
+        asyncio.run(_run())
+
+    def test_sandbox_deadlines(self):
+        async def _run():
+            tool = AsyncPythonSandBoxTool(name="python_code_sandbox", description="", step_timeout=1,
+                                          question_timeout=10)
+            await tool.set_sandbox_id("deadlines")
+            timeout = await tool.async_run("```python\nx = 2\nimport time\ntime.sleep(30)\n```")
+            self.assertIn("exceeded the time limit of 1s", timeout.output_text)
+            self.assertEqual((await tool.async_run("```python\nprint(x)\n```")).raw_output.strip(), "2")
+
+            # Code ignoring the interrupt gets its kernel replaced
+            with mock.patch.object(python_code_sandbox, "KERNEL_INTERRUPT_TIMEOUT", 1):
+                stuck = await tool.async_run("```python\nimport signal\nsignal.signal(signal.SIGINT, "
+                                             "signal.SIG_IGN)\nwhile True:\n    pass\n```")
+            self.assertIn("the interpreter was restarted", stuck.output_text)
+            self.assertIn("NameError", (await tool.async_run("```python\nprint(x)\n```")).output_text)
+
+            await asyncio.sleep(max(0.0, tool._question_deadline - time.monotonic()))
+            late = await tool.async_run("```python\nprint(3)\n```")
+            self.assertIn("The question exceeded its time limit of 10s", late.output_text)
+            AsyncPythonSandBoxTool.kill_kernels("deadlines")
+            await AsyncPythonSandBoxTool.get_kernel_pool().close()
+
+        asyncio.run(_run())
+
+    def test_kernel_dying_at_startup_raises(self):
+        async def _run():
+            # The launch script fails to chdir into the missing cwd and exits before signalling it is ready
+            with self.assertRaises(SandboxException):
+                await SandboxKernel.start(self.work_dir, "kernel_dead", os.path.join(self.tmp_dir, "missing"))
+            self.assertFalse(os.path.exists(os.path.join(self.work_dir, "kernel_dead")))
+
+        asyncio.run(_run())
+
+    def test_failed_spawn_closes_the_ready_pipe(self):
+        async def _run():
+            open_fds = len(os.listdir("/proc/self/fd"))
+            with mock.patch("asyncio.create_subprocess_exec", side_effect=OSError("no more processes")):
+                with self.assertRaises(OSError):
+                    await SandboxKernel.start(self.work_dir, "kernel_unspawned", self.tmp_dir)
+            self.assertEqual(len(os.listdir("/proc/self/fd")), open_fds)
+            self.assertFalse(os.path.exists(os.path.join(self.work_dir, "kernel_unspawned")))
+
+        asyncio.run(_run())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+import pytest
+
+from infiagent.agent.react.async_react_agent import STOP_WORD, find_step_end
+from infiagent.agent.react.output_parser import parse_react_output
+from infiagent.llm import BaseLLM, VLlmOpenAIClient
+from infiagent.llm.base_llm import cut_completion
+from infiagent.llm.transport import close_transport
+from infiagent.schemas import BaseCompletion
+
+ACTION_STEP = ("I will load the data first.\n"
+               "Action: python_code_sandbox\n"
+               "Action Input: ```python\n"
+               "import pandas as pd\n"
+               "print(pd.read_csv('data.csv').shape)\n"
+               "```")
+HALLUCINATED_STEPS = "\nThought: the shape tells the row count, so next I will " + "keep reasoning about it " * 40
+# An action printing the stop word, followed by a made up observation
+PRINTING_ACTION_STEP = ACTION_STEP.replace("```python\n", "```python\nprint('Observation: rows below')\n")
+
+
+class _WholeCompletionLLM(BaseLLM):
+
+    def __init__(self, content: str):
+        super().__init__(model_name="whole", params={})
+        self.content = content
+
+    async def async_completion(self, prompt, input_imgs=None, **kwargs) -> BaseCompletion:
+        return BaseCompletion(state="success", content=self.content)
+
+
+class TestStepEnd(unittest.TestCase):
+
+    def test_step_ends(self):
+        self.assertEqual(find_step_end(ACTION_STEP + HALLUCINATED_STEPS), len(ACTION_STEP))
+        final_answer = "Thought: I now know the final answer.\nFinal Answer: ```json[\"3 rows\"]```"
+        self.assertEqual(find_step_end(final_answer + "\nThought: more"), len(final_answer))
+        # A json block of a thought is not an action
+        self.assertIsNone(find_step_end("Thought: the schema is ```json{}``` so\nAction: python_code_sandbox\n"))
+
+    def test_final_answer_after_an_action_is_cut(self):
+        # The answer is not based on the output of the action, the action is run instead
+        text = ACTION_STEP + "\nFinal Answer: ```json[\"3 rows\"]```"
+        self.assertTrue(parse_react_output(text).is_final)
+        self.assertEqual(find_step_end(text), len(ACTION_STEP))
+        self.assertFalse(parse_react_output(text[:find_step_end(text)]).is_final)
+
+    def test_every_prefix_gives_the_same_step(self):
+        text = ACTION_STEP + "\nObservation: made up\nFinal Answer: ```json[1]```"
+        ends = {find_step_end(text[:index]) for index in range(len(text) + 1)}
+        self.assertEqual(ends, {None, len(ACTION_STEP)})
+
+    def test_whole_completions_are_cut(self):
+        llm = _WholeCompletionLLM(ACTION_STEP + "\nObservation: made up" + HALLUCINATED_STEPS)
+        self.assertFalse(llm.supports_streaming)
+        completion = asyncio.run(llm.async_completion_until("prompt", until=find_step_end, stop=STOP_WORD))
+        self.assertEqual(completion.content, ACTION_STEP)
+
+    def test_stop_words_in_code_are_kept(self):
+        llm = _WholeCompletionLLM(PRINTING_ACTION_STEP + "\nObservation: made up" + HALLUCINATED_STEPS)
+        completion = asyncio.run(llm.async_completion_until("prompt", until=find_step_end, stop=STOP_WORD))
+        self.assertEqual(completion.content, PRINTING_ACTION_STEP)
+        # Without a complete step the stop word outside the code still cuts the completion
+        self.assertEqual(cut_completion("Let me see ```x``` Observation: made up ```y```", stop=STOP_WORD),
+                         "Let me see ```x``` ")
+
+
+@pytest.mark.usefixtures("mock_llm_server")
+class TestStreamingCompletion(unittest.TestCase):
+    MOCK_SERVER_SCRIPT = [ACTION_STEP + HALLUCINATED_STEPS]
+    MOCK_SERVER_ARGS = ["--tokens_per_second", "200"]
+
+    def test_generation_is_cancelled_after_the_action(self):
+        async def _run():
+            llm = VLlmOpenAIClient(model_name="mock", params={"max_tokens": 4096}, api_base=f"{self.base_url}/v1")
+            self.assertTrue(llm.supports_streaming)
+            start_time = time.time()
+            completion = await llm.async_completion_until("Question: How many rows?\nThought:",
+                                                          until=find_step_end, stop=STOP_WORD)
+            elapsed = time.time() - start_time
+            await close_transport()
+            return completion, elapsed
+
+        completion, elapsed = asyncio.run(_run())
+        self.assertEqual(completion.content, ACTION_STEP)
+        self.assertGreater(completion.completion_token, 0)
+        # The whole turn takes about 3 seconds to generate
+        self.assertLess(elapsed, 1.5)
+        time.sleep(0.2)
+        stats = httpx.get(f"{self.base_url}/stats").json()
+        self.assertEqual((stats["in_flight"], stats["completed"]), (0, 0))
+
+
+
+@pytest.mark.usefixtures("mock_llm_server")
+class TestStreamingStopWords(unittest.TestCase):
+    MOCK_SERVER_SCRIPT = [PRINTING_ACTION_STEP + "\nObservation: made up" + HALLUCINATED_STEPS,
+                          "Let me see ```x```\nObservation: made up" + HALLUCINATED_STEPS]
+
+    def test_stop_words_in_code_are_kept(self):
+        async def _run():
+            llm = VLlmOpenAIClient(model_name="mock", params={"max_tokens": 4096}, api_base=f"{self.base_url}/v1")
+            prompt = "Question: How many rows?\nThought:"
+            action = await llm.async_completion_until(prompt, until=find_step_end, stop=STOP_WORD)
+            # Without a complete step the stop word outside the code still ends the completion
+            thought = await llm.async_completion_until(f"{prompt}{action.content}\nObservation:\n(3, 2)\n\nThought:",
+                                                       until=find_step_end, stop=STOP_WORD)
+            await close_transport()
+            return action, thought
+
+        action, thought = asyncio.run(_run())
+        self.assertEqual(action.content, PRINTING_ACTION_STEP)
+        self.assertEqual(thought.content, "Let me see ```x```\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from aiohttp import web
+
+from infiagent.llm import VLlmOpenAIClient
+from infiagent.llm.transport import close_transport, configure_transport, get_aiohttp_session, run_blocking, \
+    shutdown_sdk_executor
+
+
+async def _start_server(name, requests):
+    async def _chat_completion(request):
+        requests.append((request.headers.get("Authorization"), request.transport.get_extra_info("peername")))
+        return web.json_response({"id": "1", "object": "chat.completion", "model": "m",
+                                  "choices": [{"index": 0, "message": {"role": "assistant", "content": name},
+                                               "finish_reason": "stop"}],
+                                  "usage": {"prompt_tokens": 1, "completion_tokens": 1}})
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", _chat_completion)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/v1"
+
+
+class TestLLMTransport(unittest.TestCase):
+
+    def test_clients_keep_their_endpoint_and_reuse_connections(self):
+        async def _run():
+            requests_a, requests_b = [], []
+            runner_a, base_a = await _start_server("a", requests_a)
+            runner_b, base_b = await _start_server("b", requests_b)
+            llm_params = {"max_tokens": 4096, "temperature": 0, "top_p": 1}
+            client_a = VLlmOpenAIClient(model_name="m", params=llm_params, api_base=base_a)
+            client_b = VLlmOpenAIClient(model_name="m", params=llm_params, api_base=base_b)
+
+            for _ in range(3):
+                completions = await asyncio.gather(client_a.async_completion("q"), client_b.async_completion("q"))
+                self.assertEqual([completion.content for completion in completions], ["a", "b"])
+
+            # Sequential rounds run on the same keep-alive connection
+            self.assertEqual(len(requests_a), 3)
+            self.assertEqual(len({peer for _, peer in requests_a}), 1)
+            self.assertEqual(len({peer for _, peer in requests_b}), 1)
+
+            session = get_aiohttp_session()
+            await close_transport()
+            self.assertTrue(session.closed)
+            await runner_a.cleanup()
+            await runner_b.cleanup()
+
+        asyncio.run(_run())
+
+    def test_blocking_sdk_calls_leave_the_loop_free(self):
+        async def _run():
+            ticks = 0
+
+            async def _ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticker = asyncio.create_task(_ticker())
+            start_time = time.monotonic()
+            results = await asyncio.gather(*[run_blocking(time.sleep, 0.2) for _ in range(4)])
+            ticker.cancel()
+            self.assertEqual(results, [None] * 4)
+            # The four calls ran side by side, and the loop kept running meanwhile
+            self.assertLess(time.monotonic() - start_time, 0.35)
+            self.assertGreater(ticks, 10)
+
+        asyncio.run(_run())
+
+    def test_blocking_sdk_calls_time_out(self):
+        async def _run():
+            started = []
+            release = threading.Event()
+
+            def _call(name):
+                started.append(name)
+                release.wait(5)
+
+            with self.assertRaises(asyncio.TimeoutError):
+                await run_blocking(_call, "running", timeout=0.1)
+            # With a single thread busy, a timed out call is dropped from the queue before it starts
+            with self.assertRaises(asyncio.TimeoutError):
+                await run_blocking(_call, "queued", timeout=0.1)
+            release.set()
+            await run_blocking(time.sleep, 0)
+            self.assertEqual(started, ["running"])
+
+        shutdown_sdk_executor()
+        configure_transport(sdk_max_workers=1)
+        try:
+            asyncio.run(_run())
+        finally:
+            shutdown_sdk_executor()
+            configure_transport(sdk_max_workers=32)
+
+
+if __name__ == '__main__':
+    unittest.main()
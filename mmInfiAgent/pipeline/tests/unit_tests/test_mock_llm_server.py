@@ -0,0 +1,62 @@
+import asyncio
+import json
+import time
+import unittest
+
+import httpx
+import pytest
+
+from infiagent.llm import VLlmOpenAIClient
+from infiagent.llm.transport import close_transport
+
+@pytest.mark.usefixtures("mock_llm_server")
+class TestMockLLMServer(unittest.TestCase):
+    MOCK_SERVER_ARGS = ["--latency", "fixed:0.2"]
+
+    def test_react_turns_advance_with_the_prompt(self):
+        async def _run():
+            llm = VLlmOpenAIClient(model_name="mock", params={"max_tokens": 4096, "temperature": 0, "top_p": 1},
+                                   api_base=f"{self.base_url}/v1")
+            prompt = "Question: How many rows?\nThought:"
+            start_time = time.time()
+            first, other = await asyncio.gather(llm.async_completion(prompt),
+                                                llm.async_completion("Question: Another one?\nThought:"))
+            # Concurrent requests wait for their latency at the same time
+            self.assertLess(time.time() - start_time, 0.39)
+            self.assertIn("Action: python_code_sandbox", first.content)
+            self.assertEqual(first.content, other.content)
+
+            second = await llm.async_completion(f"{prompt}{first.content}\nObservation:\n['data.csv']\n\nThought:\n")
+            self.assertIn("Final Answer:", second.content)
+            await close_transport()
+
+        asyncio.run(_run())
+
+    def test_streams_server_sent_events(self):
+        request = {"model": "mock", "stream": True, "stop": ["```\n"],
+                   "messages": [{"role": "user", "content": "Question: Stream it\nThought:"}]}
+        content = ""
+        with httpx.stream("POST", f"{self.base_url}/v1/chat/completions", json=request) as response:
+            for line in response.iter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                content += json.loads(line[len("data: "):])["choices"][0]["delta"].get("content", "")
+        # The completion is cut before the stop sequence
+        self.assertTrue(content.startswith("Let me look at the attached files first."))
+        self.assertNotIn("```\n", content)
+
+
+
+@pytest.mark.usefixtures("mock_llm_server")
+class TestMockLLMServerThrottling(unittest.TestCase):
+    MOCK_SERVER_ARGS = ["--throttle_rate", "1"]
+
+    def test_injected_throttling(self):
+        response = httpx.post(f"{self.base_url}/v1/chat/completions",
+                              json={"model": "mock", "messages": [{"role": "user", "content": "q"}]})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(httpx.get(f"{self.base_url}/stats").json()["throttled"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from aiohttp import web
+from PIL import Image
+
+from infiagent.exceptions.exceptions import InputErrorException
+from infiagent.llm import AzureOpenAIGPTClient, OpenAICompatibleClient
+from infiagent.llm.client.llava_openai import LlavaOpenAIGPTClient
+from infiagent.llm.transport import close_transport
+from infiagent.schemas import MediaFile
+
+
+async def _start_server(requests, failures=0):
+    async def _chat_completion(request):
+        body = await request.json()
+        requests.append({"path": request.path, "headers": dict(request.headers), "body": body})
+        if len(requests) <= failures:
+            return web.json_response({"error": {"message": "overloaded", "type": "server_error"}}, status=500)
+        content = body.get("model") or request.match_info.get("engine")
+        return web.json_response({"id": "1", "object": "chat.completion", "model": content,
+                                  "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                               "finish_reason": "stop"}],
+                                  "usage": {"prompt_tokens": 1, "completion_tokens": 1}})
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", _chat_completion)
+    app.router.add_post("/openai/deployments/{engine}/chat/completions", _chat_completion)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+class TestOpenAICompatibleClient(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_path = os.path.join(self.tmp_dir, "chart.bmp")
+        Image.new("RGB", (64, 32), "red").save(self.image_path)
+
+    def test_backends_run_side_by_side(self):
+        async def _run():
+            requests = []
+            runner, base_url = await _start_server(requests)
+            llava = LlavaOpenAIGPTClient(model_name="llava", params={"temperature": 0.2},
+                                         api_base=f"{base_url}/v1", api_key="key-a")
+            # The config of a generic client, as read from the llm section of an agent config
+            internvl = await OpenAICompatibleClient.create({
+                "model_name": "internvl", "params": {"max_tokens": 512}, "api_base": f"{base_url}/v1",
+                "api_key": "key-b", "image_transport": "base64", "max_gen_length": 256,
+                "sampling_params": {"temperature": 0.7, "max_tokens": None, "top_p": None}})
+            # Only the clients of servers known to stream do so by default
+            self.assertFalse(llava.supports_streaming or internvl.supports_streaming)
+            self.assertTrue(AzureOpenAIGPTClient(model_name="gptv", params={}).supports_streaming)
+            completions = await asyncio.gather(
+                llava.async_completion("q", [MediaFile(open_path="https://example.com/chart.png")]),
+                internvl.async_completion("q", [self.image_path]))
+            await close_transport()
+            await runner.cleanup()
+            return completions, {request["body"]["model"]: request for request in requests}
+
+        completions, requests = asyncio.run(_run())
+        self.assertEqual([completion.content for completion in completions], ["llava", "internvl"])
+        llava, internvl = requests["llava"], requests["internvl"]
+        self.assertEqual(llava["headers"]["Authorization"], "Bearer key-a")
+        self.assertEqual(internvl["headers"]["Authorization"], "Bearer key-b")
+        self.assertEqual(llava["body"]["messages"][0]["content"][1]["image_url"]["url"],
+                         "https://example.com/chart.png")
+        self.assertTrue(internvl["body"]["messages"][0]["content"][1]["image_url"]["url"]
+                        .startswith("data:image/png;base64,"))
+        self.assertEqual((llava["body"]["temperature"], "max_tokens" in llava["body"]), (0.2, False))
+        self.assertEqual((internvl["body"]["temperature"], internvl["body"]["max_tokens"]), (0.7, 512))
+        self.assertNotIn("top_p", internvl["body"])
+
+    def test_azure_deployment_and_retries(self):
+        async def _run():
+            requests = []
+            runner, base_url = await _start_server(requests, failures=1)
+            llm = AzureOpenAIGPTClient(model_name="gpt-4v", params={}, api_base=base_url, api_key="azure-key",
+                                       stream=False, retry_attempts=2, retry_min_wait=0, retry_max_wait=0)
+            self.assertFalse(llm.supports_streaming)
+            completion = await llm.async_completion("q")
+            await close_transport()
+            await runner.cleanup()
+            return completion, requests
+
+        completion, requests = asyncio.run(_run())
+        self.assertEqual(completion.content, "gpt-4v")
+        # The failed attempt is retried as configured
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[-1]["path"], "/openai/deployments/gpt-4v/chat/completions")
+        self.assertEqual(requests[-1]["headers"]["api-key"], "azure-key")
+
+    def test_invalid_config(self):
+        with self.assertRaises(InputErrorException):
+            OpenAICompatibleClient(model_name="m", params={}, image_transport="file")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
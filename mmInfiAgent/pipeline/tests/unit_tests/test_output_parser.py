@@ -0,0 +1,54 @@
+import random
+import time
+import unittest
+
+from infiagent.agent.react.output_parser import ParsedOutput, parse_react_output, parse_react_output_regex
+from infiagent.exceptions.exceptions import LLMException
+
+# Pieces of the ReAct format and near misses, put together at random for the equivalence check
+TOKENS = ["Action:", "Action :", "Action", " Input:", "Action Input:", "Action\nInput: ", "Input :", "```python\n",
+          "```py\n", "```json", "```", "'''", "'''py\n", "''", "\n", " ", "x", "print(1)", "Thought: ok",
+          "Final Answer:", "final answer", "[END]"]
+
+
+def _outcome(parse, llm_output):
+    try:
+        return parse(llm_output)
+    except LLMException as e:
+        return str(e)
+
+
+class TestOutputParser(unittest.TestCase):
+
+    def test_steps(self):
+        action = parse_react_output("Load it.\nAction: python_code_sandbox\nAction Input: ```python\nprint(1)\n```")
+        self.assertEqual(action, ParsedOutput(context="Load it.", tool="python_code_sandbox", tool_input="print(1)"))
+        self.assertFalse(action.is_final)
+        answer = parse_react_output("Thought: done\nFinal Answer: ```json[\"3\"]```")
+        self.assertEqual(answer.final_answer, "Thought: done\n ```json[\"3\"]```")
+        bare = parse_react_output("Plot it.\n```python\ndf.plot()\n```")
+        self.assertEqual((bare.tool, bare.tool_input), ("python_code_sandbox", "df.plot()"))
+        with self.assertRaisesRegex(LLMException, "Missing 'Action Input'"):
+            parse_react_output("Action: python_code_sandbox\n")
+        with self.assertRaisesRegex(LLMException, "Unrecognized"):
+            parse_react_output("'''python\nprint(1)\n'''")
+
+    def test_same_results_as_the_regex_parser(self):
+        rng = random.Random(7)
+        for _ in range(5000):
+            llm_output = "".join(rng.choice(TOKENS) for _ in range(rng.randint(0, 14)))
+            self.assertEqual(_outcome(parse_react_output, llm_output),
+                             _outcome(parse_react_output_regex, llm_output), llm_output)
+
+    def test_linear_time(self):
+        # The former regexes take minutes on these
+        for llm_output in ["Action: python_code_sandbox\n" * 2000,
+                           "Action: a\nAction Input: ```python\n" + "df.head()\n" * 20000,
+                           "```python\nprint(1)\n" * 5000]:
+            start_time = time.perf_counter()
+            _outcome(parse_react_output, llm_output)
+            self.assertLess(time.perf_counter() - start_time, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from infiagent.agent import AsyncReactAgent
+from infiagent.prompt import PromptBuilder, SimpleReactPrompt, ZeroShotReactPrompt
+from infiagent.schemas import AgentAction, AgentObservation
+
+
+def _steps(rounds):
+    steps = []
+    for index in range(rounds):
+        steps.append(AgentAction(tool="python_code_sandbox", tool_input="print(1)", formatted_output="",
+                                 raw_output=f"Thought {index} {{braces}}\nAction: python_code_sandbox"))
+        steps.append(AgentObservation(tool="python_code_sandbox", formatted_output=f"Observation {index}",
+                                      raw_output=""))
+    return steps
+
+
+class TestPromptBuilder(unittest.TestCase):
+
+    def test_matches_full_format(self):
+        for prompt_template in [SimpleReactPrompt(), ZeroShotReactPrompt()]:
+            variables = dict(instruction="Question: {x}?", tool_description="sandbox", tool_names="sandbox")
+            builder = PromptBuilder(prompt_template, **variables)
+            steps = _steps(3)
+            for index, step in enumerate(steps):
+                builder.append(step)
+                expected = prompt_template.format(
+                    agent_scratchpad=prompt_template.construct_scratchpad(steps[:index + 1]), **variables)
+                self.assertEqual(builder.build(), expected)
+                self.assertTrue(expected.startswith(builder.prefix))
+
+    def test_agent_prompt_follows_steps(self):
+        agent = AsyncReactAgent(prompt_template=ZeroShotReactPrompt())
+        agent.intermediate_steps.extend(_steps(1))
+        prompt = agent._compose_prompt("Question: a")
+        prefix = agent.prompt_prefix
+
+        agent.intermediate_steps.extend(_steps(2)[2:])
+        self.assertTrue(agent._compose_prompt("Question: a").startswith(prompt))
+        self.assertIs(agent.prompt_prefix, prefix)
+
+        agent.clear()
+        self.assertIsNone(agent.prompt_prefix)
+        self.assertNotIn("Observation 0", agent._compose_prompt("Question: b"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+import pytest
+
+from infiagent.agent import AgentFactory
+from infiagent.llm.transport import close_transport, get_request_timeout, request_deadline
+from infiagent.schemas import AgentRequest, Message, QuestionBudget, RoleType
+from infiagent.services.chat_complete_service import predict
+from infiagent.tools import AsyncPythonSandBoxTool
+from infiagent.utils.system_messages import AGENT_EXCEED_MAX_RETRY_EN
+
+SCRIPT = [
+    " I will count the rows.\n"
+    "Action: python_code_sandbox\n"
+    "Action Input: ```python\n"
+    "print(3)\n"
+    "```\n",
+    " I now know the answer.\n"
+    "Final Answer: ```json[\"3\"]```",
+]
+
+
+@pytest.mark.usefixtures("mock_llm_server")
+class TestQuestionBudget(unittest.TestCase):
+    MOCK_SERVER_SCRIPT = SCRIPT
+    MOCK_SERVER_ARGS = ["--latency", "fixed:3"]
+
+    def test_limits(self):
+        now = time.time()
+        budget = QuestionBudget(max_seconds=100, max_tokens=1000, max_sandbox_seconds=30, run_deadline=now + 50)
+        self.assertAlmostEqual(budget.deadline, now + 50, delta=1)
+        self.assertIsNone(budget.exhausted)
+        budget.add_sandbox_seconds(25)
+        self.assertAlmostEqual(budget.remaining_sandbox_seconds(), 5, delta=1)
+        budget.add_tokens(600)
+        self.assertEqual(budget.remaining_tokens(), 400)
+        budget.add_tokens(400)
+        self.assertEqual(budget.exhausted, "token")
+        self.assertEqual(QuestionBudget(max_seconds=10, started_at=now - 20).exhausted, "time")
+        self.assertEqual(QuestionBudget(run_deadline=now - 1).exhausted, "run time")
+        self.assertIsNone(QuestionBudget().deadline)
+
+    def test_request_timeouts(self):
+        self.assertEqual(get_request_timeout(60), 60)
+        with request_deadline(time.time() + 5):
+            self.assertLessEqual(get_request_timeout(60), 5)
+            self.assertLessEqual(get_request_timeout(), 5)
+        self.assertIsNone(get_request_timeout())
+
+    def test_exhausted_budgets_finish_the_question(self):
+        async def _run(budget):
+            content = await predict(prompt="Question: How many rows?\n", uploaded_files=[], uploaded_imgs=[],
+                                    open_path_img="", config_path=self.config_path, budget=budget)
+            await close_transport()
+            return content
+
+        # The prompt alone is over the token budget, the LLM isn't called
+        content = asyncio.run(_run(QuestionBudget(max_tokens=10)))
+        self.assertIn("within its token budget", content)
+
+        # The LLM call is cancelled at the deadline instead of waiting for the response
+        start_time = time.time()
+        content = asyncio.run(_run(QuestionBudget(max_seconds=1)))
+        self.assertLess(time.time() - start_time, 3)
+        self.assertIn("within its time budget", content)
+        self.assertNotIn("[\"3\"]", content)
+        self.assertEqual(AsyncPythonSandBoxTool._KERNELS, {})
+
+    def test_client_timeouts_are_retried(self):
+        async def _run(budget):
+            agent = await AgentFactory().acquire(self.config_path)
+            completion = mock.AsyncMock(side_effect=asyncio.TimeoutError())
+            with mock.patch.object(agent.llm, "async_completion_until", completion):
+                request = AgentRequest(messages=[Message(RoleType.User, "Question: How many rows?")], budget=budget)
+                responses = [response async for response in agent.async_run(request)]
+            return responses, completion.await_count
+
+        # A timeout of the client is not an exhausted budget, with or without a budget
+        for budget in [None, QuestionBudget(max_seconds=3600)]:
+            responses, attempts = asyncio.run(_run(budget))
+            self.assertEqual(attempts, 2)
+            self.assertEqual(responses[-1].output_text.strip(), AGENT_EXCEED_MAX_RETRY_EN)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import asyncio
+import time
+import unittest
+
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_fixed
+
+from infiagent.llm import BaseLLM
+from infiagent.llm.rate_limiter import RateLimiter, TokenBucket, before_sleep_throttle
+from infiagent.schemas import BaseCompletion
+
+
+class ThrottledError(Exception):
+    http_status = 429
+
+
+class _FakeLLM(BaseLLM):
+
+    def __init__(self, fail_calls=0, **data):
+        super().__init__(**data)
+        self.fail_calls = fail_calls
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def async_completion(self, prompt: str, **kwargs) -> BaseCompletion:
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            if self.calls <= self.fail_calls:
+                raise ThrottledError("429 Too Many Requests")
+            return BaseCompletion(state="success", content="ok", prompt_token=100, completion_token=20)
+        finally:
+            self.in_flight -= 1
+
+
+class _RetryingLLM(_FakeLLM):
+
+    async def async_completion(self, prompt: str, **kwargs) -> BaseCompletion:
+        @retry(wait=wait_fixed(0), stop=stop_after_attempt(3), retry=retry_if_exception_type(ThrottledError),
+               reraise=True, before_sleep=before_sleep_throttle())
+        async def _call():
+            return await super(_RetryingLLM, self).async_completion(prompt, **kwargs)
+
+        return await _call()
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_concurrency_shrinks_on_throttling_and_grows_back(self):
+        async def _run():
+            llm = _FakeLLM(fail_calls=8, model_name="aimd", params={},
+                           rate_limit={"max_concurrency": 8, "cooldown": 0})
+            limiter = llm.rate_limiter
+            results = await asyncio.gather(*[llm.async_completion("q") for _ in range(8)], return_exceptions=True)
+            self.assertTrue(all(isinstance(result, ThrottledError) for result in results))
+            self.assertEqual(limiter.concurrency, 1)
+
+            llm.max_in_flight = 0
+            await asyncio.gather(*[llm.async_completion("q") for _ in range(20)])
+            self.assertEqual(limiter.in_flight, 0)
+            self.assertGreater(limiter.concurrency, 1)
+            # The calls were let through as the limit grew back from 1, not all at once
+            self.assertLess(llm.max_in_flight, limiter.concurrency + 1)
+
+        asyncio.run(_run())
+
+    def test_limiter_is_shared_by_model(self):
+        first = _FakeLLM(model_name="shared", params={})
+        second = _FakeLLM(model_name="shared", params={})
+        other = _FakeLLM(model_name="other", params={})
+        self.assertIs(first.rate_limiter, second.rate_limiter)
+        self.assertIsNot(first.rate_limiter, other.rate_limiter)
+
+    def test_retries_are_limited_once(self):
+        async def _run():
+            llm = _RetryingLLM(fail_calls=2, model_name="retry", params={},
+                               rate_limit={"max_concurrency": 4, "requests_per_minute": 600, "cooldown": 0})
+            limiter = llm.rate_limiter
+            completion = await llm.async_completion("q")
+            self.assertEqual(completion.content, "ok")
+            self.assertEqual(llm.calls, 3)
+            # The parent completion ran in the slot of the override, each retry took a request and halved the
+            # limit from 4 to 1, and the final success added one slot
+            self.assertEqual(limiter.in_flight, 0)
+            self.assertEqual(limiter.concurrency, 2)
+            self.assertLess(limiter._requests.level, 600 - 2)
+
+        asyncio.run(_run())
+
+    def test_cancelled_waiter_passes_on_its_slot(self):
+        async def _run():
+            limiter = RateLimiter("cancelled", max_concurrency=1)
+            await limiter._acquire_slot()
+            first = asyncio.ensure_future(limiter._acquire_slot())
+            second = asyncio.ensure_future(limiter._acquire_slot())
+            await asyncio.sleep(0)
+            # The first waiter is woken up by the release and cancelled before it runs
+            limiter._release_slot()
+            first.cancel()
+            await asyncio.wait_for(second, timeout=1)
+            self.assertTrue(first.cancelled())
+            self.assertEqual(limiter.in_flight, 1)
+
+        asyncio.run(_run())
+
+    def test_token_usage_is_settled(self):
+        async def _run():
+            llm = _FakeLLM(model_name="tokens", params={}, rate_limit={"tokens_per_minute": 6000})
+            await llm.async_completion("x" * 400)
+            # 100 tokens reserved from the prompt length, settled with the 120 tokens used
+            self.assertAlmostEqual(llm.rate_limiter._tokens.level, 6000 - 120, delta=5)
+
+        asyncio.run(_run())
+
+    def test_bucket_waits_for_refill(self):
+        async def _run():
+            bucket = TokenBucket(600)
+            bucket.consume(600)
+            start_time = time.monotonic()
+            await bucket.take(1)
+            self.assertGreater(time.monotonic() - start_time, 0.05)
+
+        asyncio.run(_run())
+
+
+if __name__ == '__main__':
+    unittest.main()
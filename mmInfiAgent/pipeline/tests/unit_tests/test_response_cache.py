@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+from infiagent.exceptions.exceptions import LLMCacheMissException
+from infiagent.llm import BaseLLM
+from infiagent.llm import image_cache
+from infiagent.llm.response_cache import ResponseCache, configure_response_cache
+from infiagent.schemas import BaseCompletion, MediaFile
+
+
+class _CountingLLM(BaseLLM):
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self.calls = 0
+
+    async def async_completion(self, prompt: str, input_imgs=None, **kwargs) -> BaseCompletion:
+        self.calls += 1
+        return BaseCompletion(state="success", content=f"answer {self.calls}", prompt_token=10, completion_token=2)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmp_dir, "cache.sqlite")
+
+    def test_record_then_replay_without_calls(self):
+        async def _run():
+            llm = _CountingLLM(model_name="cached", params={"temperature": 0})
+            configure_response_cache(mode="record", path=self.cache_path)
+            recorded = await llm.async_completion("Read upload_files/aB3dE6gH/data.csv")
+            self.assertEqual(llm.calls, 1)
+
+            cache = configure_response_cache(mode="replay_or_fail", path=self.cache_path)
+            # Another session stages the same file under another sandbox id
+            replayed = await llm.async_completion("Read upload_files/Zy9xW8vU/data.csv")
+            self.assertEqual(replayed, recorded)
+            self.assertEqual(llm.calls, 1)
+            self.assertEqual(cache.hits, 1)
+
+            with self.assertRaises(LLMCacheMissException):
+                await llm.async_completion("Another question")
+            self.assertEqual(llm.calls, 1)
+
+            # Other sampling params are another key
+            llm_hot = _CountingLLM(model_name="cached", params={"temperature": 1})
+            configure_response_cache(mode="replay", path=self.cache_path)
+            await llm_hot.async_completion("Read upload_files/aB3dE6gH/data.csv")
+            self.assertEqual(llm_hot.calls, 1)
+
+        try:
+            asyncio.run(_run())
+        finally:
+            configure_response_cache(mode="off")
+
+    def test_images_are_keyed_by_content(self):
+        # Images are read from the sandbox directory under tmp
+        os.makedirs(os.path.join(self.tmp_dir, "tmp", "upload_files"))
+        for name, content in [("a.png", b"image"), ("b.png", b"image"), ("c.png", b"other")]:
+            with open(os.path.join(self.tmp_dir, "tmp", "upload_files", name), "wb") as fw:
+                fw.write(content)
+
+        with mock.patch.object(image_cache, "root_directory", self.tmp_dir):
+            keys = [ResponseCache.make_key("m", {}, "prompt", [MediaFile(sandbox_path=f"upload_files/{name}")])
+                    for name in ["a.png", "b.png", "c.png"]]
+            # Before the staging is done the image is keyed by its source file
+            staging = MediaFile(sandbox_path="upload_files/d.png", open_path="http://host/d.png",
+                                source_path=os.path.join(self.tmp_dir, "tmp", "upload_files", "a.png"))
+            keys.append(ResponseCache.make_key("m", {}, "prompt", [staging]))
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+        self.assertEqual(keys[0], keys[3])
+
+    def test_least_recently_used_are_evicted(self):
+        completion = BaseCompletion(state="success", content="x" * 100)
+        entry_size = len(zlib.compress(json.dumps(completion.to_dict()).encode("utf-8")))
+        # Room for three entries and a half, eviction frees down to 90% of it
+        cache = ResponseCache(path=self.cache_path, mode="replay", max_size=entry_size * 7 // 2)
+        for key in ["a", "b", "c"]:
+            cache.put(key, completion)
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("d", completion)
+        self.assertIsNone(cache.get("b"))
+        for key in ["a", "c", "d"]:
+            self.assertIsNotNone(cache.get(key))
+        self.assertLessEqual(cache.size, cache.max_size)
+        cache.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
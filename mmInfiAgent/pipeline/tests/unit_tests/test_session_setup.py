@@ -0,0 +1,75 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+import pytest
+
+from infiagent.conversation_sessions import CodeInterpreterSession
+from infiagent.llm.transport import close_transport
+from infiagent.services.chat_complete_service import predict
+from infiagent.tools import AsyncPythonSandBoxTool
+from infiagent.utils import configure_csv_info_cache
+
+SCRIPT = [
+    " I will count the rows.\n"
+    "Action: python_code_sandbox\n"
+    "Action Input: ```python\n"
+    "import pandas as pd\n"
+    "print(len(pd.read_csv('data.csv')))\n"
+    "```\n",
+    " I now know the answer.\n"
+    "Final Answer: ```json[\"3\"]```",
+]
+
+
+@pytest.mark.usefixtures("mock_llm_server")
+class TestSessionSetup(unittest.TestCase):
+    MOCK_SERVER_SCRIPT = SCRIPT
+    MOCK_SERVER_ARGS = ["--latency", "fixed:0.5"]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        configure_csv_info_cache(os.path.join(cls.tmp_dir, "csv_info_cache"))
+        cls.csv_path = os.path.join(cls.tmp_dir, "data.csv")
+        with open(cls.csv_path, "w") as fw:
+            fw.write("a,b\n1,2\n3,4\n5,6\n")
+
+    def test_setup_overlaps_the_first_round(self):
+        async def _run():
+            session = await CodeInterpreterSession.create(config_path=self.config_path)
+            sandbox_id = session.session_id
+            await session.stage_to_sandbox([self.csv_path], stage_mode="symlink")
+            # Neither the kernel nor the staging is waited for before the chat starts
+            self.assertIn(sandbox_id, AsyncPythonSandBoxTool._KERNEL_TASKS)
+            self.assertEqual(len(AsyncPythonSandBoxTool._SETUP_TASKS[sandbox_id]), 1)
+            self.assertEqual(session.input_files[0].source_path, self.csv_path)
+            self.assertIn("a       3 non-null", session.input_files[0].file_basic_info)
+            await AsyncPythonSandBoxTool.cancel_setup(sandbox_id)
+            AsyncPythonSandBoxTool.kill_kernels(sandbox_id)
+            session.close()
+            self.assertNotIn(sandbox_id, AsyncPythonSandBoxTool._KERNELS)
+
+            content = await predict(prompt="Question: How many rows?\n", uploaded_files=[self.csv_path],
+                                    uploaded_imgs=[], open_path_img="", stage_mode="symlink",
+                                    config_path=self.config_path)
+            await close_transport()
+            return content
+
+        content = asyncio.run(_run())
+        # The first code run waited for the staged file and the kernel
+        self.assertIn("STDOUT:\n```python\n3\n", content)
+        self.assertIn("[\"3\"]", content)
+        self.assertEqual((AsyncPythonSandBoxTool._KERNELS, AsyncPythonSandBoxTool._KERNEL_TASKS,
+                          AsyncPythonSandBoxTool._SETUP_TASKS), ({}, {}, {}))
+
+    @classmethod
+    def tearDownClass(cls):
+        configure_csv_info_cache()
+        shutil.rmtree(cls.tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+from infiagent.llm import VLlmOpenAIClient
+from infiagent.llm.token_budget import ApproximateTokenizer, TokenBudget, get_context_window, get_tokenizer
+from infiagent.prompt import PromptBuilder, ZeroShotReactPrompt
+from infiagent.schemas import AgentAction, AgentObservation
+
+
+def _steps(rounds, observation_length=400):
+    steps = []
+    for index in range(rounds):
+        steps.append(AgentAction(tool="python_code_sandbox", tool_input="print(1)", formatted_output="",
+                                 raw_output=f"Thought {index}\nAction: python_code_sandbox"))
+        steps.append(AgentObservation(tool="python_code_sandbox", raw_output="",
+                                      formatted_output=f"Observation {index} " + "value, " * observation_length))
+    return steps
+
+
+class TestTokenBudget(unittest.TestCase):
+
+    def test_approximate_counts(self):
+        tokenizer = ApproximateTokenizer()
+        self.assertEqual(tokenizer.count("x" * 400), 100)
+        self.assertEqual(tokenizer.count("数据分析"), 4)
+        text = "df = pd.read_csv('upload_files/data.csv')\nprint(df.head())\n" * 20
+        head, tail = tokenizer.head(text, 50), tokenizer.tail(text, 50)
+        self.assertTrue(text.startswith(head) and text.endswith(tail))
+        self.assertLessEqual(tokenizer.count(head), 50)
+        self.assertLessEqual(tokenizer.count(tail), 50)
+        self.assertGreater(tokenizer.count(head), 45)
+
+    def test_context_windows(self):
+        self.assertEqual(get_context_window("gpt-4-0613"), 8192)
+        self.assertEqual(get_context_window("gpt-4o-2024-05-13"), 128000)
+        self.assertEqual(get_context_window("claude3"), 200000)
+        self.assertEqual(get_context_window("Qwen-72B-Chat", {"max_tokens": 8192}), 8192)
+        self.assertEqual(get_context_window("gpt-4", {"context_window": 1000}), 1000)
+        self.assertIs(get_tokenizer("gpt-4"), get_tokenizer("gpt-4"))
+
+    def test_truncate_keeps_both_ends(self):
+        budget = TokenBudget("local", 100)
+        text = "Instructions first. " + "filler " * 500 + "Latest step."
+        truncated, token_count = budget.truncate(text)
+        self.assertLessEqual(token_count, 100)
+        self.assertTrue(truncated.startswith("Instructions first."))
+        self.assertTrue(truncated.endswith("Latest step."))
+
+    def test_client_fits_prompt_in_tokens(self):
+        # The former character budget cut this prompt of 10000 characters to 2596 characters
+        llm = VLlmOpenAIClient(model_name="local", params={"max_tokens": 4096})
+        prompt = "word " * 2000
+        self.assertEqual(llm.fit_prompt(prompt), prompt)
+        self.assertLessEqual(llm.token_budget.count(llm.fit_prompt(prompt * 2)), 4096 - llm.max_gen_length)
+
+    def test_builder_condenses_then_drops_old_steps(self):
+        prompt_template = ZeroShotReactPrompt()
+        builder = PromptBuilder(prompt_template, instruction="Question: how many rows?", tool_description="sandbox",
+                                tool_names="sandbox")
+        steps = _steps(3)
+        for step in steps:
+            builder.append(step)
+        full_prompt = builder.build()
+        full_tokens = TokenBudget("local", 1).count(full_prompt)
+
+        # Room for all steps once the oldest observation is condensed
+        budget = TokenBudget("local", full_tokens - 300)
+        prompt = builder.build(budget)
+        self.assertLessEqual(builder.token_count, budget.max_prompt_tokens)
+        self.assertTrue(prompt.startswith(builder.prefix))
+        self.assertIn("Thought 0", prompt)
+        self.assertIn("[condensed]", prompt.split("Thought 1")[0])
+        self.assertTrue(prompt.endswith(full_prompt[-1000:]))
+
+        # Without room for the old steps, they are dropped and the latest action and observation kept
+        budget = TokenBudget("local", full_tokens // 2)
+        prompt = builder.build(budget)
+        self.assertLessEqual(builder.token_count, budget.max_prompt_tokens)
+        self.assertTrue(prompt.startswith(builder.prefix))
+        self.assertNotIn("Thought 0", prompt)
+        self.assertIn("earlier steps omitted", prompt)
+        self.assertIn("Thought 2", prompt)
+        self.assertIn(steps[-1].formatted_output, prompt)
+
+
+if __name__ == '__main__':
+    unittest.main()